@@ -1,45 +1,70 @@
 import os
+import math
 import time
-import ast
+import asyncio
+from contextlib import aclosing, asynccontextmanager
+
+import anyio
 
 import uvicorn
 
-from fastapi import FastAPI, Header, WebSocket
+from fastapi import FastAPI, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import Annotated
 
 import logging
 from fastapi import Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
-from typing import AsyncIterable
+from typing import AsyncIterable, Awaitable, Callable, List, Literal, Optional
 from fastapi.responses import StreamingResponse
-from langchain.callbacks import AsyncIteratorCallbackHandler
 
-from bairdotr.ollama_llm import get_all_in_one_rag, get_ollama_model
+
+from bairdotr.config import RUN_NAME, BACKGROUND_STARTUP, WARMUP_ON_STARTUP, STREAM_PROTOCOL, WEBSOCKET_PROTOCOL
+from bairdotr.startup import RagRuntime
+from bairdotr.embedding_worker import BatchingEmbeddings
 from bairdotr.llm_wrapper import(
-    get_model_answer_rag, 
+    aget_model_answer_rag, 
+    alookup_answer_cache,
+    split_for_replay,
     clean_history, 
     cut_history,
-    get_runnable_chain,
+    make_cached_turn,
+    make_interrupted_turn,
+    make_chain_input,
     make_config_for_chain
 )
-from bairdotr.tools import question_with_RAG
+from bairdotr.tools import aquestion_with_RAG
+from bairdotr.executors import RequestLimiter, CapacityExceeded
+from bairdotr.metrics import GenerationTimer, get_pipeline_metrics
+from bairdotr.scheduler import LlmOverloaded, get_llm_scheduler, llm_client
+from bairdotr.streaming import ClientDisconnected, FrameEncoder, coalesce, stop_on_disconnect, stream_in_task
 from bairdotr.database_management import(
-    read_data_token,
-    make_token,
+    get_or_make_token,
     check_token,
-    get_path_to_hot_history,
-    read_hot_history,
-    write_hot_history,
+    clear_hot_history,
+    aread_hot_history,
+    awrite_hot_history,
     write_to_cold_history,
     generate_hex,
     get_session_history_with_local_file
 )
 
-app = FastAPI()
+# Модель (общая для всех запросов процесса: её HTTP-клиенты держат пул соединений к Ollama), база,
+# цепочка с историей и кеш ответов загружаются после открытия порта, см. /readyz
+RUNTIME = RagRuntime(warmup = WARMUP_ON_STARTUP)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if BACKGROUND_STARTUP:
+        RUNTIME.start()
+    else:
+        await asyncio.to_thread(RUNTIME.load)
+    yield
+
+app = FastAPI(lifespan = lifespan)
 
 #------------------------
 # Для того, чтобы React мог связываться с FastApi, ему нужно открыть порты 
@@ -55,7 +80,27 @@ app.add_middleware(
 )
 # -----------------------
 
-MODEL, VECTOR_STORE = get_all_in_one_rag()
+# Одновременно к модели идёт не больше MAX_CONCURRENT_REQUESTS запросов, остальные ждут в очереди или получают отказ
+LIMITER = RequestLimiter()
+# Все вызовы Ollama идут через общий планировщик: приоритеты, очередь по клиентам, быстрый отказ с Retry-After
+SCHEDULER = get_llm_scheduler()
+OVERLOADED_TEXT = "Сервер перегружен. Попробуйте повторить запрос позже"
+NOT_READY_TEXT = "Сервер запускается. Попробуйте повторить запрос через минуту"
+BAD_REQUEST_TEXT = 'Некорректный запрос: ожидается JSON {"message": "вопрос"}'
+
+# Гистограммы этапов пишут сами модули bairdotr, здесь - запросы и текущее состояние процесса
+METRICS = get_pipeline_metrics()
+METRICS.add_gauge("bairdotr_requests_in_progress", "Chat requests holding a slot", lambda: LIMITER.active)
+METRICS.add_gauge("bairdotr_requests_queued", "Chat requests waiting for a slot", lambda: LIMITER.waiting)
+METRICS.add_gauge("bairdotr_ready", "1 when models and the vector store are loaded", lambda: int(RUNTIME.ready))
+METRICS.add_gauge(
+    "bairdotr_index_vectors", "Live vectors in the FAISS index",
+    lambda: RUNTIME.vector_store.index.ntotal - RUNTIME.vector_store.n_deleted if RUNTIME.ready else None
+)
+METRICS.add_gauge(
+    "bairdotr_index_deleted_vectors", "Deleted vectors waiting for compaction",
+    lambda: RUNTIME.vector_store.n_deleted if RUNTIME.ready else None
+)
 
 class CommonHeaders(BaseModel):
     token: str
@@ -63,30 +108,37 @@ class CommonHeaders(BaseModel):
 class ClearBody(BaseModel):
     session_id: str
 
+class WebSocketRequest(BaseModel):
+    """Вопрос по websocket (JSON)"""
+    message: str
+    sources: Optional[List[str]] = None
+
 class RequestBody(BaseModel):
     question: str
     session_id: str
+    # Искать ответ только в этих исходных файлах (имена - как в GET /sources)
+    sources: Optional[List[str]] = None
 
 @app.get("/")
 def read_root():
     """Проверка связи"""
     return {"connection": "good"}
 
+@app.get("/healthz")
+def healthz() -> dict:
+    """Процесс жив и отвечает (модели при этом могут ещё загружаться)"""
+    return {"status": "alive"}
+
+@app.get("/readyz")
+def readyz() -> JSONResponse:
+    """Готовность принимать вопросы: модели и база загружены и прогреты. Иначе - 503"""
+    status_code = status.HTTP_200_OK if RUNTIME.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse(content = RUNTIME.state(), status_code = status_code)
+
 @app.get("/registry")
 def get_token(user_id: str) -> dict:
     """Получение существующего токена или создание нового при отсутствии записи"""
-    data = read_data_token()
-    create_token = True
-    token = None
-
-    for user in data["id"]:
-        if user == user_id:
-            create_token = False
-            token = data.loc[data["id"] == user_id]["token"].item()
-            break
-    
-    if create_token:
-        token = make_token(user_id)
+    token = get_or_make_token(user_id)
 
     return {"response": 200, "token": token}
 
@@ -97,45 +149,91 @@ def clear_history(headers: Annotated[CommonHeaders, Header()], body: ClearBody)
     # token = get_token(token)["token"]
 
     if check_token(token):
-        path = get_path_to_hot_history(body.session_id)
-        if os.path.isfile(path):
-            os.remove(path)
+        clear_hot_history(body.session_id)
         return {"response": 200, "status": "history cleaned"}
 
     else:
         return {"response": 401, "text": "Такого токена не существует. Попробуйте завести новый или обновить текущий"}
 
 @app.post("/chat/completions")
-def model_answer(headers: Annotated[CommonHeaders, Header()], body: RequestBody) -> dict:
+async def model_answer(headers: Annotated[CommonHeaders, Header()], body: RequestBody, response: Response) -> dict:
     """Получение ответа от модели. История подгружается согласно токену"""
     token = headers.token
     # token = get_token(token)["token"]
 
-    if check_token(token):
-        time_question = int(time.time())
-
-        session_id = body.session_id
-
-        history = read_hot_history(session_id)
-
-        answer, history = get_model_answer_rag(
-            human_message = body.question,
-            model = MODEL,
-            vector_store = VECTOR_STORE,
-            history = history
-        )
-
-        history = clean_history(history)
-        history = cut_history(history)
-        
-        write_hot_history(session_id, history)
-        write_to_cold_history(session_id, body.question, time_question, answer)
+    if not RUNTIME.ready:
+        METRICS.requests.inc("completions", "not_ready")
+        return {"response": 503, "text": NOT_READY_TEXT}
 
+    if check_token(token):
+        request_start = time.perf_counter()
+        try:
+            check_model_queue()
+            async with LIMITER.slot():
+                # Вызовы модели этого запроса стоят в очереди планировщика от имени токена
+                with llm_client(token):
+                    time_question = int(time.time())
+
+                    session_id = body.session_id
+
+                    history = await aread_hot_history(session_id)
+
+                    answer, history = await aget_model_answer_rag(
+                        human_message = body.question,
+                        model = RUNTIME.model,
+                        vector_store = RUNTIME.vector_store,
+                        history = history,
+                        answer_cache = RUNTIME.answer_cache,
+                        sources = body.sources
+                    )
+
+                    history = clean_history(history)
+                    history = cut_history(history)
+                
+                    await awrite_hot_history(session_id, history)
+                    write_to_cold_history(session_id, body.question, time_question, answer)
+
+        except CapacityExceeded as e:
+            METRICS.requests.inc("completions", "overloaded")
+            response.headers["Retry-After"] = str(retry_after(e))
+            return {"response": 503, "text": OVERLOADED_TEXT, "retry_after": retry_after(e)}
+
+        METRICS.request_seconds.observe(time.perf_counter() - request_start, "completions")
+        METRICS.requests.inc("completions", "ok")
         return {"response": 200, "question": body.question, "answer": answer}
 
     else:
+        METRICS.requests.inc("completions", "unauthorized")
         return {"response": 401, "text": "Такого токена не существует. Попробуйте завести новый или обновить текущий"}
 
+@app.get("/sources")
+def list_sources() -> dict:
+    """Исходные файлы базы и число их чанков - допустимые значения `sources` в запросе"""
+    if not RUNTIME.ready:
+        return {"response": 503, "text": NOT_READY_TEXT}
+
+    return {"response": 200, "sources": RUNTIME.vector_store.source_index.sources()}
+
+@app.get("/stats/cache")
+def cache_stats() -> dict:
+    """Попадания в кеш ответов и кеш эмбеддингов запросов, средний размер батча эмбеддингов"""
+    if not RUNTIME.ready:
+        return {"response": 503, "text": NOT_READY_TEXT}
+
+    answer_cache, vector_store = RUNTIME.answer_cache, RUNTIME.vector_store
+    return {
+        "response": 200,
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "query_cache": vector_store.query_cache.stats() if vector_store.query_cache is not None else None,
+        "embedding_batches": vector_store.embeddings.stats() if isinstance(vector_store.embeddings, BatchingEmbeddings) else None
+    }
+
+@app.get("/metrics")
+def metrics() -> PlainTextResponse:
+    """Метрики в текстовом формате Prometheus: длительность этапов, время до первого токена,
+    скорость генерации, запросы в работе, размер индекса"""
+    return PlainTextResponse(METRICS.render(), media_type = "text/plain; version=0.0.4")
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
 	exc_str = f'{exc}'.replace('\n', ' ').replace('   ', ' ')
@@ -147,66 +245,333 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 # Streaming
 # -----------------------------
 
-async def send_message(session_id: str, content: str) -> AsyncIterable[str]:
-    callback = AsyncIteratorCallbackHandler()
-    model = get_ollama_model(need_callback = [callback])
-
-    runnable_with_history = get_runnable_chain(model)
-    config = make_config_for_chain(session_id)
-
-    message_with_rag_docs = question_with_RAG(
-        question = content, 
-        vector_store = VECTOR_STORE,
-        model = model,
-        history = get_session_history_with_local_file(session_id).messages
-    )
-
-    async for chunk in runnable_with_history.astream_events({'input': message_with_rag_docs}, version="v2", config=config):
-            if chunk["event"] in ["on_parser_stream", "on_parser_end"]:
-                if chunk["event"] == "on_parser_end":
-                    yield "END_OF_STREAM"
-                else:
-                    yield chunk["data"]["chunk"]
+def retry_after(e: CapacityExceeded) -> int:
+    """Через сколько секунд повторить отклонённый запрос: оценка очереди планировщика модели
+    или, для отказа по числу запросов, время ожидания их очереди"""
+    if isinstance(e, LlmOverloaded):
+        return e.retry_after
+    return math.ceil(LIMITER.queue_timeout)
+
+def check_model_queue() -> None:
+    """`LlmOverloaded`, если новый запрос заведомо не дождётся модели за LLM_QUEUE_DEADLINE секунд.
+    Запросы, уже принятые API, но ещё не занявшие слот модели, встанут в её очередь раньше нового"""
+    SCHEDULER.check(pending = max(0, LIMITER.active - SCHEDULER.active) + LIMITER.waiting)
+
+async def lookup_first_question(messages: list, question: str, sources: List[str] = None):
+    """Поиск ответа в семантическом кеше, если вопрос - первый в диалоге и задан по всей базе\n
+    Возвращает эмбеддинг вопроса (None, если кеш не используется) и найденный ответ или None"""
+    if RUNTIME.answer_cache is None or messages or sources is not None:
+        return None, None
+    return await alookup_answer_cache(question, RUNTIME.vector_store, RUNTIME.answer_cache)
+
+async def stream_answer_tokens(
+        chain_input: dict,
+        config: dict,
+        timer: GenerationTimer,
+        answer: list,
+        protocol: str = STREAM_PROTOCOL
+) -> AsyncIterable[str]:
+    """Токены ответа с замером генерации, текст ответа собирается в `answer`.
+    "delta" - из `chain.astream`, "events" - из событий on_parser_stream `astream_events`. В обоих случаях
+    цепочку читает отдельная задача, которая отменяется, если поток закрыт раньше конца (см. `stream_in_task`)"""
+    if protocol == "delta":
+        async with aclosing(stream_in_task(RUNTIME.runnable_with_history.astream(chain_input, config = config))) as tokens:
+            async for token in tokens:
+                timer.token()
+                answer.append(token)
+                yield token
+    else:
+        async for chunk in RUNTIME.runnable_with_history.astream_events(chain_input, version="v2", config=config):
+            if chunk["event"] == "on_parser_stream":
+                timer.token()
+                answer.append(chunk["data"]["chunk"])
+                yield chunk["data"]["chunk"]
+
+async def save_interrupted_answer(history, question: str, rag_prompt: str, answer: list, timer: GenerationTimer, endpoint: str) -> None:
+    """Клиент отключился посреди ответа. Генерация к этому моменту уже остановлена (поток закрыт),
+    в историю пишется начало ответа с пометкой, в метрики - сэкономленное время генерации"""
+    saved = timer.abort()
+    await history.aadd_messages(make_interrupted_turn(question, rag_prompt, "".join(answer)))
+    METRICS.requests.inc(endpoint, "disconnected")
+    print(f"Client disconnected: generation stopped after {timer.n_tokens} tokens, ~{saved:.1f} s of generation saved")
+
+async def send_message(
+        session_id: str,
+        content: str,
+        sources: List[str] = None,
+        protocol: str = STREAM_PROTOCOL,
+        is_disconnected: Callable[[], Awaitable[bool]] = None
+) -> AsyncIterable[str]:
+    """Текст ответа для /stream_chat/, в конце - END_OF_STREAM\n
+    `protocol`: "delta" - токены склеиваются в куски (`coalesce`), "events" - по одному токену из astream_events\n
+    `is_disconnected` (`request.is_disconnected`) проверяется во время генерации: если клиент ушёл, генерация
+    прерывается. Отмена задачи сервером (starlette отменяет ответ при http.disconnect) обрабатывается так же"""
+    if not RUNTIME.ready:
+        METRICS.requests.inc("stream", "not_ready")
+        yield NOT_READY_TEXT
+        yield "END_OF_STREAM"
+        return
+
+    request_start = time.perf_counter()
+    try:
+        async with LIMITER.slot():
+            config = make_config_for_chain(session_id)
+            history = get_session_history_with_local_file(session_id)
+            messages = await history.aget_messages()
+
+            vector, cached = await lookup_first_question(messages, content, sources)
+            if cached is not None:
+                await history.aadd_messages(make_cached_turn(cached))
+                pieces = [cached.answer] if protocol == "delta" else split_for_replay(cached.answer)
+                for piece in pieces:
+                    yield piece
+                METRICS.request_seconds.observe(time.perf_counter() - request_start, "stream")
+                METRICS.requests.inc("stream", "cached")
+                yield "END_OF_STREAM"
+                return
+
+            # Генерация в цепочке берёт клиента из session_id в config, модификация вопроса - отсюда
+            with llm_client(session_id):
+                message_with_rag_docs, rag_docs = await aquestion_with_RAG(
+                    question = content, 
+                    vector_store = RUNTIME.vector_store,
+                    model = RUNTIME.model,
+                    history = messages,
+                    need_to_rag_docs_return = True,
+                    sources = sources
+                )
+
+            answer = []
+            timer = GenerationTimer(METRICS)
+            tokens = stream_answer_tokens(make_chain_input(content, message_with_rag_docs), config, timer, answer, protocol)
+            if is_disconnected is not None:
+                tokens = stop_on_disconnect(tokens, is_disconnected)
+            if protocol == "delta":
+                tokens = coalesce(tokens)
+            try:
+                async with aclosing(tokens) as pieces:
+                    async for piece in pieces:
+                        yield piece
+            except (ClientDisconnected, asyncio.CancelledError, GeneratorExit) as e:
+                # Поток токенов уже закрыт (вместе с запросом к Ollama); запись истории не должна отменяться
+                with anyio.CancelScope(shield = True):
+                    await save_interrupted_answer(history, content, message_with_rag_docs, answer, timer, "stream")
+                if isinstance(e, ClientDisconnected):
+                    return
+                raise
+
+            timer.finish()
+            if vector is not None:
+                RUNTIME.answer_cache.put(content, vector, message_with_rag_docs, "".join(answer), rag_docs)
+            METRICS.request_seconds.observe(time.perf_counter() - request_start, "stream")
+            METRICS.requests.inc("stream", "ok")
+            yield "END_OF_STREAM"
+
+    except CapacityExceeded:
+        METRICS.requests.inc("stream", "overloaded")
+        yield OVERLOADED_TEXT
+        yield "END_OF_STREAM"
 
 @app.post("/stream_chat/")
-async def stream_chat(message: RequestBody):
+async def stream_chat(message: RequestBody, request: Request, protocol: Literal["delta", "events"] = STREAM_PROTOCOL):
+    if RUNTIME.ready:
+        # После начала потокового ответа статус уже не поменять: при заведомо долгой очереди к модели
+        # отказ с Retry-After отправляется сразу
+        try:
+            check_model_queue()
+        except LlmOverloaded as e:
+            METRICS.requests.inc("stream", "overloaded")
+            return PlainTextResponse(
+                OVERLOADED_TEXT + "END_OF_STREAM",
+                status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers = {"Retry-After": str(e.retry_after)}
+            )
+
     generator = send_message(
         session_id = message.session_id, 
-        content = message.question
+        content = message.question,
+        sources = message.sources,
+        protocol = protocol,
+        is_disconnected = request.is_disconnected
     )
     return StreamingResponse(generator, media_type="text/plain")
 
+class WebSocketSender():
+    """Отправка ответа по websocket в формате, выбранном клиентом при подключении\n
+    - "delta": компактные кадры {"type", "delta"} (см. bairdotr.streaming), кодировка json, binary или msgpack
+    - "events": прежний формат - события rag_system и on_parser_* с run_id"""
+    def __init__(self, websocket: WebSocket, protocol: str = WEBSOCKET_PROTOCOL, encoder: FrameEncoder = None) -> None:
+        self.websocket = websocket
+        self.protocol = protocol
+        self.encoder = encoder or FrameEncoder()
+        self.run_id = None
+
+    async def frame(self, frame_type: str, delta: str = "", name: str = None) -> None:
+        data = self.encoder.encode(frame_type, delta, name)
+        if isinstance(data, bytes):
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.send_text(data)
+
+    async def error(self, name: str, text: str) -> None:
+        if self.protocol == "delta":
+            await self.frame("error", text, name)
+        else:
+            await self.websocket.send_json({"event": "error", "name": name, "data": text, "run_id": "rag_system"})
+
+    async def context(self, rag_docs: str) -> None:
+        if self.protocol == "delta":
+            await self.frame("context", rag_docs)
+        else:
+            await self.websocket.send_json({"event": "rag_system", "name": "RAG", "data": rag_docs, "run_id": "rag_system"})
+
+    async def start(self) -> None:
+        self.run_id = generate_hex()
+        if self.protocol == "delta":
+            await self.frame("start")
+        else:
+            await self.websocket.send_json({"event": "on_parser_start", "name": RUN_NAME, "run_id": self.run_id, "data": {}})
+
+    async def delta(self, text: str) -> None:
+        if self.protocol == "delta":
+            await self.frame("delta", text)
+        else:
+            await self.websocket.send_json({"event": "on_parser_stream", "name": RUN_NAME, "run_id": self.run_id, "data": {"chunk": text}})
+
+    async def end(self) -> None:
+        if self.protocol == "delta":
+            await self.frame("end")
+        else:
+            await self.websocket.send_json({"event": "on_parser_end", "name": RUN_NAME, "run_id": self.run_id})
+
 @app.websocket("/ws/chat/")
 async def websocket_endpoint(websocket: WebSocket):
+    """Диалог по websocket. Формат ответа выбирается параметрами подключения:
+    `?protocol=delta|events` (по умолчанию WEBSOCKET_PROTOCOL) и `?encoding=json|binary|msgpack` (для delta)"""
     await websocket.accept()
 
-    runnable_with_history = get_runnable_chain(MODEL)
+    protocol = websocket.query_params.get("protocol", WEBSOCKET_PROTOCOL)
+    try:
+        if protocol not in ("delta", "events"):
+            raise ValueError(f"Unknown stream protocol: {protocol}, expected delta or events")
+        sender = WebSocketSender(websocket, protocol, FrameEncoder(websocket.query_params.get("encoding", "json")))
+    except ValueError as e:
+        await websocket.close(code = 1003, reason = str(e))
+        return
+
     session_id = generate_hex()
     config = make_config_for_chain(session_id)
 
-    while True:
-        data = await websocket.receive_text()
-        message = ast.literal_eval(data)["message"]
-
-        # RAG system
-        message_with_rag_docs, rag_answer = question_with_RAG(
-            question = message, 
-            vector_store = VECTOR_STORE,
-            model = MODEL,
-            history = get_session_history_with_local_file(session_id).messages,
-            need_to_rag_docs_return = True
-        )
-
-        await websocket.send_json({
-            "event": "rag_system",
-            "name": "RAG",
-            "data": rag_answer,
-            "run_id": "rag_system"
-        })
-
-        async for chunk in runnable_with_history.astream_events({'input': message_with_rag_docs}, version="v2", config=config):
-            if chunk["event"] in ["on_parser_start", "on_parser_stream"]:
-                await websocket.send_json(chunk)
+    # Клиент может закрыть соединение и между вопросами, и посреди ответа
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                request = WebSocketRequest.model_validate_json(data)
+            except ValidationError:
+                METRICS.requests.inc("websocket", "bad_request")
+                await sender.error("bad_request", BAD_REQUEST_TEXT)
+                continue
+            message = request.message
+            sources = request.sources
+
+            if not RUNTIME.ready:
+                METRICS.requests.inc("websocket", "not_ready")
+                await sender.error("not_ready", NOT_READY_TEXT)
+                continue
+
+            request_start = time.perf_counter()
+            # Отключение клиента видно по ошибке отправки любого кадра (WebSocketDisconnect): ответа из кеша,
+            # контекста, очередного куска ответа. `unsaved` - вопрос ещё не попал в историю, его нужно сохранить прерванным
+            unsaved = False
+            message_with_rag_docs = message
+            answer = []
+            timer = None
+            try:
+                check_model_queue()
+                async with LIMITER.slot():
+                    history = get_session_history_with_local_file(session_id)
+                    messages = await history.aget_messages()
+
+                    vector, cached = await lookup_first_question(messages, message, sources)
+                    if cached is not None:
+                        await history.aadd_messages(make_cached_turn(cached))
+                        await replay_cached_answer(sender, cached.rag_docs, cached.answer)
+                        METRICS.request_seconds.observe(time.perf_counter() - request_start, "websocket")
+                        METRICS.requests.inc("websocket", "cached")
+                        continue
+
+                    unsaved = True
+                    # RAG system
+                    with llm_client(session_id):
+                        message_with_rag_docs, rag_answer = await aquestion_with_RAG(
+                            question = message, 
+                            vector_store = RUNTIME.vector_store,
+                            model = RUNTIME.model,
+                            history = messages,
+                            need_to_rag_docs_return = True,
+                            sources = sources
+                        )
+
+                    await sender.context(rag_answer)
+
+                    timer = GenerationTimer(METRICS)
+                    chain_input = make_chain_input(message, message_with_rag_docs)
+                    # При отключении клиента поток токенов закрывается (aclosing), и Ollama прекращает генерацию
+                    if protocol == "delta":
+                        await sender.start()
+                        async with aclosing(coalesce(stream_answer_tokens(chain_input, config, timer, answer))) as pieces:
+                            async for piece in pieces:
+                                await sender.delta(piece)
+                        # Поток дочитан: цепочка сохранила ответ в историю
+                        unsaved = False
+                        timer.finish()
+                        if vector is not None:
+                            RUNTIME.answer_cache.put(message, vector, message_with_rag_docs, "".join(answer), rag_answer)
+                        await sender.end()
+                    else:
+                        events = RUNTIME.runnable_with_history.astream_events(chain_input, version="v2", config=config)
+                        async with aclosing(events):
+                            async for chunk in events:
+                                if chunk["event"] in ["on_parser_start", "on_parser_stream"]:
+                                    await websocket.send_json(chunk)
+                                if chunk["event"] == "on_parser_stream":
+                                    timer.token()
+                                    answer.append(chunk["data"]["chunk"])
+                                if chunk["event"] == "on_parser_end":
+                                    timer.finish()
+                                    if vector is not None:
+                                        RUNTIME.answer_cache.put(message, vector, message_with_rag_docs, "".join(answer), rag_answer)
+                                    # Конец ответа (без его текста - он уже отправлен по частям)
+                                    await websocket.send_json({"event": "on_parser_end", "name": chunk["name"], "run_id": chunk["run_id"]})
+                        unsaved = False
+                    METRICS.request_seconds.observe(time.perf_counter() - request_start, "websocket")
+                    METRICS.requests.inc("websocket", "ok")
+
+            except CapacityExceeded:
+                METRICS.requests.inc("websocket", "overloaded")
+                await sender.error("overloaded", OVERLOADED_TEXT)
+            except WebSocketDisconnect:
+                if unsaved:
+                    await save_interrupted_answer(
+                        history, message, message_with_rag_docs, answer, timer or GenerationTimer(METRICS), "websocket"
+                    )
+                else:
+                    METRICS.requests.inc("websocket", "disconnected")
+                return
+    except WebSocketDisconnect:
+        pass
+
+async def replay_cached_answer(sender: WebSocketSender, rag_docs: str, answer: str) -> None:
+    """Отправка ответа из кеша теми же кадрами (событиями), что и сгенерированного"""
+    if rag_docs is not None:
+        await sender.context(rag_docs)
+
+    await sender.start()
+    pieces = [answer] if sender.protocol == "delta" else split_for_replay(answer)
+    for piece in pieces:
+        await sender.delta(piece)
+    await sender.end()
 
 # -----------------------------
 # -----------------------------
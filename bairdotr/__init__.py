@@ -1,7 +1,38 @@
-from . import tools
-from . import documents
-from . import llm_wrapper
-from . import ollama_llm
-from . import blanks
-from . import config
-from . import database_management
\ No newline at end of file
+import importlib
+
+# Подмодули импортируются при первом обращении (`bairdotr.tools`, `from bairdotr import tools`),
+# а не при импорте пакета: иначе `import bairdotr` тянет за собой весь стек LangChain, faiss и torch
+__all__ = [
+    "tools",
+    "documents",
+    "llm_wrapper",
+    "ollama_llm",
+    "blanks",
+    "config",
+    "database_management",
+    "token_registry",
+    "cold_history",
+    "session_history",
+    "embedding_cache",
+    "faiss_index",
+    "vector_storage",
+    "store_manifest",
+    "source_index",
+    "executors",
+    "answer_cache",
+    "embedding_worker",
+    "startup",
+    "metrics",
+    "prompt_context",
+    "prompt_layout",
+    "streaming",
+    "scheduler",
+]
+
+def __getattr__(name: str):
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,166 @@
+import numpy as np
+
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, List, Optional
+
+
+@dataclass
+class CachedAnswer:
+    """Сохранённый ответ на вопрос\n
+    - question: исходный вопрос пользователя
+    - rag_prompt: вопрос с найденными чанками (именно он попадает в историю диалога)
+    - answer: ответ модели
+    - rag_docs: чанки в виде текста для показа пользователю (может отсутствовать)
+    """
+    question: str
+    rag_prompt: str
+    answer: str
+    rag_docs: Optional[str] = None
+    created_at: float = 0.0
+
+
+class SemanticAnswerCache():
+    """Семантический кеш ответов на первые вопросы диалога (без истории)\n
+    Вопрос считается повторным, если косинусная близость его эмбеддинга к эмбеддингу
+    сохранённого вопроса не меньше `threshold`. Записи вытесняются по LRU (не больше `max_entries`)
+    и по времени жизни `ttl` (в секундах). Если задан `version_source` - функция, возвращающая
+    версию базы, - кеш целиком сбрасывается при её изменении (проверка не чаще раза в `check_interval` секунд)"""
+    def __init__(
+            self,
+            threshold: float = 0.95,
+            max_entries: int = 2000,
+            ttl: float = 24 * 60 * 60,
+            version_source: Callable[[], Hashable] = None,
+            check_interval: float = 5.0
+    ) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_source = version_source
+        self.check_interval = check_interval
+
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._active = np.zeros(max_entries, dtype = bool)
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+
+        self._version = version_source() if version_source is not None else None
+        self._last_check = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype = np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _clear(self) -> None:
+        self._active[:] = False
+        self._entries.clear()
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def _check_version(self) -> None:
+        """Сброс кеша, если база, по которой получены ответы, изменилась"""
+        if self.version_source is None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        version = self.version_source()
+        if version != self._version:
+            self._version = version
+            if self._entries:
+                self._clear()
+                self.invalidations += 1
+
+    def _evict(self, slot: int) -> None:
+        del self._entries[slot]
+        self._active[slot] = False
+        self._free_slots.append(slot)
+
+    def lookup(self, vector: List[float]) -> Optional[CachedAnswer]:
+        """Ответ на самый близкий сохранённый вопрос, если он достаточно близок и не устарел, иначе None"""
+        query = self._normalize(vector)
+        with self._lock:
+            self._check_version()
+            if not self._entries or self._vectors is None or self._vectors.shape[1] != len(query):
+                self.misses += 1
+                return None
+
+            similarities = self._vectors @ query
+            similarities[~self._active] = -np.inf
+            slot = int(np.argmax(similarities))
+            if similarities[slot] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry = self._entries[slot]
+            if time.time() - entry.created_at > self.ttl:
+                self._evict(slot)
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            return entry
+
+    def put(
+            self,
+            question: str,
+            vector: List[float],
+            rag_prompt: str,
+            answer: str,
+            rag_docs: str = None
+    ) -> None:
+        """Сохранение ответа на вопрос"""
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_version()
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype = np.float32)
+                self._clear()
+
+            if not self._free_slots:
+                self._evict(next(iter(self._entries)))
+            slot = self._free_slots.pop()
+
+            self._vectors[slot] = vector
+            self._active[slot] = True
+            self._entries[slot] = CachedAnswer(
+                question = question,
+                rag_prompt = rag_prompt,
+                answer = answer,
+                rag_docs = rag_docs,
+                created_at = time.time()
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+                "size": len(self._entries)
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
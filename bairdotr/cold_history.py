@@ -0,0 +1,277 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from typing import List, Optional, Tuple
+
+SEGMENT_PREFIX = "history_"
+SEGMENT_SUFFIX = ".csv"
+
+
+def escape_line(line: str) -> str:
+    """Экранирование переноса строки, чтобы сообщение занимало одну строку в файле"""
+    return line.replace("\n", "\\n")
+
+def segment_name(opened_at: int, first_number: int) -> str:
+    """Имя сегмента: время открытия и номер первой записи в нём"""
+    return f"{SEGMENT_PREFIX}{opened_at:010d}_{first_number:012d}{SEGMENT_SUFFIX}"
+
+def parse_segment_name(name: str) -> Optional[Tuple[int, int]]:
+    """(время открытия, номер первой записи) по имени сегмента, None - если это не сегмент"""
+    if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+        return None
+    try:
+        opened_at, first_number = name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)].split("_")
+        return int(opened_at), int(first_number)
+    except ValueError:
+        return None
+
+def read_last_number(path: str, repair: bool = False, tail_size: int = 65536) -> Optional[int]:
+    """Номер последней полной записи в файле истории (формат `номер;токен;время;тип;сообщение`)\n
+    Читается только хвост файла. При `repair = True` недописанная последняя строка
+    (например, после падения процесса во время записи) обрезается"""
+    with open(path, "rb+" if repair else "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return None
+
+        start = max(0, size - tail_size)
+        f.seek(start)
+        tail = f.read()
+
+        if repair and not tail.endswith(b"\n"):
+            last_newline = tail.rfind(b"\n")
+            if last_newline != -1 or start == 0:
+                f.truncate(start + last_newline + 1)
+                tail = tail[:last_newline + 1]
+
+    for line in reversed(tail.split(b"\n")):
+        number = line.split(b";", 1)[0].strip()
+        if number.isdigit():
+            return int(number)
+
+    return None
+
+
+class ColdHistoryWriter():
+    """Запись "холодной" истории в append-only сегменты фоновым потоком\n
+    Номер записи хранится в памяти и выдаётся под блокировкой, поэтому при одновременных
+    запросах номера не повторяются. Сами записи кладутся в очередь и пишутся фоновым потоком
+    пачками: одна запись в файл и один fsync на пачку (group commit). Сегмент закрывается и
+    открывается новый, когда он превышает `segment_max_bytes` или живёт дольше `segment_max_seconds`.
+    Пачка, которую не удалось записать, остаётся в памяти и дописывается повторно раз в `retry_interval`
+    секунд вместе со следующими записями (не больше `max_pending` записей, старые отбрасываются).
+    При старте сканируется хвост последнего сегмента (и старого `history.csv`), чтобы продолжить нумерацию"""
+    def __init__(
+            self,
+            folder: str,
+            legacy_file: str = None,
+            segment_max_bytes: int = 64 * 1024 * 1024,
+            segment_max_seconds: float = 24 * 60 * 60,
+            flush_interval: float = 0.2,
+            max_batch: int = 512,
+            retry_interval: float = 1.0,
+            max_pending: int = 100_000
+    ) -> None:
+        self.folder = folder
+        self.legacy_file = legacy_file
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.retry_interval = retry_interval
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._next_number = 0
+        self._atexit_registered = False
+
+        self._segment = None
+        self._segment_path = None
+        self._segment_opened_at = 0.0
+        self._segment_size = 0
+
+    # ---------- Восстановление ----------
+
+    def list_segments(self) -> List[str]:
+        """Имена сегментов в порядке их создания"""
+        if not os.path.isdir(self.folder):
+            return []
+        names = [name for name in os.listdir(self.folder) if parse_segment_name(name) is not None]
+        return sorted(names, key = parse_segment_name)
+
+    def recover(self) -> int:
+        """Восстановление номера следующей записи по последнему сегменту\n
+        Возвращает номер, с которого продолжится запись"""
+        os.makedirs(self.folder, exist_ok = True)
+        last_number = None
+
+        for name in reversed(self.list_segments()):
+            last_number = read_last_number(os.path.join(self.folder, name), repair = True)
+            if last_number is not None:
+                break
+
+        if last_number is None and self.legacy_file is not None and os.path.isfile(self.legacy_file):
+            last_number = read_last_number(self.legacy_file)
+
+        self._next_number = 0 if last_number is None else last_number + 1
+        return self._next_number
+
+    # ---------- Фоновый поток ----------
+
+    def start(self) -> None:
+        """Восстановление и запуск фонового потока записи (вызывается автоматически при первой записи)"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.recover()
+            self._thread = threading.Thread(target = self._run, name = "cold-history-writer", daemon = True)
+            self._thread.start()
+            # После close() поток можно запустить снова, а обработчик нужен один
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+
+    def _open_segment(self, first_number: int) -> None:
+        if self._segment is not None:
+            self._segment.close()
+
+        opened_at = time.time()
+        path = os.path.join(self.folder, segment_name(int(opened_at), first_number))
+        self._segment = open(path, mode = "a", encoding = "utf-8")
+        self._segment_path = path
+        self._segment_opened_at = opened_at
+        self._segment_size = self._segment.tell()
+
+    def _need_rotation(self) -> bool:
+        return (
+            self._segment is None
+            or self._segment_size >= self.segment_max_bytes
+            or time.time() - self._segment_opened_at >= self.segment_max_seconds
+        )
+
+    def _discard_segment(self) -> None:
+        """Закрытие сегмента после ошибки записи: недописанная часть пачки обрезается,
+        повторная попытка откроет сегмент заново"""
+        try:
+            self._segment.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(self._segment_path, self._segment_size)
+        except OSError:
+            pass
+        self._segment = None
+
+    def _write_batch(self, batch: List[str]) -> None:
+        if self._need_rotation():
+            self._open_segment(int(batch[0].split(";", 1)[0]))
+
+        data = "".join(batch)
+        try:
+            self._segment.write(data)
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+        except Exception:
+            self._discard_segment()
+            raise
+        self._segment_size += len(data.encode("utf-8"))
+
+    def _take_batch(self) -> Tuple[List[str], int, bool]:
+        """Всё, что успело накопиться в очереди (не больше `max_batch` записей)\n
+        Возвращает записи, число взятых из очереди элементов и был ли среди них сигнал остановки"""
+        try:
+            item = self._queue.get(timeout = self.flush_interval)
+        except queue.Empty:
+            return [], 0, False
+
+        batch = []
+        done = 0
+        while True:
+            done += 1
+            if item is None:
+                return batch, done, True
+            batch.append(item)
+            if len(batch) >= self.max_batch:
+                return batch, done, False
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, done, False
+
+    def _run(self) -> None:
+        # Записи, которые ещё не удалось записать, в порядке номеров
+        pending: List[str] = []
+        retry_at = 0.0
+        stop = False
+        while not stop:
+            batch, done, stop = self._take_batch()
+            pending += batch
+
+            try:
+                if pending and (stop or time.monotonic() >= retry_at):
+                    self._write_batch(pending)
+                    pending = []
+            except Exception as e:
+                retry_at = time.monotonic() + self.retry_interval
+                print(f"Cold history write failed, {len(pending)} records kept for retry: {e}")
+                if len(pending) > self.max_pending:
+                    print(f"Cold history dropped {len(pending) - self.max_pending} oldest records")
+                    del pending[:len(pending) - self.max_pending]
+            finally:
+                for _ in range(done):
+                    self._queue.task_done()
+
+        if pending:
+            print(f"Cold history: {len(pending)} records were not written")
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    # ---------- Публичный интерфейс ----------
+
+    def write(
+            self,
+            token: str,
+            question: str,
+            time_question: int,
+            answer: str,
+            time_answer: int = None
+    ) -> Tuple[int, int]:
+        """Постановка в очередь записи вопроса пользователя и ответа модели\n
+        Возвращает номера, присвоенные вопросу и ответу"""
+        if self._thread is None:
+            self.start()
+
+        if time_answer is None:
+            time_answer = round(time.time())
+
+        question = escape_line(question)
+        answer = escape_line(answer)
+
+        with self._lock:
+            number = self._next_number
+            self._next_number += 2
+            self._queue.put(f"{number};{token};{time_question};human;{question}\n")
+            self._queue.put(f"{number + 1};{token};{time_answer};ai;{answer}\n")
+
+        return number, number + 1
+
+    def flush(self) -> None:
+        """Ожидание, пока фоновый поток обработает все записи из очереди: они записаны на диск
+        или, если запись не удалась, ждут повторной попытки"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        """Дописать очередь и остановить фоновый поток"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            if thread is None:
+                return
+            self._queue.put(None)
+        thread.join()
@@ -1,8 +1,52 @@
+import os
+
 # LLM модель
 LLM_MODEL = "gemma2"
+## Адрес Ollama можно переопределить переменной окружения (например, для заглушки benchmarks/ollama_stub.py)
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://ollama-container:11434")
+## Пул HTTP-соединений к Ollama (общий для всех запросов процесса) и таймауты в секундах
+OLLAMA_MAX_CONNECTIONS = 32
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = 16
+OLLAMA_KEEPALIVE_EXPIRY = 120.0
+OLLAMA_CONNECT_TIMEOUT = 5.0
+OLLAMA_READ_TIMEOUT = 300.0 # генерация длинного ответа может идти несколько минут
+## Сколько Ollama держит модель в памяти после запроса (-1 - не выгружать, "5m" - пять минут)
+OLLAMA_KEEP_ALIVE = -1
+## Планировщик вызовов модели (bairdotr/scheduler.py): все вызовы Ollama из процесса идут через него.
+## Одновременных вызовов - столько же, сколько запросов Ollama обрабатывает параллельно (её OLLAMA_NUM_PARALLEL)
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+## Классы приоритета вызовов (меньше - раньше): ответ пользователю, модификация вопроса (MultipleCall),
+## фоновые задачи (прогрев и т.п.). Внутри класса очередь делится поровну между клиентами (токенами)
+LLM_PRIORITIES = {"generation": 0, "augmentation": 1, "background": 2}
+## Сколько вызовов может ждать слота и сколько секунд. Вызов, который не дождётся слота
+## (по оценке очереди - сразу при постановке), получает отказ с Retry-After
+LLM_MAX_QUEUED = 64
+LLM_QUEUE_DEADLINE = 20.0
+
+# Запуск API
+## Загружать модели и базу в фоне после открытия порта (пока загрузка идёт, /readyz отвечает 503)
+BACKGROUND_STARTUP = True
+## Прогрев после загрузки: пробный запрос к базе (эмбеддинг + поиск) и к Ollama (один токен)
+WARMUP_ON_STARTUP = True
+WARMUP_QUESTION = "Что такое производная функции?"
 
 # Длина контекста истории
 N_HISTORY = 12
+## Раскладка промпта:
+## "prefix_cache" - системный промпт и прошлые ходы (вопросы без найденных чанков и ответы) образуют
+## неизменный от хода к ходу префикс, который Ollama берёт из KV-кеша; чанки есть только в текущем вопросе,
+## история ограничена HISTORY_TOKEN_BUDGET токенами.
+## "legacy" - вопрос с чанками остаётся в истории, история обрезается по N_HISTORY сообщений
+PROMPT_LAYOUT = "prefix_cache"
+## При превышении бюджета старые ходы (вопрос + ответ) отбрасываются сразу по HISTORY_DROP_TURNS,
+## чтобы начало промпта (и кеш Ollama) менялось не на каждом ходе
+HISTORY_TOKEN_BUDGET = 3072
+HISTORY_DROP_TURNS = 4
+## num_ctx запроса: длина промпта + ANSWER_TOKEN_RESERVE, вверх до степени двойки в пределах [MIN, MAX].
+## Смена num_ctx перезагружает модель в Ollama, поэтому в процессе он только растёт
+OLLAMA_NUM_CTX_MIN = 4096
+OLLAMA_NUM_CTX_MAX = 8192
+ANSWER_TOKEN_RESERVE = 1024
 
 # Модель эмбеддингов
 EMBEDDINGS_NAME = "intfloat/multilingual-e5-large-instruct"
@@ -11,6 +55,37 @@ EMBEDDINGS_NAME = "intfloat/multilingual-e5-large-instruct"
 K_DOCUMENTS_FOR_RAG = 3
 NEED_RAG_ALWAYS = True
 PATH_TO_VECTOR_STORE = "data/mirea_faiss_index"
+## Формат сохранения базы: "mmap" (без pickle, индекс открывается через mmap) или "pickle" (FAISS.save_local)
+VECTOR_STORE_FORMAT = "mmap"
+## Кеш эмбеддингов запросов: размер в памяти и дисковый уровень (None - без диска)
+QUERY_CACHE_SIZE = 10000
+QUERY_CACHE_DISK_PATH = "data/clients/query_embeddings_cache"
+QUERY_CACHE_DISK_CAPACITY = 50000
+## Микробатчинг эмбеддингов запросов: запросы от одновременных пользователей собираются в один батч,
+## пока он не наберёт EMBEDDING_MAX_BATCH_SIZE запросов или не пройдёт EMBEDDING_MAX_WAIT секунд с первого из них
+EMBEDDING_BATCHING = True
+EMBEDDING_MAX_BATCH_SIZE = 32
+EMBEDDING_MAX_WAIT = 0.005
+## Семантический кеш ответов на первые вопросы диалога: порог косинусной близости вопросов,
+## размер, время жизни записи (в секундах) и как часто проверять, не пересобрана ли база
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_SIZE = 2000
+ANSWER_CACHE_TTL = 24 * 60 * 60
+ANSWER_CACHE_CHECK_INTERVAL = 5.0
+## Тип faiss-индекса при сборке базы: "flat", "ivf_flat", "ivf_pq" или "hnsw"
+FAISS_INDEX_TYPE = "flat"
+FAISS_NLIST = 1024
+FAISS_PQ_M = 64
+FAISS_PQ_NBITS = 8
+FAISS_HNSW_M = 32
+FAISS_EF_CONSTRUCTION = 200
+## Параметры поиска (None - использовать сохранённые вместе с индексом)
+FAISS_NPROBE = None
+FAISS_EF_SEARCH = None
+## Поиск по части документов (sources): если у выбранных файлов не больше стольких чанков,
+## их векторы сравниваются с запросом напрямую (точно), иначе индекс ищет только по ним через IDSelector
+FILTERED_EXACT_SEARCH_MAX = 20000
 ## RAG - дополнительные шаги модифицирования вопроса пользователя
 ENABLE_EXTRA_STEPS = False # Мастер-рубильник доп. шагов
 ENABLE_CONTEXT_PARAPHRASE = True
@@ -18,20 +93,83 @@ ENABLE_PARAPHRASE = True
 ENABNLE_HYDE = True
 ENABLE_STEPBACK = True
 K_DOCUMENTS_FOR_EXTRA_STEPS = 5
+## Сборка промпта из найденных чанков: бюджет на отрывки документов (в токенах модели),
+## токенизатор модели с huggingface и число символов на токен для оценки, если токенизатор недоступен.
+## Репозиторий google/gemma-2-9b-it закрытый: нужен токен huggingface (переменная окружения HF_TOKEN)
+## с принятой лицензией Gemma. Без него токены только оцениваются - об этом пишется при запуске и в /readyz.
+## Переменной окружения PROMPT_TOKENIZER_NAME можно указать локальную папку или копию токенизатора
+RAG_CONTEXT_TOKEN_BUDGET = 1024
+PROMPT_TOKENIZER_NAME = os.environ.get("PROMPT_TOKENIZER_NAME", "google/gemma-2-9b-it")
+PROMPT_CHARS_PER_TOKEN = 3.5
+## Склейка и дедупликация отрывков: минимальное перекрытие соседних чанков (в символах)
+## и доля общих триграмм слов, начиная с которой отрывок считается почти дубликатом
+PROMPT_MIN_OVERLAP = 20
+PROMPT_NEAR_DUPLICATE = 0.8
+## Если в бюджете осталось хотя бы столько токенов, следующий отрывок обрезается, а не отбрасывается
+PROMPT_MIN_PASSAGE_TOKENS = 48
 
 # Переменные для web-интерфейса
 RUN_NAME = "Bairdotr"
 PATH_TO_NEW_HOT_HISTORY = "data/clients/new_hot_history/"
+NEW_HOT_HISTORY_DB_NAME = "history.sqlite3"
+## Потоки для поиска по базе (эмбеддинг вопроса и faiss), None - по числу ядер
+RETRIEVAL_WORKERS = None
+## Ограничение нагрузки на один процесс API: сколько запросов к модели обрабатывается одновременно,
+## сколько может ждать в очереди и сколько секунд (остальные получают отказ)
+MAX_CONCURRENT_REQUESTS = 8
+MAX_QUEUED_REQUESTS = 32
+REQUEST_QUEUE_TIMEOUT = 30.0
+## Потоковая выдача ответа по умолчанию (клиент может выбрать формат параметром запроса ?protocol=...):
+## "delta" - токены из chain.astream склеиваются в куски (в /ws/chat/ - кадры {"type", "delta"});
+## "events" - по токену из событий astream_events v2 (в /ws/chat/ - прежний формат событий on_parser_*).
+## Для /stream_chat/ формат ответа один и тот же (текст с END_OF_STREAM), отличается только размер кусков.
+STREAM_PROTOCOL = "delta"
+## У /ws/chat/ по умолчанию остаётся прежний формат событий: у существующих клиентов не меняется протокол.
+## Компактные кадры - /ws/chat/?protocol=delta
+WEBSOCKET_PROTOCOL = "events"
+## Кадр уходит, когда с первого токена в нём прошло STREAM_FLUSH_INTERVAL секунд
+## или набралось STREAM_FLUSH_BYTES байт (первый токен ответа отправляется сразу)
+STREAM_FLUSH_INTERVAL = 0.05
+STREAM_FLUSH_BYTES = 512
+## Как часто во время генерации проверяется, не отключился ли клиент /stream_chat/ (секунды).
+## При отключении генерация в Ollama прерывается, а в историю пишется начало ответа с пометкой
+STREAM_DISCONNECT_POLL = 0.25
+INTERRUPTED_ANSWER_MARKER = "[ответ прерван: клиент отключился]"
 
 # Пути к базе данных по истории сообщений и пользователей
 DATA_FOLDER = "data/clients"
 CSV_TOKENS_NAME = "tokens.csv"
 HISTORY_FILE_NAME = "history.csv"
 HOT_HISTORY = "hot_history"
+# "Холодная" история пишется сегментами в папку DATA_FOLDER/COLD_HISTORY_FOLDER
+COLD_HISTORY_FOLDER = "history"
+COLD_HISTORY_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+COLD_HISTORY_SEGMENT_MAX_SECONDS = 24 * 60 * 60
+COLD_HISTORY_FLUSH_INTERVAL = 0.2
+COLD_HISTORY_MAX_BATCH = 512
+# Записи, которые не удалось записать (нет места, ошибка диска), остаются в памяти и пишутся
+# повторно не чаще раза в COLD_HISTORY_RETRY_INTERVAL секунд. Сверх COLD_HISTORY_MAX_PENDING
+# записей отбрасываются самые старые
+COLD_HISTORY_RETRY_INTERVAL = 1.0
+COLD_HISTORY_MAX_PENDING = 100_000
+# "Горячая" история (v1) хранится в SQLite-файле в DATA_FOLDER
+HOT_HISTORY_DB_NAME = "hot_history.sqlite3"
+# Сколько последних сессий держать в памяти
+SESSION_HISTORY_CACHE_SIZE = 1024
+# Как часто (в секундах) проверять, не изменился ли файл токенов извне
+TOKEN_REGISTRY_CHECK_INTERVAL = 1.0
 
 # Vector Store
 RAW_DOCS = "data/docs/raw"
 PREPARED = "data/docs/cleaned_and_prepared"
 JUST_CLEANED = "data/docs/just_cleaned"
 CHUNK_SIZE_FOR_RECURSIVE = 600
-CHUNK_OVERLAP = 80
\ No newline at end of file
+CHUNK_OVERLAP = 80
+## Потоковая загрузка документов: размер читаемого блока (в символах) и пачка чанков на один вызов эмбеддингов
+INGEST_BLOCK_SIZE = 1024 * 1024
+INGEST_EMBED_BATCH_SIZE = 256
+## Разбор сырых документов: число процессов (None - по числу ядер), сколько файлов
+## обрабатывает один процесс до перезапуска (ограничивает рост памяти) и файл чекпоинта
+PARSE_WORKERS = None
+PARSE_MAX_TASKS_PER_CHILD = 4
+PARSE_CHECKPOINT_FILE = "data/docs/parsed_docs.jsonl"
@@ -1,20 +1,37 @@
 from langchain.schema import HumanMessage, SystemMessage, AIMessage
-from langchain_community.chat_message_histories.file import FileChatMessageHistory
+from langchain_core.messages import messages_from_dict
 
 from bairdotr.config import (
     DATA_FOLDER, 
     HISTORY_FILE_NAME, 
     CSV_TOKENS_NAME, 
     HOT_HISTORY,
-    PATH_TO_NEW_HOT_HISTORY
+    PATH_TO_NEW_HOT_HISTORY,
+    TOKEN_REGISTRY_CHECK_INTERVAL,
+    COLD_HISTORY_FOLDER,
+    COLD_HISTORY_SEGMENT_MAX_BYTES,
+    COLD_HISTORY_SEGMENT_MAX_SECONDS,
+    COLD_HISTORY_FLUSH_INTERVAL,
+    COLD_HISTORY_MAX_BATCH,
+    COLD_HISTORY_RETRY_INTERVAL,
+    COLD_HISTORY_MAX_PENDING,
+    HOT_HISTORY_DB_NAME,
+    NEW_HOT_HISTORY_DB_NAME,
+    SESSION_HISTORY_CACHE_SIZE
 )
+from bairdotr.token_registry import TokenRegistry
+from bairdotr.cold_history import ColdHistoryWriter
+from bairdotr.session_history import SessionHistoryStore, StoredChatMessageHistory
+from bairdotr.metrics import get_pipeline_metrics
 
 import secrets
+import asyncio
+import json
 import pandas as pd
 import time
 import os
 import re
-from typing import Literal
+from typing import Literal, Union
 
 def read_n_to_last_line(filename: str, n: int = 1) -> str:
     """Returns the nth before last line of a file (n=1 gives last line)"""
@@ -43,21 +60,29 @@ def decode_str(line: str, mode: Literal["to_file", "from_file"]) -> str:
 
     return line
 
-def write_to_cold_history(token: str, question: str, time_question: int, answer: str) -> None:
-    """Запись в "холодную" историю сообщения пользователя и ответа модели"""
-    filename = DATA_FOLDER + "/" + HISTORY_FILE_NAME
-
-    question = decode_str(question, mode = "to_file")
-    answer = decode_str(answer, mode = "to_file")
+_COLD_HISTORY_WRITERS = {}
+
+def get_cold_history_writer() -> ColdHistoryWriter:
+    """Фоновый писатель "холодной" истории (создаётся один раз на процесс)"""
+    folder = DATA_FOLDER + "/" + COLD_HISTORY_FOLDER
+    writer = _COLD_HISTORY_WRITERS.get(folder)
+    if writer is None:
+        writer = _COLD_HISTORY_WRITERS.setdefault(folder, ColdHistoryWriter(
+            folder = folder,
+            legacy_file = DATA_FOLDER + "/" + HISTORY_FILE_NAME,
+            segment_max_bytes = COLD_HISTORY_SEGMENT_MAX_BYTES,
+            segment_max_seconds = COLD_HISTORY_SEGMENT_MAX_SECONDS,
+            flush_interval = COLD_HISTORY_FLUSH_INTERVAL,
+            max_batch = COLD_HISTORY_MAX_BATCH,
+            retry_interval = COLD_HISTORY_RETRY_INTERVAL,
+            max_pending = COLD_HISTORY_MAX_PENDING
+        ))
+    return writer
 
-    time_answer = round(time.time())
-    number = int(read_n_to_last_line(filename).split(";")[0])
-
-    with open(filename, mode = "a+") as f:
-        f.write(
-            "\n" + str(number) + ";" + str(token) + ";" + str(time_question) + ";human;" + question + 
-            "\n" + str(number + 1) + ";" + str(token) + ";" + str(time_answer) + ";ai;" + answer
-        )
+def write_to_cold_history(token: str, question: str, time_question: int, answer: str) -> None:
+    """Запись в "холодную" историю сообщения пользователя и ответа модели\n
+    Запись ставится в очередь и дописывается в сегменты фоновым потоком"""
+    get_cold_history_writer().write(token, question, time_question, answer)
 
 def raw_history_to_langchain_history(content: list[str]):
     """Перевод сырых данных из "горячей" истории в сообщения Langchain"""
@@ -85,46 +110,87 @@ def get_path_to_hot_history(token: str) -> str:
     """Путь до хранения горячей истории"""
     return DATA_FOLDER + "/" + HOT_HISTORY + "/" + token + ".txt"
 
-def read_hot_history(token: str):
-    """Восстановление истории сообщений из "горячей" истории"""
+def read_legacy_hot_history(token: str) -> Union[list, None]:
+    """Чтение "горячей" истории из старого текстового файла (для переноса в хранилище)"""
     path = get_path_to_hot_history(token)
     if os.path.isfile(path):
         with open(path, "r") as file:
             content = file.readlines()
             content = [line[:-1] for line in content]
-            history = raw_history_to_langchain_history(content)
-
-            if history == []:
-                return None
-            else:
-                return history
+            return raw_history_to_langchain_history(content)
     else:
         return None
 
+_HISTORY_STORES = {}
+
+def get_history_store(db_path: str, legacy_loader = None) -> SessionHistoryStore:
+    """Хранилище истории диалогов по указанному пути (создаётся один раз на процесс)"""
+    store = _HISTORY_STORES.get(db_path)
+    if store is None:
+        store = _HISTORY_STORES.setdefault(db_path, SessionHistoryStore(
+            db_path = db_path,
+            cache_size = SESSION_HISTORY_CACHE_SIZE,
+            legacy_loader = legacy_loader
+        ))
+    return store
+
+def get_hot_history_store() -> SessionHistoryStore:
+    """Хранилище "горячей" истории (v1)"""
+    return get_history_store(DATA_FOLDER + "/" + HOT_HISTORY_DB_NAME, read_legacy_hot_history)
+
+def read_hot_history(token: str):
+    """Восстановление истории сообщений из "горячей" истории"""
+    history = get_hot_history_store().get(token)
+
+    if history == []:
+        return None
+    else:
+        return history
+
 def write_hot_history(token: str, history: list) -> None:
-    """Запись "начисто" новой полной последней актуальной истории диалога с пользователем в "горячую" историю"""
-    path = get_path_to_hot_history(token)
+    """Запись новой полной последней актуальной истории диалога с пользователем в "горячую" историю\n
+    На диск пишутся только изменения относительно сохранённой истории"""
+    get_hot_history_store().sync(token, history)
+
+async def aread_hot_history(token: str):
+    """Асинхронный вариант `read_hot_history` (чтение в пуле потоков, event loop не блокируется)"""
+    return await asyncio.to_thread(read_hot_history, token)
+
+async def awrite_hot_history(token: str, history: list) -> None:
+    """Асинхронный вариант `write_hot_history`"""
+    await asyncio.to_thread(write_hot_history, token, history)
 
-    with open(path, "w+") as file:
-        for h in history:
-            msg_type = h.type
-            msg = h.content
-            msg = decode_str(msg, mode = "to_file")
+def clear_hot_history(token: str) -> None:
+    """Удаление "горячей" истории диалога"""
+    get_hot_history_store().clear(token)
 
-            file.writelines([msg_type, "\n", msg, "\n"])
+    path = get_path_to_hot_history(token)
+    if os.path.isfile(path):
+        os.remove(path)
 
 def generate_hex() -> str:
     """Генерация нового токена"""
     return secrets.token_hex(16)
 
+_TOKEN_REGISTRIES = {}
+
+def get_token_registry() -> TokenRegistry:
+    """Реестр токенов для текущего пути к БД токенов (создаётся один раз на процесс)"""
+    path = DATA_FOLDER + "/" + CSV_TOKENS_NAME
+    registry = _TOKEN_REGISTRIES.get(path)
+    if registry is None:
+        registry = _TOKEN_REGISTRIES.setdefault(
+            path, TokenRegistry(path, check_interval = TOKEN_REGISTRY_CHECK_INTERVAL)
+        )
+    return registry
+
 def make_token(user_id: str) -> str:
     """Создание токена и запись его в конец файла"""
-    token = generate_hex()
-
-    with open(DATA_FOLDER + "/" + CSV_TOKENS_NAME, mode = "a+") as f:
-        f.write("\n" + user_id + ";" + token)
+    return get_token_registry().add(user_id, generate_hex())
 
-    return token
+def get_or_make_token(user_id: str) -> str:
+    """Получение существующего токена пользователя или создание нового при отсутствии записи"""
+    return get_token_registry().get_or_create(user_id)
 
 def read_data_token() -> pd.DataFrame:
     """Чтение БД токенов"""
@@ -135,20 +201,23 @@ def read_data_token() -> pd.DataFrame:
 
 def check_token(token: str) -> bool:
     """Проверка наличия токена в БД"""
-    data = read_data_token()
-    true_token = False
-
-    for user in data["token"]:
-        if user == token:
-            true_token = True
-            break
-
-    return true_token
+    with get_pipeline_metrics().stage("token_check"):
+        return get_token_registry().check(token)
 
 # -------------------------------
 # Database v2 via langchain tools
 # -------------------------------
 
-def get_session_history_with_local_file(session_id) -> FileChatMessageHistory:
+def read_legacy_session_history(session_id) -> Union[list, None]:
+    """Чтение истории из старого json-файла FileChatMessageHistory (для переноса в хранилище)"""
     fpath = PATH_TO_NEW_HOT_HISTORY + f"{session_id}.txt"
-    return FileChatMessageHistory(file_path = fpath, encoding = "utf-8", ensure_ascii = False)
+    if os.path.isfile(fpath):
+        with open(fpath, encoding = "utf-8") as f:
+            return messages_from_dict(json.load(f))
+    else:
+        return None
+
+def get_session_history_with_local_file(session_id) -> StoredChatMessageHistory:
+    """История сессии для RunnableWithMessageHistory. Хранится в SQLite-файле в PATH_TO_NEW_HOT_HISTORY"""
+    store = get_history_store(PATH_TO_NEW_HOT_HISTORY + NEW_HOT_HISTORY_DB_NAME, read_legacy_session_history)
+    return StoredChatMessageHistory(store, session_id)
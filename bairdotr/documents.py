@@ -6,10 +6,40 @@ from langchain_community.vectorstores import FAISS
 from langchain_core.embeddings import Embeddings
 from uuid import uuid4
 from langchain_community.docstore.in_memory import InMemoryDocstore
-from typing import List, Literal, Union
+from typing import Iterable, Iterator, List, Literal, Tuple, Union
+from itertools import islice
+import numpy as np
 import re
 
-from bairdotr.config import CHUNK_SIZE_FOR_RECURSIVE, CHUNK_OVERLAP
+from bairdotr.config import (
+    CHUNK_SIZE_FOR_RECURSIVE,
+    CHUNK_OVERLAP,
+    VECTOR_STORE_FORMAT,
+    INGEST_BLOCK_SIZE,
+    INGEST_EMBED_BATCH_SIZE,
+    FILTERED_EXACT_SEARCH_MAX
+)
+from bairdotr.embedding_cache import QueryEmbeddingCache
+from bairdotr.faiss_index import (
+    IndexParams,
+    build_index,
+    train_index,
+    apply_search_params,
+    extract_ivf,
+    make_search_parameters
+)
+from bairdotr.store_manifest import StoreManifest, file_hash
+from bairdotr.source_index import SourceIndex
+from bairdotr.metrics import get_pipeline_metrics
+from bairdotr.vector_storage import (
+    STORAGE_META_FILE,
+    ChunkStore,
+    PositionIdMap,
+    is_mmap_store,
+    read_index,
+    write_mmap_store
+)
+import os
 
 def get_standard_splitter() -> CharacterTextSplitter:
     """Возвращает стандартный CharacterTextSplitter (для подготовленных по структуре заранее документов) со следующими характеристиками:\n
@@ -37,6 +67,25 @@ def get_recursive_splitter() -> RecursiveCharacterTextSplitter:
 
     return text_splitter
 
+# Правила очистки текста (см. preprocess_re), паттерны компилируются один раз
+CLEAN_DELETE_RE = re.compile(r"[^а-яёА-Я-Z0-9.,\n \-:!;?\[\]\(\)]+")
+CLEAN_SPACES_RE = re.compile(r"\n[ \n]*| [ \n]+")
+CLEAN_HYPHEN_RE = re.compile(r"(?<=[а-я])- (?=[а-я])")
+# Символы, через которые могут тянуться совпадения правил очистки: по ним блоки не режутся
+CLEAN_UNSAFE_CHARS = " \n-"
+
+def get_splitter(splitter_type: Union[None, Literal["standard", "recursive"], TextSplitter] = None) -> TextSplitter:
+    """Разделитель по его типу (None - "recursive"), либо сам переданный разделитель"""
+    match splitter_type:
+        case "recursive" | None:
+            return get_recursive_splitter()
+
+        case "standard":
+            return get_standard_splitter()
+
+        case _:
+            return splitter_type
+
 def load_and_split_file(
         path_to_file: str, 
         source_name: str, 
@@ -58,51 +107,105 @@ def load_and_split_file(
     По умолчанию (значение None) - устанавливаться тип "recursive" 
     
     `need_to_cut_out_questions`: если из текста нужно автоматически вырезать блоки с вопросами (актуально для учебников) - установить в значние True.
-    По умолчанию - False"""
-    if splitter_type is None:
-        splitter_type = "recursive"
-    
-    match splitter_type:
-        case "recursive":
-            splitter = get_recursive_splitter()
-        
-        case "standard":
-            splitter = get_standard_splitter()
-        
-        case _:
-            splitter = splitter_type
+    По умолчанию - False
+
+    Для больших файлов лучше использовать `iter_split_file` - он не держит в памяти весь документ"""
+    return list(iter_split_file(
+        path_to_file = path_to_file,
+        source_name = source_name,
+        splitter_type = splitter_type,
+        need_to_cut_out_questions = need_to_cut_out_questions
+    ))
+
+def iter_split_file(
+        path_to_file: str,
+        source_name: str,
+        splitter_type: Union[None, Literal["standard", "recursive"], TextSplitter] = None,
+        need_to_cut_out_questions: bool = False,
+        block_size: int = INGEST_BLOCK_SIZE
+) -> Iterator[Document]:
+    """То же, что `load_and_split_file`, но файл читается блоками по `block_size` символов,
+    а чанки отдаются по одному по мере готовности. Память - порядка одного блока, а не всего файла"""
+    splitter = get_splitter(splitter_type)
 
     with open(path_to_file, encoding="utf8") as f:
-        document_original = f.read()
-    
-    if splitter_type != "standard":
-        document_original = preprocess_re(document_original)
+        blocks = iter(lambda: f.read(block_size), "")
+        if splitter_type != "standard":
+            blocks = iter_clean_blocks(blocks)
 
-    document_split = splitter.create_documents(
-        texts = [document_original],
-        metadatas = [{"source": source_name}]
-    )
+        for chunk in iter_split_text(blocks, splitter):
+            if need_to_cut_out_questions and "?" in chunk:
+                continue
+            yield Document(page_content = chunk, metadata = {"source": source_name, "id": str(uuid4())})
 
-    for doc in document_split:
-        doc.metadata["id"] = str(uuid4())
+def iter_clean_blocks(blocks: Iterable[str]) -> Iterator[str]:
+    """Очистка текста, идущего блоками. Хвост блока, на который может прийтись склейка
+    переноса или пробелов, переносится в следующий блок, поэтому результат тот же, что у `preprocess_re` на всём тексте"""
+    carry = ""
+    for block in blocks:
+        text = carry + CLEAN_DELETE_RE.sub("", block)
+        cut = find_safe_cut(text)
+        carry = text[cut:]
+        if cut > 0:
+            yield clean_spaces_and_hyphens(text[:cut])
 
-    if need_to_cut_out_questions:
-        document_split = [
-            i for i in document_split if "?" not in i.page_content
-        ]
+    if carry:
+        yield clean_spaces_and_hyphens(carry)
 
-    return document_split
+def find_safe_cut(text: str) -> int:
+    """Последняя позиция, по обе стороны которой стоят символы не из CLEAN_UNSAFE_CHARS (0, если такой нет)"""
+    for position in range(len(text) - 1, 0, -1):
+        if text[position] not in CLEAN_UNSAFE_CHARS and text[position - 1] not in CLEAN_UNSAFE_CHARS:
+            return position
+    return 0
 
-def preprocess_re(text: str) -> str:
-    """Очистка текста в документе от всякого мусора"""
-    cleaned_text = re.sub(r"[^а-яёА-Я-Z0-9.,\n \-:!;?\[\]\(\)]", "", text)
-    cleaned_text = re.sub(r"[`*~{}=<>##§]", " ", cleaned_text)
-    cleaned_text = re.sub(r"\/\/\.\.", " ", cleaned_text)
-    cleaned_text = re.sub(r"([а-я])-\s+([а-я])", r"\1\2", cleaned_text)
-    cleaned_text = re.sub(r"\n", " ", cleaned_text)
-    cleaned_text = re.sub(r"\s+ ", " ", cleaned_text)
+def iter_split_text(blocks: Iterable[str], splitter: TextSplitter) -> Iterator[str]:
+    """Деление текста, идущего блоками, на чанки\n
+    Делится только часть буфера до последней группы пробельных символов (чтобы не разрезать разделитель).
+    Последний чанк может зависеть от продолжения текста, поэтому он не отдаётся, а буфер
+    продолжается с его начала: так перекрытие с предыдущим чанком сохраняется как при делении всего текста"""
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        cut = find_last_space_run(buffer)
+        chunks = splitter.split_text(buffer[:cut]) if cut > 0 else []
+        if len(chunks) < 2:
+            continue
+
+        start = buffer.rfind(chunks[-1], 0, cut)
+        if start <= 0:
+            # Чанк не является подстрокой буфера (разделитель склеил части) - копим дальше
+            continue
+        # Пробелы перед чанком (срезанные strip) - часть его первого куска, их длина влияет на границы следующих чанков.
+        # Переносы строк не захватываются: в "standard" они - разделитель, в очищенном тексте их нет
+        while start > 0 and buffer[start - 1] in " \t":
+            start -= 1
+
+        yield from chunks[:-1]
+        buffer = buffer[start:]
+
+    if buffer:
+        yield from splitter.split_text(buffer)
+
+def find_last_space_run(text: str) -> int:
+    """Начало последней группы пробельных символов, перед которой есть текст (0, если такой нет)"""
+    position = len(text) - 1
+    while position > 0 and not text[position].isspace():
+        position -= 1
+    while position > 0 and text[position - 1].isspace():
+        position -= 1
+    return position
+
+def clean_spaces_and_hyphens(text: str) -> str:
+    text = CLEAN_SPACES_RE.sub(" ", text)
+    return CLEAN_HYPHEN_RE.sub("", text)
 
-    return cleaned_text
+def preprocess_re(text: str) -> str:
+    """Очистка текста в документе от всякого мусора:
+    - удаляются все символы, кроме русских букв, цифр и знаков препинания
+    - склеиваются слова, разорванные переносом ("сло- во")
+    - переносы строк и повторные пробелы заменяются одним пробелом"""
+    return clean_spaces_and_hyphens(CLEAN_DELETE_RE.sub("", text))
 
 
 class FaissStoreHandler():
@@ -111,41 +214,450 @@ class FaissStoreHandler():
             self, 
             embeddings: Embeddings, 
             need_load: bool = False, 
-            load_path: str = None
+            load_path: str = None,
+            query_cache: QueryEmbeddingCache = None,
+            index_params: IndexParams = None,
+            use_mmap: bool = True
     ) -> None:
+        """`query_cache`: кеш эмбеддингов запросов. Если указан, при попадании в кеш
+        поиск идёт сразу по индексу без прогона модели эмбеддингов
+
+        `index_params`: тип и параметры нового индекса (по умолчанию - плоский индекс).
+        При загрузке используются параметры, сохранённые рядом с индексом
+
+        `use_mmap`: для хранилищ в mmap-формате - открыть индекс через mmap, а чанки читать
+        лениво только для найденных позиций (хранилище открывается только для чтения).
+        При False всё читается в память и хранилище можно изменять"""
+        self.embeddings = embeddings
+        self.query_cache = query_cache
+        self.read_only = False
+
+        # Векторы, ожидающие обучения индекса (для IVF)
+        self._pending_texts = []
+        self._pending_vectors = []
+        self._pending_metadatas = []
+        self._pending_ids = []
+
+        # Исходные файлы базы и id их чанков (для инкрементальной пересборки)
+        self.manifest = StoreManifest()
+        # Позиции векторов по исходным файлам (для поиска по части документов).
+        # Если рядом с базой его нет, строится по чанкам при первом обращении
+        self._source_index = SourceIndex()
+
         if need_load and load_path is not None:
-            self.vector_store_faiss = FAISS.load_local(
-                folder_path = load_path,
-                embeddings = embeddings,
-                allow_dangerous_deserialization = True
-            )
+            self.index_params = IndexParams.load(load_path) or IndexParams()
+            self.manifest = StoreManifest.load(load_path) or StoreManifest()
+            self._source_index = SourceIndex.load(load_path)
+            if is_mmap_store(load_path):
+                self._load_mmap_store(load_path, use_mmap)
+            else:
+                self.vector_store_faiss = FAISS.load_local(
+                    folder_path = load_path,
+                    embeddings = embeddings,
+                    allow_dangerous_deserialization = True
+                )
+            apply_search_params(self.index, self.index_params)
             print("Faiss vector store loaded")
         else:
+            self.index_params = index_params or IndexParams()
             self.vector_store_faiss = FAISS(
                 embedding_function = embeddings,
-                index = faiss.IndexFlatL2(len(embeddings.embed_query("Генрих Герц"))),
+                index = build_index(len(embeddings.embed_query("Генрих Герц")), self.index_params),
                 docstore = InMemoryDocstore(),
                 index_to_docstore_id = {},
             )
-            print("Blank faiss vector store created")
-    
-    def add_documents(self, split_documents: List[Document]) -> None:
-        """Добавление документов, на входе должен быть уже разделённый на чанки документ"""
+            print(f"Blank faiss vector store created ({self.index_params.index_type})")
+
+    def _load_mmap_store(self, load_path: str, use_mmap: bool) -> None:
+        """Загрузка хранилища в mmap-формате (без pickle)"""
+        chunk_store = ChunkStore(load_path)
+        index = read_index(load_path, self.index_params.index_type, use_mmap = use_mmap)
+        if index.ntotal != chunk_store.count:
+            raise ValueError(f"Index has {index.ntotal} vectors, chunk store has {chunk_store.count} records")
+
+        if use_mmap:
+            docstore = chunk_store
+            index_to_docstore_id = PositionIdMap(chunk_store)
+            self.read_only = True
+        else:
+            docstore = InMemoryDocstore()
+            index_to_docstore_id = {}
+            for position, doc in chunk_store.documents():
+                if doc is not None:
+                    docstore.add({doc.id: doc})
+                    index_to_docstore_id[position] = doc.id
+
+        self.vector_store_faiss = FAISS(
+            embedding_function = self.embeddings,
+            index = index,
+            docstore = docstore,
+            index_to_docstore_id = index_to_docstore_id,
+        )
+
+    @property
+    def index(self) -> faiss.Index:
+        return self.vector_store_faiss.index
+
+    @property
+    def source_index(self) -> SourceIndex:
+        if self._source_index is None:
+            self._source_index = SourceIndex.build(
+                (position, doc.metadata.get("source"))
+                for position, doc in ((i, self.get_document(i)) for i in range(self.index.ntotal))
+                if doc is not None
+            )
+        return self._source_index
+
+    def get_document(self, position: int) -> Union[Document, None]:
+        """Чанк по позиции вектора в индексе (None, если позиция удалена)"""
+        docstore_id = self.vector_store_faiss.index_to_docstore_id.get(position)
+        if docstore_id is None:
+            return None
+
+        doc = self.vector_store_faiss.docstore.search(docstore_id)
+        if not isinstance(doc, Document):
+            return None
+        if doc.id is None and not self.read_only:
+            doc = doc.model_copy(update = {"id": docstore_id})
+        return doc
+
+    @property
+    def n_deleted(self) -> int:
+        """Число удалённых, но ещё не вычищенных из индекса векторов"""
+        return self.index.ntotal - len(self.vector_store_faiss.index_to_docstore_id)
+
+    def add_documents(self, split_documents: List[Document]) -> List[str]:
+        """Добавление документов, на входе должен быть уже разделённый на чанки документ\n
+        Возвращает id добавленных чанков"""
         uuids = [str(uuid4()) for _ in range(len(split_documents))]
-        self.vector_store_faiss.add_documents(documents = split_documents, ids = uuids)
+        texts = [doc.page_content for doc in split_documents]
+        metadatas = [doc.metadata for doc in split_documents]
+
+        self.add_embeddings(texts, self.embeddings.embed_documents(texts), metadatas, uuids)
         print("Document added to faiss vector store")
-    
-    def similarity_search(self, query: str, k: int) -> List[Document]:
-        """Поиск чанков, наиболее релевантных запросу. k - количество документов"""
-        results = self.vector_store_faiss.similarity_search(
-            query = query,
-            k = k
+        return uuids
+
+    def add_document_stream(self, documents: Iterable[Document], batch_size: int = INGEST_EMBED_BATCH_SIZE) -> List[str]:
+        """Добавление чанков, идущих потоком (например, из `iter_split_file`): эмбеддинги считаются
+        пачками по `batch_size`, так что весь документ в памяти не держится\n
+        Возвращает id добавленных чанков"""
+        documents = iter(documents)
+        ids = []
+        while batch := list(islice(documents, batch_size)):
+            uuids = [str(uuid4()) for _ in range(len(batch))]
+            texts = [doc.page_content for doc in batch]
+            metadatas = [doc.metadata for doc in batch]
+
+            self.add_embeddings(texts, self.embeddings.embed_documents(texts), metadatas, uuids)
+            ids.extend(uuids)
+
+        print("Document added to faiss vector store")
+        return ids
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise ValueError("Vector store is opened read-only via mmap, load it with use_mmap = False to modify it")
+
+    def delete_ids(self, ids: List[str]) -> int:
+        """Удаление чанков по id. Векторы остаются в индексе до `compact`, но в поиск не попадают\n
+        Возвращает число удалённых чанков"""
+        self._check_writable()
+        ids = set(ids)
+        source_index = self.source_index
+
+        # Векторы, ещё не добавленные в необученный индекс, просто выкидываем
+        if self._pending_ids:
+            keep = [i for i, id_ in enumerate(self._pending_ids) if id_ not in ids]
+            self._pending_texts = [self._pending_texts[i] for i in keep]
+            self._pending_vectors = [self._pending_vectors[i] for i in keep]
+            self._pending_metadatas = [self._pending_metadatas[i] for i in keep]
+            self._pending_ids = [self._pending_ids[i] for i in keep]
+
+        index_to_docstore_id = self.vector_store_faiss.index_to_docstore_id
+        positions = [position for position, id_ in index_to_docstore_id.items() if id_ in ids]
+        deleted = [index_to_docstore_id.pop(position) for position in positions]
+        if deleted:
+            self.vector_store_faiss.docstore.delete(deleted)
+            source_index.remove_positions(positions)
+
+        return len(deleted)
+
+    def delete_source(self, source: str) -> int:
+        """Удаление всех чанков исходного файла (по манифесту). Возвращает число удалённых чанков"""
+        deleted = self.delete_ids(self.manifest.get_ids(source))
+        self.manifest.remove(source)
+        return deleted
+
+    def compact(self) -> int:
+        """Вычищение удалённых векторов из индекса: живые векторы перекладываются
+        в новый индекс с теми же параметрами (для IVF - без переобучения), позиции перенумеровываются.
+        Для IVF-PQ векторы восстанавливаются из PQ-кодов, т.е. приближённо\n
+        Возвращает число вычищенных векторов"""
+        self._check_writable()
+        removed = self.n_deleted
+        if removed == 0:
+            return 0
+
+        old_index = self.index
+        source_index = self.source_index
+        items = sorted(self.vector_store_faiss.index_to_docstore_id.items())
+        positions = np.array([position for position, _ in items], dtype = np.int64)
+
+        ivf = extract_ivf(old_index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        vectors = old_index.reconstruct_batch(positions) if len(positions) else None
+        if ivf is not None:
+            ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+
+        new_index = faiss.clone_index(old_index)
+        new_index.reset()
+        apply_search_params(new_index, self.index_params)
+        if vectors is not None:
+            new_index.add(vectors)
+
+        self.vector_store_faiss.index = new_index
+        self.vector_store_faiss.index_to_docstore_id = {new: id_ for new, (_, id_) in enumerate(items)}
+        source_index.remap({old: new for new, (old, _) in enumerate(items)})
+        print(f"Faiss vector store compacted: {removed} deleted vectors removed")
+        return removed
+
+    def upsert_file(
+            self,
+            path_to_file: str,
+            source_name: str,
+            splitter: Literal["standard", "recursive"] = "recursive",
+            need_to_cut_out_questions: bool = False
+    ) -> bool:
+        """Добавление файла в базу, только если его там нет или он изменился
+        (старые чанки изменённого файла удаляются). Возвращает True, если файл был (пере)добавлен"""
+        content_hash = file_hash(path_to_file)
+        if self.manifest.is_current(source_name, content_hash, splitter):
+            return False
+
+        if source_name in self.manifest:
+            self.delete_source(source_name)
+
+        ids = self.add_and_save_raw_files(
+            path_to_file = path_to_file,
+            source_name = source_name,
+            splitter = splitter,
+            need_to_cut_out_questions = need_to_cut_out_questions
         )
+        self.manifest.set(source_name, content_hash, splitter, ids)
+        return True
+
+    def add_embeddings(
+            self, 
+            texts: List[str], 
+            vectors: List[List[float]], 
+            metadatas: List[dict], 
+            ids: List[str]
+    ) -> None:
+        """Добавление уже посчитанных эмбеддингов. Если индекс требует обучения (IVF),
+        векторы копятся, пока их не хватит для обучения (или до сохранения/поиска)"""
+        self._check_writable()
+
+        if self.index.is_trained:
+            self._add_to_index(texts, vectors, metadatas, ids)
+            return
+
+        self._pending_texts.extend(texts)
+        self._pending_vectors.extend(vectors)
+        self._pending_metadatas.extend(metadatas)
+        self._pending_ids.extend(ids)
+
+        if len(self._pending_ids) >= self.index_params.min_train_points():
+            self.train_pending()
+
+    def _add_to_index(
+            self, 
+            texts: List[str], 
+            vectors: List[List[float]], 
+            metadatas: List[dict], 
+            ids: List[str]
+    ) -> None:
+        vectors = np.asarray(vectors, dtype = np.float32)
+        if self.vector_store_faiss._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        # Индекс файлов строится (если его ещё нет) до добавления, чтобы не учесть новые позиции дважды
+        source_index = self.source_index
+        start = self.index.ntotal
+        self.index.add(vectors)
+
+        self.vector_store_faiss.docstore.add({
+            id_: Document(id = id_, page_content = text, metadata = metadata)
+            for id_, text, metadata in zip(ids, texts, metadatas)
+        })
+        self.vector_store_faiss.index_to_docstore_id.update({start + j: id_ for j, id_ in enumerate(ids)})
+
+        by_source = {}
+        for j, metadata in enumerate(metadatas):
+            by_source.setdefault((metadata or {}).get("source"), []).append(start + j)
+        for source, positions in by_source.items():
+            source_index.add(source, positions)
+
+    def train_pending(self) -> None:
+        """Обучение индекса на накопленных векторах и их добавление в индекс"""
+        if not self._pending_ids or self.index.is_trained:
+            return
+
+        vectors = np.asarray(self._pending_vectors, dtype = np.float32)
+        if self.vector_store_faiss._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        index, params = train_index(vectors.shape[1], self.index_params, vectors)
+        self.vector_store_faiss.index = index
+        self.index_params = params
+        print(f"Faiss {params.index_type} index trained on {len(vectors)} vectors (nlist = {params.nlist})")
+
+        self._add_to_index(self._pending_texts, self._pending_vectors, self._pending_metadatas, self._pending_ids)
+        self._pending_texts, self._pending_vectors, self._pending_metadatas, self._pending_ids = [], [], [], []
+
+    def set_search_params(self, nprobe: int = None, ef_search: int = None) -> None:
+        """Изменение параметров поиска по умолчанию (nprobe для IVF, efSearch для HNSW)"""
+        if nprobe is not None:
+            self.index_params.nprobe = nprobe
+        if ef_search is not None:
+            self.index_params.ef_search = ef_search
+        apply_search_params(self.index, self.index_params)
+
+    def embed_query(self, query: str) -> List[float]:
+        """Эмбеддинг запроса (с учётом кеша, если он подключён)"""
+        with get_pipeline_metrics().stage("query_embedding"):
+            if self.query_cache is None:
+                return self.embeddings.embed_query(query)
+
+            embedding = self.query_cache.get(query)
+            if embedding is None:
+                embedding = self.embeddings.embed_query(query)
+                self.query_cache.put(query, embedding)
+            return embedding
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Эмбеддинги нескольких запросов: найденные в кеше берутся из него,
+        остальные считаются одним батчем за один прогон модели"""
+        embeddings = [None] * len(queries)
+        missing = []
+
+        for i, query in enumerate(queries):
+            if self.query_cache is not None:
+                embeddings[i] = self.query_cache.get(query)
+            if embeddings[i] is None:
+                missing.append(i)
+
+        if missing:
+            with get_pipeline_metrics().stage("query_embedding_batch"):
+                computed = self.embeddings.embed_documents([queries[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+                if self.query_cache is not None:
+                    self.query_cache.put(queries[i], embedding)
+
+        return embeddings
+
+    def search_by_vectors(
+            self, 
+            vectors: List[List[float]], 
+            k: int,
+            nprobe: int = None,
+            ef_search: int = None,
+            sources: List[str] = None
+    ) -> List[List[Tuple[Document, float]]]:
+        """Поиск по уже посчитанным эмбеддингам запросов, один вызов `index.search` на все запросы\n
+        `nprobe`, `ef_search` - переопределение параметров поиска только для этого вызова\n
+        `sources` - искать только среди чанков этих исходных файлов (metadata["source"])"""
+        self.train_pending()
+
+        vectors = np.asarray(vectors, dtype = np.float32)
+        if self.vector_store_faiss._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        if sources is not None:
+            scores, indices = self._filtered_search(vectors, k, sources, nprobe, ef_search)
+        else:
+            # Удалённые позиции отбрасываются после поиска, поэтому берём с запасом
+            k_search = min(k + self.n_deleted, max(self.index.ntotal, 1))
+
+            params = make_search_parameters(self.index, nprobe = nprobe, ef_search = ef_search)
+            with get_pipeline_metrics().stage("faiss_search"):
+                scores, indices = self.index.search(vectors, k_search, params = params)
+
+        results = []
+        for row_scores, row_indices in zip(scores, indices):
+            found = []
+            for score, i in zip(row_scores, row_indices):
+                if i == -1:
+                    continue
+                doc = self.get_document(int(i))
+                if doc is not None:
+                    found.append((doc, float(score)))
+            results.append(found[:k])
+
         return results
+
+    def _filtered_search(
+            self,
+            vectors: np.ndarray,
+            k: int,
+            sources: List[str],
+            nprobe: int = None,
+            ef_search: int = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Поиск только по позициям чанков файлов `sources`. Индекс сам пропускает остальные
+        векторы (IDSelector), так что k лучших не теряются, как при отбрасывании чужих чанков после поиска.
+        Небольшой набор позиций у не-IVF индекса сравнивается с запросами напрямую: это точно
+        и быстрее, а HNSW с очень узким фильтром может не дойти до нужных векторов по графу"""
+        positions = self.source_index.positions(sources)
+        if len(positions) == 0:
+            return np.empty((len(vectors), 0), dtype = np.float32), np.empty((len(vectors), 0), dtype = np.int64)
+
+        # Удалённые позиции убираются из индекса файлов сразу, поэтому запас не нужен
+        k_search = min(k, len(positions))
+
+        with get_pipeline_metrics().stage("faiss_search"):
+            if extract_ivf(self.index) is None and len(positions) <= FILTERED_EXACT_SEARCH_MAX:
+                scores, found = faiss.knn(
+                    vectors, self.index.reconstruct_batch(positions), k_search, metric = self.index.metric_type
+                )
+                return scores, np.where(found >= 0, positions[np.maximum(found, 0)], -1)
+
+            selector = faiss.IDSelectorBatch(positions)
+            params = make_search_parameters(self.index, nprobe = nprobe, ef_search = ef_search, selector = selector)
+            return self.index.search(vectors, k_search, params = params)
+
+    def similarity_search_batch(self, queries: List[str], k: int, **search_kwargs) -> List[List[Tuple[Document, float]]]:
+        """Поиск чанков сразу для нескольких запросов: один батч эмбеддингов и один поиск по индексу\n
+        Для каждого запроса возвращает список пар (чанк, расстояние) - чем меньше, тем релевантнее"""
+        if not queries:
+            return []
+        return self.search_by_vectors(self.embed_queries(queries), k, **search_kwargs)
+
+    def similarity_search(self, query: str, k: int, **search_kwargs) -> List[Document]:
+        """Поиск чанков, наиболее релевантных запросу. k - количество документов"""
+        results = self.search_by_vectors([self.embed_query(query)], k, **search_kwargs)[0]
+        return [doc for doc, _ in results]
     
-    def save(self, path: str) -> None:
-        """Сохранение Faiss vector store по указанному пути"""
-        self.vector_store_faiss.save_local(path)
+    def save(self, path: str, storage_format: Literal["mmap", "pickle"] = None) -> None:
+        """Сохранение Faiss vector store (и параметров индекса) по указанному пути\n
+        `storage_format`: "mmap" - формат без pickle для быстрой загрузки через mmap,
+        "pickle" - стандартный формат langchain. По умолчанию - VECTOR_STORE_FORMAT из config"""
+        self.train_pending()
+
+        if storage_format is None:
+            storage_format = VECTOR_STORE_FORMAT
+
+        if storage_format == "mmap":
+            write_mmap_store(path, self.index, (self.get_document(i) for i in range(self.index.ntotal)))
+        else:
+            self.vector_store_faiss.save_local(path)
+            if is_mmap_store(path):
+                os.remove(os.path.join(path, STORAGE_META_FILE))
+
+        self.index_params.save(path)
+        self.manifest.save(path)
+        self.source_index.save(path)
         print(f"Faiss vector store saved in {path}")
     
     def add_and_save_raw_files(
@@ -155,20 +667,23 @@ class FaissStoreHandler():
             splitter: Union[None, Literal["standard", "recursive"], TextSplitter] = None,
             need_to_cut_out_questions: bool = False,
             path_to_new_file: Union[None, Literal["same"], str] = None
-    ) -> None:
-        """Добавление файлов (с возможным последующим сохранением) в Faiss vector store"""
-        docs = load_and_split_file(
+    ) -> List[str]:
+        """Добавление файлов (с возможным последующим сохранением) в Faiss vector store\n
+        Возвращает id добавленных чанков"""
+        docs = iter_split_file(
             path_to_file = path_to_file,
             source_name = source_name,
             splitter_type = splitter,
             need_to_cut_out_questions = need_to_cut_out_questions
         )
 
-        self.add_documents(docs)
+        ids = self.add_document_stream(docs)
 
         if path_to_new_file is not None:
             if path_to_new_file == "same":
                 self.save(path_to_file)
             
             else:
-                self.save(path_to_new_file)
\ No newline at end of file
+                self.save(path_to_new_file)
+
+        return ids
\ No newline at end of file
@@ -0,0 +1,208 @@
+import numpy as np
+
+import os
+import json
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+def normalize_query(text: str) -> str:
+    """Нормализация текста запроса для ключа кеша: Unicode NFC и схлопывание пробельных символов"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class DiskEmbeddingTier():
+    """Дисковый уровень кеша эмбеддингов: векторы лежат в memory-mapped файле фиксированного размера\n
+    Слоты выделяются по кругу (самые старые записи перезаписываются). Соответствие ключ -> слот
+    дописывается в журнал `keys.log` и восстанавливается при старте, поэтому кеш переживает перезапуск"""
+    def __init__(self, path: str, model_name: str, capacity: int = 50000) -> None:
+        self.path = path
+        self.model_name = model_name
+        self.capacity = capacity
+
+        self._vectors: Optional[np.memmap] = None
+        self._slot_keys: List[Optional[str]] = [None] * capacity
+        self._index: Dict[str, int] = {}
+        self._next_slot = 0
+        self._log = None
+        self._log_lines = 0
+        self.dim = None
+
+        os.makedirs(path, exist_ok = True)
+        self._open_existing()
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.path, "vectors.f32")
+
+    @property
+    def _log_path(self) -> str:
+        return os.path.join(self.path, "keys.log")
+
+    def _open_existing(self) -> None:
+        if not os.path.isfile(self._meta_path):
+            return
+
+        with open(self._meta_path, encoding = "utf-8") as f:
+            meta = json.load(f)
+
+        # Кеш другой модели или другого размера использовать нельзя
+        if meta.get("model_name") != self.model_name or meta.get("capacity") != self.capacity:
+            return
+
+        self.dim = meta["dim"]
+        self._vectors = np.memmap(self._vectors_path, dtype = np.float32, mode = "r+", shape = (self.capacity, self.dim))
+
+        if os.path.isfile(self._log_path):
+            with open(self._log_path, encoding = "utf-8") as f:
+                for line in f:
+                    key, _, slot = line.strip().partition(" ")
+                    if not slot.isdigit() or int(slot) >= self.capacity:
+                        continue
+                    self._assign(key, int(slot))
+                    self._next_slot = (int(slot) + 1) % self.capacity
+                    self._log_lines += 1
+
+    def _create(self, dim: int) -> None:
+        self.dim = dim
+        self._vectors = np.memmap(self._vectors_path, dtype = np.float32, mode = "w+", shape = (self.capacity, dim))
+        if os.path.isfile(self._log_path):
+            os.remove(self._log_path)
+
+        with open(self._meta_path, "w", encoding = "utf-8") as f:
+            json.dump({"model_name": self.model_name, "capacity": self.capacity, "dim": dim}, f)
+
+    def _assign(self, key: str, slot: int) -> None:
+        old_key = self._slot_keys[slot]
+        if old_key is not None:
+            self._index.pop(old_key, None)
+        self._slot_keys[slot] = key
+        self._index[key] = slot
+
+    def _compact_log(self) -> None:
+        """Перезапись журнала ключей только актуальными записями (в порядке слотов записи)"""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+        tmp_path = self._log_path + ".tmp"
+        order = [(self._next_slot + i) % self.capacity for i in range(self.capacity)]
+        with open(tmp_path, "w", encoding = "utf-8") as f:
+            for slot in order:
+                key = self._slot_keys[slot]
+                if key is not None:
+                    f.write(f"{key} {slot}\n")
+        os.replace(tmp_path, self._log_path)
+        self._log_lines = len(self._index)
+
+    def get(self, key: str) -> Optional[List[float]]:
+        slot = self._index.get(key)
+        if slot is None:
+            return None
+        return self._vectors[slot].tolist()
+
+    def put(self, key: str, vector: List[float]) -> None:
+        if key in self._index:
+            return
+        if self._vectors is None:
+            self._create(len(vector))
+        if len(vector) != self.dim:
+            return
+
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.capacity
+        self._vectors[slot] = np.asarray(vector, dtype = np.float32)
+        self._assign(key, slot)
+
+        if self._log_lines >= 2 * self.capacity:
+            self._compact_log()
+        if self._log is None:
+            self._log = open(self._log_path, "a", encoding = "utf-8")
+        self._log.write(f"{key} {slot}\n")
+        self._log.flush()
+        self._log_lines += 1
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class QueryEmbeddingCache():
+    """Кеш эмбеддингов запросов с LRU-вытеснением в памяти и необязательным дисковым уровнем\n
+    Ключ - хэш от имени модели эмбеддингов и нормализованного текста запроса"""
+    def __init__(
+            self,
+            model_name: str,
+            max_entries: int = 10000,
+            disk_path: str = None,
+            disk_capacity: int = 50000
+    ) -> None:
+        self.model_name = model_name
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._disk = DiskEmbeddingTier(disk_path, model_name, disk_capacity) if disk_path else None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(
+            (self.model_name + "\0" + normalize_query(text)).encode("utf-8")
+        ).hexdigest()
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last = False)
+
+    def get(self, text: str) -> Optional[List[float]]:
+        """Эмбеддинг запроса из кеша или None"""
+        key = self.key(text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            if self._disk is not None:
+                vector = self._disk.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, vector: List[float]) -> None:
+        """Сохранение эмбеддинга запроса в кеш"""
+        key = self.key(text)
+        with self._lock:
+            self._remember(key, vector)
+            if self._disk is not None:
+                self._disk.put(key, vector)
+
+    def stats(self) -> dict:
+        """Счётчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "memory_size": len(self._memory),
+                "disk_size": len(self._disk) if self._disk is not None else 0
+            }
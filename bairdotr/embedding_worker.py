@@ -0,0 +1,91 @@
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import List, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+
+class BatchingEmbeddings(Embeddings):
+    """Обёртка над моделью эмбеддингов, объединяющая запросы одновременных пользователей в батчи\n
+    `embed_query` не считает эмбеддинг сам, а ставит текст в очередь фонового потока. Поток ждёт
+    первый запрос, затем добирает очередь до `max_batch_size` запросов, но не дольше `max_wait` секунд,
+    прогоняет батч через `embed_documents` модели за один проход и раздаёт результаты.
+    `embed_documents` (загрузка документов, уже идущая батчами) передаётся модели напрямую"""
+    def __init__(self, embeddings: Embeddings, max_batch_size: int = 32, max_wait: float = 0.005) -> None:
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self.requests = 0
+        self.batches = 0
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._worker, name = "embedding-batcher", daemon = True)
+                self._thread.start()
+
+    def _collect_batch(self) -> List[Tuple[str, Future]]:
+        """Первый запрос ожидается без ограничения по времени, остальные - до дедлайна"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout = timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            # Запросы, от которых уже отказались, не считаются
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                vectors = self.embeddings.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def submit(self, text: str) -> Future:
+        """Поставить запрос в очередь, результат - в возвращаемом Future"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.submit(text).result()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self) -> dict:
+        """Число посчитанных запросов, батчей и средний размер батча"""
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0
+        }
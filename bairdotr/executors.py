@@ -0,0 +1,85 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable
+
+from bairdotr.config import RETRIEVAL_WORKERS, MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS, REQUEST_QUEUE_TIMEOUT
+
+_RETRIEVAL_EXECUTORS = {}
+
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    """Пул потоков для поиска по базе (создаётся один раз на процесс)\n
+    Эмбеддинг и faiss отпускают GIL на время вычислений, поэтому потоков столько же, сколько ядер.
+    Отдельный пул нужен, чтобы долгий поиск не занимал общий пул asyncio, в котором идёт работа с историей"""
+    workers = RETRIEVAL_WORKERS or os.cpu_count() or 1
+    executor = _RETRIEVAL_EXECUTORS.get(workers)
+    if executor is None:
+        executor = _RETRIEVAL_EXECUTORS.setdefault(
+            workers, ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "retrieval")
+        )
+    return executor
+
+async def run_retrieval(func: Callable, *args, **kwargs) -> Any:
+    """Выполнение `func` в пуле поиска, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_retrieval_executor(), functools.partial(func, *args, **kwargs))
+
+
+class CapacityExceeded(Exception):
+    """Запрос отклонён: все слоты заняты, а очередь переполнена или ожидание слишком долгое"""
+
+
+class RequestLimiter():
+    """Ограничение числа одновременно обрабатываемых запросов в пределах одного event loop\n
+    - max_concurrent: сколько запросов обрабатывается одновременно
+    - max_queued: сколько запросов может ждать свободного слота (остальные сразу получают отказ)
+    - queue_timeout: сколько секунд запрос может ждать слота
+    """
+    def __init__(
+            self,
+            max_concurrent: int = MAX_CONCURRENT_REQUESTS,
+            max_queued: int = MAX_QUEUED_REQUESTS,
+            queue_timeout: float = REQUEST_QUEUE_TIMEOUT
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+
+    async def acquire(self) -> None:
+        """Занять слот. Бросает `CapacityExceeded`, если занять его не удалось"""
+        if not self._semaphore.locked():
+            # Свободный слот занимается сразу, без переключения задач
+            await self._semaphore.acquire()
+            self.active += 1
+            return
+
+        if self.waiting >= self.max_queued:
+            raise CapacityExceeded(f"{self.active} requests in progress, {self.waiting} in queue")
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise CapacityExceeded(f"No free slot in {self.queue_timeout} seconds") from None
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        """Слот на время блока `async with`"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
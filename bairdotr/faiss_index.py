@@ -0,0 +1,179 @@
+import faiss
+import numpy as np
+
+import os
+import json
+from dataclasses import dataclass, asdict, fields, replace
+from typing import Literal, Optional, Tuple
+
+from bairdotr.config import (
+    FAISS_INDEX_TYPE,
+    FAISS_NLIST,
+    FAISS_PQ_M,
+    FAISS_PQ_NBITS,
+    FAISS_HNSW_M,
+    FAISS_EF_CONSTRUCTION,
+    FAISS_NPROBE,
+    FAISS_EF_SEARCH
+)
+
+INDEX_PARAMS_FILE = "index_params.json"
+
+# Рекомендация faiss: не меньше 39 точек обучения на один кластер k-means
+POINTS_PER_CENTROID = 39
+
+
+@dataclass
+class IndexParams:
+    """Параметры faiss-индекса. Сохраняются рядом с индексом в `index_params.json`\n
+    - index_type: "flat" (точный перебор), "ivf_flat", "ivf_pq" или "hnsw"
+    - nlist: число кластеров IVF (при малом корпусе уменьшается при обучении)
+    - nprobe: сколько кластеров IVF просматривать при поиске
+    - pq_m, pq_nbits: число подвекторов и бит на подвектор для PQ-сжатия
+    - hnsw_m, ef_construction: число связей вершины и ширина поиска при построении HNSW
+    - ef_search: ширина поиска HNSW при запросе
+    """
+    index_type: Literal["flat", "ivf_flat", "ivf_pq", "hnsw"] = "flat"
+    nlist: int = 1024
+    nprobe: int = 16
+    pq_m: int = 64
+    pq_nbits: int = 8
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+
+    @property
+    def is_ivf(self) -> bool:
+        return self.index_type in ("ivf_flat", "ivf_pq")
+
+    def min_train_points(self) -> int:
+        """Сколько векторов нужно накопить, чтобы обучить индекс с заданным nlist"""
+        if not self.is_ivf:
+            return 0
+        points = self.nlist * POINTS_PER_CENTROID
+        if self.index_type == "ivf_pq":
+            points = max(points, (2 ** self.pq_nbits) * POINTS_PER_CENTROID)
+        return points
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "IndexParams":
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok = True)
+        with open(os.path.join(folder, INDEX_PARAMS_FILE), "w", encoding = "utf-8") as f:
+            json.dump(self.to_dict(), f, indent = 2)
+
+    @classmethod
+    def load(cls, folder: str) -> Optional["IndexParams"]:
+        """Параметры, сохранённые рядом с индексом, или None (старые хранилища - плоский индекс)"""
+        path = os.path.join(folder, INDEX_PARAMS_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path, encoding = "utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def get_index_params_from_config() -> IndexParams:
+    """Параметры нового индекса согласно config"""
+    params = IndexParams(
+        index_type = FAISS_INDEX_TYPE,
+        nlist = FAISS_NLIST,
+        pq_m = FAISS_PQ_M,
+        pq_nbits = FAISS_PQ_NBITS,
+        hnsw_m = FAISS_HNSW_M,
+        ef_construction = FAISS_EF_CONSTRUCTION
+    )
+    if FAISS_NPROBE is not None:
+        params.nprobe = FAISS_NPROBE
+    if FAISS_EF_SEARCH is not None:
+        params.ef_search = FAISS_EF_SEARCH
+    return params
+
+def build_index(dim: int, params: IndexParams) -> faiss.Index:
+    """Создание пустого faiss-индекса (L2) по параметрам"""
+    match params.index_type:
+        case "flat":
+            index = faiss.IndexFlatL2(dim)
+
+        case "ivf_flat":
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, params.nlist, faiss.METRIC_L2)
+
+        case "ivf_pq":
+            if dim % params.pq_m != 0:
+                raise ValueError(f"pq_m = {params.pq_m} must divide the embedding dimension {dim}")
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, params.nlist, params.pq_m, params.pq_nbits)
+
+        case "hnsw":
+            index = faiss.IndexHNSWFlat(dim, params.hnsw_m)
+            index.hnsw.efConstruction = params.ef_construction
+
+        case _:
+            raise ValueError(f"Unknown faiss index type: {params.index_type}")
+
+    apply_search_params(index, params)
+    return index
+
+def fit_params_to_corpus(params: IndexParams, n_train: int) -> IndexParams:
+    """Подгонка nlist под размер обучающей выборки, если векторов меньше, чем нужно"""
+    if not params.is_ivf or n_train >= params.min_train_points():
+        return params
+
+    if params.index_type == "ivf_pq" and n_train < 2 ** params.pq_nbits:
+        raise ValueError(
+            f"ivf_pq with pq_nbits = {params.pq_nbits} needs at least {2 ** params.pq_nbits} vectors "
+            f"to train, got {n_train}. Use 'ivf_flat' or 'flat' for such a small corpus"
+        )
+
+    nlist = max(1, min(params.nlist, n_train // POINTS_PER_CENTROID))
+    return replace(params, nlist = nlist, nprobe = min(params.nprobe, nlist))
+
+def train_index(dim: int, params: IndexParams, vectors: np.ndarray) -> Tuple[faiss.Index, IndexParams]:
+    """Создание и обучение индекса на векторах корпуса\n
+    Возвращает обученный (пустой) индекс и фактически использованные параметры"""
+    params = fit_params_to_corpus(params, len(vectors))
+    index = build_index(dim, params)
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(vectors, dtype = np.float32))
+    return index, params
+
+def apply_search_params(index: faiss.Index, params: IndexParams) -> None:
+    """Установка параметров поиска по умолчанию (nprobe для IVF, efSearch для HNSW)"""
+    ivf = extract_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = params.nprobe
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = params.ef_search
+
+def extract_ivf(index: faiss.Index):
+    """IVF-часть индекса или None, если индекс не IVF"""
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+def make_search_parameters(
+        index: faiss.Index,
+        nprobe: int = None,
+        ef_search: int = None,
+        selector: faiss.IDSelector = None
+) -> Optional[faiss.SearchParameters]:
+    """Параметры для одного вызова `index.search` (без изменения настроек индекса)\n
+    `selector` - поиск только по выбранным позициям (IDSelector). Пока параметры используются,
+    на selector должна оставаться ссылка\n
+    Возвращает None, если переопределять нечего"""
+    ivf = extract_ivf(index)
+    if ivf is not None and (nprobe is not None or selector is not None):
+        # Не заданный явно nprobe берётся из индекса, иначе faiss подставит значение по умолчанию (1)
+        return faiss.SearchParametersIVF(nprobe = nprobe if nprobe is not None else ivf.nprobe, sel = selector)
+    if hasattr(index, "hnsw") and (ef_search is not None or selector is not None):
+        return faiss.SearchParametersHNSW(efSearch = ef_search if ef_search is not None else index.hnsw.efSearch, sel = selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel = selector)
+    return None
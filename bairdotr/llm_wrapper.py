@@ -1,12 +1,18 @@
-from langchain.schema import HumanMessage
-from bairdotr.tools import question_with_RAG #, AllToolsHandler
+from langchain.schema import HumanMessage, AIMessage
+from bairdotr.tools import question_with_RAG, aquestion_with_RAG #, AllToolsHandler
 from bairdotr.blanks import get_standard_start_message, get_stardard_system_message
-from bairdotr.config import N_HISTORY, RUN_NAME
+from bairdotr.config import N_HISTORY, RUN_NAME, PROMPT_LAYOUT, INTERRUPTED_ANSWER_MARKER
 from bairdotr.documents import FaissStoreHandler
-from typing import Tuple
+from bairdotr.answer_cache import SemanticAnswerCache, CachedAnswer
+from bairdotr.executors import run_retrieval
+from bairdotr.metrics import GenerationTimer, get_pipeline_metrics
+from bairdotr.prompt_layout import window_history, make_request_kwargs
+from typing import List, Tuple, Union
+import re
 
 from bairdotr.database_management import get_session_history_with_local_file
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.output_parsers import StrOutputParser
 
@@ -48,32 +54,139 @@ def get_model_answer_rag(
         human_message: str, 
         model, 
         vector_store: FaissStoreHandler,
-        history: list = None
+        history: list = None,
+        answer_cache: SemanticAnswerCache = None,
+        sources: List[str] = None,
+        layout: str = PROMPT_LAYOUT
     ) -> Tuple[str, list]:
     """Получить ответ модели  с обязательным вызовом RAG\n
     Модель должна быть БЕЗ возможности вызывать tools\n
+    Если передан `answer_cache`, ответ на первый вопрос диалога (history = None) берётся из него
+    при наличии похожего вопроса, а новый ответ сохраняется в него\n
+    `sources` - искать чанки только в этих исходных файлах. Такие ответы кешем не используются:
+    он хранит ответы, найденные по всей базе\n
+    `layout` - раскладка промпта (см. PROMPT_LAYOUT и `make_prompt_messages`)\n
     Возвращает ответ модели и историю запросов"""
-    q_rag = question_with_RAG(
+    use_cache = answer_cache is not None and history is None and sources is None
+    if use_cache:
+        vector = vector_store.embed_query(human_message)
+        cached = answer_cache.lookup(vector)
+        if cached is not None:
+            return cached.answer, make_history_from_cache(cached, layout)
+
+    q_rag, rag_docs = question_with_RAG(
         question = human_message, 
         vector_store = vector_store,
         model = model,
-        history = history
+        history = history,
+        need_to_rag_docs_return = True,
+        sources = sources
     )
 
-    h_message = HumanMessage(content = q_rag)
-    if history is None:
-        s_message = get_stardard_system_message()
-        start_message = get_standard_start_message()
-        history = [s_message, start_message, h_message]
-    else:
-        history.append(h_message)
+    messages, history = make_prompt_messages(human_message, q_rag, history, layout)
 
-    answer = model.invoke(history)
+    timer = GenerationTimer(get_pipeline_metrics())
+    answer = model.invoke(messages, **make_request_kwargs(model, messages))
+    timer.finish_from_metadata(answer.response_metadata)
     
     history.append(answer)
+
+    if use_cache:
+        answer_cache.put(human_message, vector, q_rag, answer.content, rag_docs)
     
     return answer.content, history
 
+async def aget_model_answer_rag(
+        human_message: str, 
+        model, 
+        vector_store: FaissStoreHandler,
+        history: list = None,
+        answer_cache: SemanticAnswerCache = None,
+        sources: List[str] = None,
+        layout: str = PROMPT_LAYOUT
+    ) -> Tuple[str, list]:
+    """Асинхронный вариант `get_model_answer_rag`: не блокирует event loop
+    ни на поиске по базе, ни на генерации ответа"""
+    use_cache = answer_cache is not None and history is None and sources is None
+    if use_cache:
+        vector, cached = await alookup_answer_cache(human_message, vector_store, answer_cache)
+        if cached is not None:
+            return cached.answer, make_history_from_cache(cached, layout)
+
+    q_rag, rag_docs = await aquestion_with_RAG(
+        question = human_message, 
+        vector_store = vector_store,
+        model = model,
+        history = history,
+        need_to_rag_docs_return = True,
+        sources = sources
+    )
+
+    messages, history = make_prompt_messages(human_message, q_rag, history, layout)
+
+    timer = GenerationTimer(get_pipeline_metrics())
+    answer = await model.ainvoke(messages, **make_request_kwargs(model, messages))
+    timer.finish_from_metadata(answer.response_metadata)
+    
+    history.append(answer)
+
+    if use_cache:
+        answer_cache.put(human_message, vector, q_rag, answer.content, rag_docs)
+    
+    return answer.content, history
+
+async def alookup_answer_cache(
+        human_message: str,
+        vector_store: FaissStoreHandler,
+        answer_cache: SemanticAnswerCache
+    ) -> Tuple[List[float], Union[CachedAnswer, None]]:
+    """Поиск ответа на похожий вопрос в кеше. Эмбеддинг вопроса считается в пуле потоков поиска
+    и попадает в кеш эмбеддингов базы, поэтому при промахе поиск чанков его не пересчитывает\n
+    Возвращает эмбеддинг вопроса (нужен для `answer_cache.put`) и найденный ответ или None"""
+    vector = await run_retrieval(vector_store.embed_query, human_message)
+    return vector, answer_cache.lookup(vector)
+
+def make_prompt_messages(
+        human_message: str,
+        q_rag: str,
+        history: Union[list, None],
+        layout: str = PROMPT_LAYOUT
+    ) -> Tuple[list, list]:
+    """Сообщения для модели и история, которая сохраняется после ответа (ответ в неё добавляется отдельно)\n
+    - "prefix_cache": история - окно по HISTORY_TOKEN_BUDGET с голыми вопросами, вопрос с чанками
+      есть только в сообщениях текущего вызова
+    - "legacy": вопрос с чанками добавляется в историю, она же отправляется модели"""
+    if history is None:
+        history = [get_stardard_system_message(), get_standard_start_message()]
+
+    if layout == "prefix_cache":
+        history = window_history(history)
+        return history + [HumanMessage(content = q_rag)], history + [HumanMessage(content = human_message)]
+
+    history.append(HumanMessage(content = q_rag))
+    return history, history
+
+def make_cached_turn(cached: CachedAnswer, layout: str = PROMPT_LAYOUT) -> list:
+    """Вопрос и ответ из кеша в том виде, в каком они сохранились бы в истории после генерации"""
+    question = cached.question if layout == "prefix_cache" else cached.rag_prompt
+    return [HumanMessage(content = question), AIMessage(content = cached.answer)]
+
+def make_interrupted_turn(question: str, rag_prompt: str, partial_answer: str, layout: str = PROMPT_LAYOUT) -> list:
+    """Вопрос и начало ответа, генерацию которого прервали (клиент отключился), в том виде,
+    в каком цепочка сохранила бы их в истории, и с пометкой INTERRUPTED_ANSWER_MARKER в конце ответа"""
+    human = question if layout == "prefix_cache" else rag_prompt
+    answer = f"{partial_answer.rstrip()}\n\n{INTERRUPTED_ANSWER_MARKER}" if partial_answer.strip() else INTERRUPTED_ANSWER_MARKER
+    return [HumanMessage(content = human), AIMessage(content = answer)]
+
+def make_history_from_cache(cached: CachedAnswer, layout: str = PROMPT_LAYOUT) -> list:
+    """История диалога v1 после ответа из кеша - такая же, как если бы ответ был сгенерирован"""
+    return [get_stardard_system_message(), get_standard_start_message()] + make_cached_turn(cached, layout)
+
+def split_for_replay(answer: str, words_in_chunk: int = 3) -> List[str]:
+    """Деление сохранённого ответа на куски по несколько слов для выдачи в потоковом режиме"""
+    words = re.findall(r"\s*\S+", answer)
+    return ["".join(words[i:i + words_in_chunk]) for i in range(0, len(words), words_in_chunk)]
+
 def clean_history(history: list) -> list:
     """Очистка от лишних вызовов для истории, остаётся только сообщения типа System, Human и ответы AI"""
     history_temp = []
@@ -87,8 +200,12 @@ def clean_history(history: list) -> list:
         
     return history_temp
 
-def cut_history(history: list) -> list:
-    """Обрезка истории по количеству сообщений с сохранением системного промпта"""
+def cut_history(history: list, layout: str = PROMPT_LAYOUT) -> list:
+    """Обрезка истории: при раскладке "prefix_cache" - окно по HISTORY_TOKEN_BUDGET токенов (`window_history`),
+    иначе - по количеству сообщений с сохранением системного промпта"""
+    if layout == "prefix_cache":
+        return window_history(history)
+
     if len(history) > N_HISTORY:
             sys = history[:1]
             history_temp = history[-N_HISTORY:]
@@ -100,30 +217,43 @@ def cut_history(history: list) -> list:
 # Runnable with history. V2
 # -------------------------
 
-def get_runnable_chain(model):
+def get_runnable_chain(model, layout: str = PROMPT_LAYOUT):
     """Формат для вызова:\n
     - Если `есть` streaming:\n
     .. code-block:: python
         async for chunk in runnable_chain.astream_events(
-            {'input': user_message}, version="v2", config=config
+            make_chain_input(user_message, message_with_rag_docs), version="v2", config=config
         ):
             if chunk["event"] in ["on_parser_start", "on_parser_stream"]:
                 print(chunk)
     
     - Если `нет` streaming:
     .. code-block:: python
-        runnable_chain.invoke({'input': user_message}, version="v2", config=config)
+        runnable_chain.invoke(make_chain_input(user_message, message_with_rag_docs), version="v2", config=config)
 
-    config можно создать через функцию `make_config_for_chain`
+    config можно создать через функцию `make_config_for_chain`\n
+    При `layout` = "prefix_cache" в историю сессии сохраняется голый вопрос (`input`), модели отправляется
+    вопрос с чанками (`rag_input`), а история ограничивается окном `window_history`
     """
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", get_stardard_system_message().content),
-        ("placeholder", "{history}"),
-        ("user", "{input}")
-    ])
+    if layout == "prefix_cache":
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", get_stardard_system_message().content),
+            ("placeholder", "{history}"),
+            ("user", "{rag_input}")
+        ])
+        prompt = RunnablePassthrough.assign(history = lambda x: window_history(x.get("history") or [])) | prompt
+    else:
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", get_stardard_system_message().content),
+            ("placeholder", "{history}"),
+            ("user", "{input}")
+        ])
+
+    # num_ctx и keep_alive - по длине собранного промпта
+    sized_model = RunnableLambda(lambda prompt_value: model.bind(**make_request_kwargs(model, prompt_value.to_messages())))
 
     str_parser = StrOutputParser()
-    chain = prompt | model | str_parser.with_config({"run_name": RUN_NAME})
+    chain = prompt | sized_model | str_parser.with_config({"run_name": RUN_NAME})
 
     runnable_with_history = RunnableWithMessageHistory(
         chain,
@@ -134,6 +264,16 @@ def get_runnable_chain(model):
 
     return runnable_with_history
 
-def make_config_for_chain(session_id: str) -> dict:
-    """Создание config для runnable_chain"""
-    return {"configurable": {"session_id": session_id}}
\ No newline at end of file
+def make_chain_input(question: str, rag_prompt: str, layout: str = PROMPT_LAYOUT) -> dict:
+    """Вход цепочки `get_runnable_chain`: вопрос пользователя и вопрос с найденными чанками"""
+    if layout == "prefix_cache":
+        return {"input": question, "rag_input": rag_prompt}
+    return {"input": rag_prompt}
+
+def make_config_for_chain(session_id: str, callbacks: list = None) -> dict:
+    """Создание config для runnable_chain\n
+    `callbacks` - обработчики событий только этого вызова (модель при этом остаётся общей)"""
+    config = {"configurable": {"session_id": session_id}}
+    if callbacks:
+        config["callbacks"] = callbacks
+    return config
\ No newline at end of file
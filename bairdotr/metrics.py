@@ -0,0 +1,289 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# Границы корзин гистограмм длительности (секунды): от долей миллисекунды (поиск faiss)
+# до минут (генерация длинного ответа)
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0
+)
+# Скорость генерации (токенов в секунду)
+RATE_BUCKETS = (1, 2.5, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram():
+    """Гистограмма в формате Prometheus: счётчики по корзинам, сумма и количество наблюдений\n
+    Запись - одно `bisect` и инкремент под блокировкой, поэтому её можно ставить на каждый запрос"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+        self._lock = threading.Lock()
+        # значения меток -> [счётчики корзин (+Inf последняя), сумма, количество]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues: str):
+        """Длительность блока `with` в секундах"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = {labels: (list(counts), total, n) for labels, (counts, total, n) in self._series.items()}
+
+        lines = []
+        for labels, (counts, total, n) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {n}")
+        return lines
+
+
+class Counter():
+    """Монотонный счётчик"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in sorted(values.items())]
+
+
+class Gauge():
+    """Текущее значение, которое считается функцией `source` в момент запроса /metrics.
+    С `labelnames` `source` возвращает словарь {значения меток: значение}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, source: Callable[[], float], labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.source = source
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        try:
+            value = self.source()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if self.labelnames:
+            return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}" for labels, v in sorted(value.items())]
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class MetricsRegistry():
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus (для /metrics)"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        """Регистрация метрики. Метрика с тем же именем заменяет прежнюю"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class PipelineMetrics():
+    """Метрики RAG-конвейера\n
+    - stage_seconds{stage}: длительность этапов (token_check, history_load, history_write, query_embedding,
+      faiss_search, augmentation_*, prompt_build, generation)
+    - time_to_first_token_seconds: от начала генерации до первого токена
+    - generation_tokens_per_second: скорость генерации после первого токена
+    - request_seconds{endpoint}: полная длительность запроса
+    - requests_total{endpoint, outcome}: обработанные запросы
+    - rag_context_tokens_total{kind}: токены найденных чанков (retrieved) и попавших в промпт отрывков (sent)
+    - generation_saved_seconds_total: оценка времени генерации, не потраченного на ответы отключившимся клиентам
+    - llm_queue_seconds{priority}: ожидание слота планировщика вызовов модели
+    - llm_calls_total{priority, outcome}: вызовы модели, получившие слот (admitted) и отклонённые (rejected)
+    Гауги (запросы в работе, размер индекса) добавляются через `add_gauge`"""
+    def __init__(self) -> None:
+        self.registry = MetricsRegistry()
+        self.stage_seconds = self.registry.register(Histogram(
+            "bairdotr_stage_seconds", "Duration of RAG pipeline stages in seconds", ("stage",)
+        ))
+        self.time_to_first_token = self.registry.register(Histogram(
+            "bairdotr_time_to_first_token_seconds", "Time from the start of generation to the first token"
+        ))
+        self.tokens_per_second = self.registry.register(Histogram(
+            "bairdotr_generation_tokens_per_second", "Generation speed after the first token", buckets = RATE_BUCKETS
+        ))
+        self.request_seconds = self.registry.register(Histogram(
+            "bairdotr_request_seconds", "Duration of chat requests in seconds", ("endpoint",)
+        ))
+        self.requests = self.registry.register(Counter(
+            "bairdotr_requests_total", "Processed chat requests", ("endpoint", "outcome")
+        ))
+        self.context_tokens = self.registry.register(Counter(
+            "bairdotr_rag_context_tokens_total", "Tokens of retrieved chunks and of passages sent to the model", ("kind",)
+        ))
+        self.generation_saved_seconds = self.registry.register(Counter(
+            "bairdotr_generation_saved_seconds_total", "Estimated generation seconds not spent after clients disconnected"
+        ))
+        self.llm_queue_seconds = self.registry.register(Histogram(
+            "bairdotr_llm_queue_seconds", "Time model calls wait for a scheduler slot", ("priority",)
+        ))
+        self.llm_calls = self.registry.register(Counter(
+            "bairdotr_llm_calls_total", "Model calls admitted and rejected by the scheduler", ("priority", "outcome")
+        ))
+        # Законченные ответы: число, токены, секунды генерации после первого токена (для оценки прерванных)
+        self._answers = [0, 0, 0.0]
+        self._answers_lock = threading.Lock()
+
+    def record_answer(self, n_tokens: int, seconds: float) -> None:
+        with self._answers_lock:
+            self._answers[0] += 1
+            self._answers[1] += n_tokens
+            self._answers[2] += seconds
+
+    def answer_stats(self) -> Tuple[float, float]:
+        """Средняя длина законченного ответа в токенах и средняя скорость генерации (токенов в секунду)"""
+        with self._answers_lock:
+            answers, tokens, seconds = self._answers
+        if answers == 0 or seconds <= 0:
+            return 0.0, 0.0
+        return tokens / answers, tokens / seconds
+
+    def stage(self, name: str):
+        """Контекстный менеджер: длительность этапа `name`"""
+        return self.stage_seconds.time(name)
+
+    def observe_stage(self, name: str, seconds: float) -> None:
+        self.stage_seconds.observe(seconds, name)
+
+    def add_gauge(self, name: str, documentation: str, source: Callable[[], float], labelnames: Tuple[str, ...] = ()) -> None:
+        self.registry.register(Gauge(name, documentation, source, labelnames))
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+class GenerationTimer():
+    """Замер генерации ответа по потоку токенов: время до первого токена, скорость и общая длительность\n
+    .. code-block:: python
+        timer = GenerationTimer(get_pipeline_metrics())
+        async for chunk in stream:
+            timer.token()
+        timer.finish()
+    """
+    def __init__(self, metrics: PipelineMetrics) -> None:
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.n_tokens = 0
+
+    def token(self, n: int = 1) -> None:
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            self.metrics.time_to_first_token.observe(self.first_token - self.start)
+        self.n_tokens += n
+
+    def finish_from_metadata(self, metadata: dict) -> None:
+        """Конец генерации без потока токенов (`invoke`): время до первого токена и скорость
+        берутся из `response_metadata` Ollama (load/prompt_eval/eval_duration в наносекундах), если они есть"""
+        if metadata.get("eval_count") and metadata.get("eval_duration"):
+            self.metrics.time_to_first_token.observe(
+                (metadata.get("load_duration", 0) + metadata.get("prompt_eval_duration", 0)) / 1e9
+            )
+            self.metrics.tokens_per_second.observe(metadata["eval_count"] / (metadata["eval_duration"] / 1e9))
+        self.metrics.observe_stage("generation", time.perf_counter() - self.start)
+
+    def finish(self, n_tokens: int = None) -> None:
+        """Конец генерации. `n_tokens` - точное число токенов, если модель его вернула"""
+        end = time.perf_counter()
+        self.metrics.observe_stage("generation", end - self.start)
+
+        n_tokens = n_tokens if n_tokens is not None else self.n_tokens
+        first_token = self.first_token if self.first_token is not None else self.start
+        # Первый токен пришёл в first_token, остальные генерировались после него
+        if n_tokens > 1 and end > first_token:
+            self.metrics.tokens_per_second.observe((n_tokens - 1) / (end - first_token))
+            self.metrics.record_answer(n_tokens - 1, end - first_token)
+
+    def abort(self) -> float:
+        """Генерация прервана (клиент отключился). Возвращает оценку сэкономленных секунд генерации:
+        недостающие до средней длины ответа токены при скорости этого ответа (или средней, если токенов
+        ещё не было). Пока нет ни одного законченного ответа, оценка - 0"""
+        mean_tokens, mean_rate = self.metrics.answer_stats()
+        rate = mean_rate
+        if self.n_tokens > 1:
+            elapsed = time.perf_counter() - self.first_token
+            if elapsed > 0:
+                rate = (self.n_tokens - 1) / elapsed
+
+        saved = max(0.0, mean_tokens - self.n_tokens) / rate if rate > 0 else 0.0
+        self.metrics.generation_saved_seconds.inc(amount = saved)
+        return saved
+
+
+_PIPELINE_METRICS = {}
+
+def get_pipeline_metrics() -> PipelineMetrics:
+    """Метрики конвейера, общие для всего процесса"""
+    metrics = _PIPELINE_METRICS.get("default")
+    if metrics is None:
+        metrics = _PIPELINE_METRICS.setdefault("default", PipelineMetrics())
+    return metrics
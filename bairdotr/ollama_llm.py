@@ -1,36 +1,166 @@
 from langchain_ollama import ChatOllama
 from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+import httpx
 
 from bairdotr.tools import FaissStoreHandler
-from bairdotr.config import PATH_TO_VECTOR_STORE, EMBEDDINGS_NAME, LLM_MODEL
+from bairdotr.embedding_cache import QueryEmbeddingCache
+from bairdotr.answer_cache import SemanticAnswerCache
+from bairdotr.embedding_worker import BatchingEmbeddings
+from bairdotr.vector_storage import store_version
+from bairdotr.scheduler import current_llm_client, get_llm_scheduler
+from bairdotr.config import (
+    PATH_TO_VECTOR_STORE, 
+    EMBEDDINGS_NAME, 
+    LLM_MODEL,
+    OLLAMA_BASE_URL,
+    OLLAMA_MAX_CONNECTIONS,
+    OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+    OLLAMA_KEEPALIVE_EXPIRY,
+    OLLAMA_CONNECT_TIMEOUT,
+    OLLAMA_READ_TIMEOUT,
+    OLLAMA_KEEP_ALIVE,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_DISK_PATH,
+    QUERY_CACHE_DISK_CAPACITY,
+    EMBEDDING_BATCHING,
+    EMBEDDING_MAX_BATCH_SIZE,
+    EMBEDDING_MAX_WAIT,
+    FAISS_NPROBE,
+    FAISS_EF_SEARCH,
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_THRESHOLD,
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_CHECK_INTERVAL
+)
 
-from typing import Tuple, Literal
+from functools import partial
+from contextlib import aclosing
+from typing import Tuple, Literal, Union
 
 def get_all_in_one_rag() -> Tuple[ChatOllama, FaissStoreHandler]:
     """Общая функция для того, чтобы сразу начать.\n
     Возвращает модель и vector_store для RAG-системы"""
-    model = get_ollama_model(LLM_MODEL)
-    embeddings = get_emdeddings(EMBEDDINGS_NAME)
+    model = get_shared_ollama_model(LLM_MODEL)
+    if EMBEDDING_BATCHING:
+        embeddings = get_batching_embeddings(EMBEDDINGS_NAME)
+    else:
+        embeddings = get_emdeddings(EMBEDDINGS_NAME)
 
     vector_store = FaissStoreHandler(
         embeddings = embeddings,
         need_load = True,
-        load_path = PATH_TO_VECTOR_STORE
+        load_path = PATH_TO_VECTOR_STORE,
+        query_cache = get_query_cache(EMBEDDINGS_NAME)
     )
+    vector_store.set_search_params(nprobe = FAISS_NPROBE, ef_search = FAISS_EF_SEARCH)
     return model, vector_store
 
+def get_query_cache(embeddings_name: str) -> QueryEmbeddingCache:
+    """Кеш эмбеддингов запросов согласно настройкам из config"""
+    query_cache = QueryEmbeddingCache(
+        model_name = embeddings_name,
+        max_entries = QUERY_CACHE_SIZE,
+        disk_path = QUERY_CACHE_DISK_PATH,
+        disk_capacity = QUERY_CACHE_DISK_CAPACITY
+    )
+    return query_cache
+
+def get_answer_cache(path_to_vector_store: str = PATH_TO_VECTOR_STORE) -> Union[SemanticAnswerCache, None]:
+    """Семантический кеш ответов согласно настройкам из config (None, если он выключен)\n
+    Кеш сбрасывается, когда база по пути `path_to_vector_store` пересохраняется"""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+
+    answer_cache = SemanticAnswerCache(
+        threshold = ANSWER_CACHE_THRESHOLD,
+        max_entries = ANSWER_CACHE_SIZE,
+        ttl = ANSWER_CACHE_TTL,
+        version_source = partial(store_version, path_to_vector_store),
+        check_interval = ANSWER_CACHE_CHECK_INTERVAL
+    )
+    return answer_cache
+
 def get_emdeddings(embeddings_name: str):
     embeddings = HuggingFaceEmbeddings(model_name = embeddings_name)
     return embeddings
 
+_BATCHING_EMBEDDINGS = {}
+
+def get_batching_embeddings(embeddings_name: str) -> BatchingEmbeddings:
+    """Модель эмбеддингов с микробатчингом запросов, общая для всего процесса\n
+    Запросы всех пользователей идут в один фоновый поток, который считает их батчами"""
+    embeddings = _BATCHING_EMBEDDINGS.get(embeddings_name)
+    if embeddings is None:
+        embeddings = _BATCHING_EMBEDDINGS.setdefault(embeddings_name, BatchingEmbeddings(
+            get_emdeddings(embeddings_name),
+            max_batch_size = EMBEDDING_MAX_BATCH_SIZE,
+            max_wait = EMBEDDING_MAX_WAIT
+        ))
+    return embeddings
+
+def get_ollama_client_kwargs() -> dict:
+    """Настройки HTTP-клиента Ollama: размер пула keep-alive соединений и таймауты из config"""
+    return {
+        "limits": httpx.Limits(
+            max_connections = OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections = OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry = OLLAMA_KEEPALIVE_EXPIRY
+        ),
+        "timeout": httpx.Timeout(OLLAMA_READ_TIMEOUT, connect = OLLAMA_CONNECT_TIMEOUT)
+    }
+
+class ScheduledChatOllama(ChatOllama):
+    """ChatOllama, вызовы которой проходят через планировщик `get_llm_scheduler`: слот занимается
+    на всё время генерации (и потоковой), класс приоритета берётся из `llm_priority`, клиент - из `llm_client`
+    или session_id цепочки. Так через планировщик идут и вызовы внутри цепочек langchain (HyDE, ответ с историей)"""
+    @staticmethod
+    def _llm_client(run_manager) -> str:
+        return current_llm_client(getattr(run_manager, "metadata", None))
+
+    def _generate(self, messages, stop = None, run_manager = None, **kwargs):
+        with get_llm_scheduler().sync_slot(client = self._llm_client(run_manager)):
+            return super()._generate(messages, stop, run_manager, **kwargs)
+
+    def _stream(self, messages, stop = None, run_manager = None, **kwargs):
+        with get_llm_scheduler().sync_slot(client = self._llm_client(run_manager)):
+            yield from super()._stream(messages, stop, run_manager, **kwargs)
+
+    async def _agenerate(self, messages, stop = None, run_manager = None, **kwargs):
+        async with get_llm_scheduler().slot(client = self._llm_client(run_manager)):
+            return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+    async def _astream(self, messages, stop = None, run_manager = None, **kwargs):
+        # Поток Ollama закрывается и тогда, когда его бросили (клиент отключился), и всегда до освобождения слота
+        async with get_llm_scheduler().slot(client = self._llm_client(run_manager)):
+            async with aclosing(super()._astream(messages, stop, run_manager, **kwargs)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+
 def get_ollama_model(
         model_name: Literal["gemma2", "llama3.2"] = LLM_MODEL,
         need_callback = []
     ) -> ChatOllama:
-    llm = ChatOllama(
+    """Новая модель со своими HTTP-клиентами, вызовы - через планировщик. Для обработки запросов API
+    лучше использовать `get_shared_ollama_model`, а callbacks передавать через config вызова"""
+    llm = ScheduledChatOllama(
         model = model_name,
-        base_url = "http://ollama-container:11434",
-        callbacks = need_callback
+        base_url = OLLAMA_BASE_URL,
+        callbacks = need_callback,
+        keep_alive = OLLAMA_KEEP_ALIVE,
+        client_kwargs = get_ollama_client_kwargs()
     )
 
-    return llm
\ No newline at end of file
+    return llm
+
+_OLLAMA_MODELS = {}
+
+def get_shared_ollama_model(model_name: Literal["gemma2", "llama3.2"] = LLM_MODEL) -> ChatOllama:
+    """Модель, общая для всего процесса (создаётся один раз на имя модели)\n
+    Её HTTP-клиенты держат пул keep-alive соединений к Ollama, поэтому запросы
+    не открывают новое соединение каждый раз. Callbacks конкретного запроса передаются через config:
+    `model.invoke(messages, config = {"callbacks": [...]})`"""
+    model = _OLLAMA_MODELS.get(model_name)
+    if model is None:
+        model = _OLLAMA_MODELS.setdefault(model_name, get_ollama_model(model_name))
+    return model
@@ -1,12 +1,15 @@
 from langchain_unstructured import UnstructuredLoader
 from collections import defaultdict
+from multiprocessing import get_context
 import re
 import os
+import json
+import argparse
 
-from typing import List
+from typing import Dict, List, Tuple
 from langchain_core.documents.base import Document
 
-from bairdotr.config import PREPARED, RAW_DOCS
+from bairdotr.config import PREPARED, RAW_DOCS, PARSE_WORKERS, PARSE_MAX_TASKS_PER_CHILD, PARSE_CHECKPOINT_FILE
 
 
 def loader_choice(
@@ -51,34 +54,34 @@ def delete_trash(docs: List[Document],inf_titul: bool) -> list[Document]:
     for doc in docs:
         delete = False
 
-    # Удаление титульника, если нет условия inf_titul = False
-    if((doc.metadata["page_number"]==1)and(not inf_titul)):
-        delete = True
+        # Удаление титульника, если нет условия inf_titul = False
+        if((doc.metadata["page_number"]==1)and(not inf_titul)):
+            delete = True
 
-    # Удаление всего, что имеет категорию Image
-    if(doc.metadata["category"]=="Image"):
-        delete = True
+        # Удаление всего, что имеет категорию Image
+        if(doc.metadata["category"]=="Image"):
+            delete = True
 
-    # Удаляем любой блок, который не содержит ни одной русской буквы
-    match_rus = re.fullmatch('[^а-яА-ЯёЁ]+',doc.page_content)
-    if match_rus:
-        delete = True
+        # Удаляем любой блок, который не содержит ни одной русской буквы
+        match_rus = re.fullmatch('[^а-яА-ЯёЁ]+',doc.page_content)
+        if match_rus:
+            delete = True
 
-    # Удаляем формы. Форма ищется через множественные _. Если они найдены, удаляем всю страницу
-    # Если _ находится в нижней части документа, то это сноска, оставляем
-    # Если _ находится в самой верхней части, то это примечение к документу, оставляем
-    if((doc.metadata["coordinates"]["points"][1][1] < 1900)and(doc.metadata["coordinates"]["points"][1][1] > 400)):
-        match_form = re.search('_{4,}',doc.page_content)
-        if(match_form):
-            delete_page.append(doc.metadata["page_number"])
+        # Удаляем формы. Форма ищется через множественные _. Если они найдены, удаляем всю страницу
+        # Если _ находится в нижней части документа, то это сноска, оставляем
+        # Если _ находится в самой верхней части, то это примечение к документу, оставляем
+        if((doc.metadata["coordinates"]["points"][1][1] < 1900)and(doc.metadata["coordinates"]["points"][1][1] > 400)):
+            match_form = re.search('_{4,}',doc.page_content)
+            if(match_form):
+                delete_page.append(doc.metadata["page_number"])
 
-    # Удаление нижней части каждой страницы документа, если информация о документе есть. Проверка inf_doc выше.
-    if ((doc.metadata["coordinates"]["points"][1][1] > 2100)and(inf_doc)):
-        delete = True
+        # Удаление нижней части каждой страницы документа, если информация о документе есть. Проверка inf_doc выше.
+        if ((doc.metadata["coordinates"]["points"][1][1] > 2100)and(inf_doc)):
+            delete = True
 
-    # Если ни одним из средста, блок не был удален, сохраняем его
-    if(not delete):
-        new_doc.append(doc)
+        # Если ни одним из средста, блок не был удален, сохраняем его
+        if(not delete):
+            new_doc.append(doc)
 
     # Удаление форм. Получаем только уникальные страницы на удаление
     delete_page = set(delete_page)
@@ -120,6 +123,74 @@ def div_into_butch(
     return docs_fin
 
 
+def read_checkpoint(checkpoint_path: str) -> Dict[str, dict]:
+    """Уже обработанные документы из файла чекпоинта: имя -> размер и время изменения исходника.\n
+    Оборванная при падении последняя строка пропускается"""
+    done = {}
+    if not os.path.isfile(checkpoint_path):
+        return done
+    with open(checkpoint_path, encoding = "utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[record["document"]] = record
+    return done
+
+def append_checkpoint(checkpoint_path: str, document: str, source_path: str) -> None:
+    """Отметка документа как обработанного. Пишется только после того, как готовый файл на месте"""
+    stat = os.stat(source_path)
+    record = {"document": document, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    with open(checkpoint_path, "a", encoding = "utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii = False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def is_converted(record: dict, source_path: str, final_path_doc: str) -> bool:
+    """Документ уже обработан и с тех пор не менялся"""
+    if record is None or not os.path.isfile(final_path_doc):
+        return False
+    stat = os.stat(source_path)
+    return record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns
+
+def convert_document(
+        path: str,
+        final_path_doc: str,
+        choice_loader: str,
+        api: str,
+        inf_titul: bool,
+        batch_size: int,
+        split_in_batch: str,
+        block_in_batch: int
+    ) -> int:
+    """Обработка одного документа (выполняется в процессе-обработчике).
+    Результат пишется во временный файл и подменяется целиком, поэтому после падения
+    не остаётся наполовину записанных документов. Возвращает число батчей"""
+    loader = loader_choice(path,choice_loader,api)
+    docs = list(loader.lazy_load())
+
+    new_docs = delete_trash(docs,inf_titul)
+    del docs
+    fin_doc = div_into_butch(new_docs,batch_size,split_in_batch,block_in_batch)
+
+    tmp_path = final_path_doc + ".tmp"
+    with open(tmp_path, 'w') as f:
+        for i in fin_doc:
+            print(i+"\n\n", file=f)
+    os.replace(tmp_path, final_path_doc)
+    return len(fin_doc)
+
+def convert_task(task: Tuple[str, tuple]) -> Tuple[str, int, str]:
+    """Обёртка для пула: ошибка одного документа не должна останавливать остальные.
+    Возвращает имя документа, число батчей и текст ошибки (None, если всё хорошо)"""
+    document, args = task
+    try:
+        return document, convert_document(*args), None
+    except Exception as e:
+        return document, 0, repr(e)
+
+
 def mirea_loader(
         download_path,
         final_path,
@@ -129,6 +200,10 @@ def mirea_loader(
         batch_size = 300,
         split_in_batch = "\n",
         block_in_batch = 10,
+        workers = PARSE_WORKERS,
+        max_tasks_per_child = PARSE_MAX_TASKS_PER_CHILD,
+        checkpoint_path = PARSE_CHECKPOINT_FILE,
+        restart = False
     ) -> None:
     """Загрузчик. Параметры:
     - download_path - путь, где лежат необработанные документы
@@ -141,35 +216,72 @@ def mirea_loader(
     - batch_size - количество символов в блоке, после которого мы решаем, что это новый batch. По умолчанию 300
     - split_in_batch - как делим блоки в батче. По умолчанию "\n"
     - block_in_batch - максимальное число блоков в батче. По умолчанию 10
+
+    - workers - число процессов-обработчиков. По умолчанию PARSE_WORKERS (None - по числу ядер)
+    - max_tasks_per_child - сколько документов обрабатывает процесс до перезапуска (ограничение памяти)
+    - checkpoint_path - файл с уже обработанными документами, повторный запуск их пропускает
+    - restart - обработать все документы заново, игнорируя чекпоинт
     """
-    # Просмотр папки с доками
-    docs_paths = os.listdir(download_path)
+    os.makedirs(final_path, exist_ok = True)
+    # Остатки незаписанных до конца документов после падения
+    for name in os.listdir(final_path):
+        if name.endswith(".tmp"):
+            os.remove(os.path.join(final_path, name))
 
+    if restart and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+    done = read_checkpoint(checkpoint_path)
+
+    # Просмотр папки с доками, уже обработанные пропускаем
+    docs_paths = sorted(os.listdir(download_path))
+    tasks = {}
     for document in docs_paths:
         path = os.path.join(download_path,document)
+        final_path_doc = final_path + "/" + document[:-3] + "txt"
+        if is_converted(done.get(document), path, final_path_doc):
+            continue
+        tasks[document] = (path, final_path_doc)
 
-        # Выбор загрузчика
-        loader = loader_choice(path,choice_loader,api)
+    skipped = len(docs_paths) - len(tasks)
+    if skipped:
+        print(f"Пропущено уже обработанных документов: {skipped}")
+    if not tasks:
+        return
 
-        docs = []
-        for doc in loader.lazy_load():
-            docs.append(doc)
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    print(f"Обработка {len(tasks)} документов, процессов: {workers}")
 
-        new_docs = delete_trash(docs,inf_titul)
-        fin_doc = div_into_butch(new_docs,batch_size,split_in_batch,block_in_batch)
+    # spawn и перезапуск процесса каждые max_tasks_per_child документов: память парсера не копится
+    failed = []
+    args = [
+        (document, (path, final_path_doc, choice_loader, api, inf_titul, batch_size, split_in_batch, block_in_batch))
+        for document, (path, final_path_doc) in tasks.items()
+    ]
+    with get_context("spawn").Pool(processes = workers, maxtasksperchild = max_tasks_per_child) as pool:
+        for n, (document, n_batches, error) in enumerate(pool.imap_unordered(convert_task, args), start = 1):
+            if error is not None:
+                failed.append(document)
+                print(f"[{n}/{len(tasks)}] Документ {document} не обработан: {error}")
+                continue
 
-        final_path_doc = final_path + "/" + document[:-3] + "txt"
-        with open(final_path_doc, 'w') as f:
-            for i in fin_doc:
-                print(i+"\n\n", file=f)
+            append_checkpoint(checkpoint_path, document, tasks[document][0])
+            # Лог загрузки
+            print(f"[{n}/{len(tasks)}] Документ {document} обработан ({n_batches} батчей)")
 
-        # Лог загрузки
-        print("Документ " + document + " обработан")
+    if failed:
+        print(f"Не удалось обработать {len(failed)} документов, они будут обработаны при следующем запуске: {failed}")
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Convert raw documents into prepared text files")
+    parser.add_argument("--workers", type = int, default = PARSE_WORKERS, help = "number of worker processes")
+    parser.add_argument("--restart", action = "store_true", help = "ignore the checkpoint and convert everything again")
+    args = parser.parse_args()
+
     mirea_loader(
         download_path = RAW_DOCS,
-        final_path = PREPARED
-    )
\ No newline at end of file
+        final_path = PREPARED,
+        workers = args.workers,
+        restart = args.restart
+    )
@@ -0,0 +1,234 @@
+import re
+from dataclasses import dataclass
+from typing import List, Set, Union
+
+from langchain_core.documents import Document
+
+from bairdotr.config import (
+    RAG_CONTEXT_TOKEN_BUDGET,
+    PROMPT_TOKENIZER_NAME,
+    PROMPT_CHARS_PER_TOKEN,
+    PROMPT_MIN_OVERLAP,
+    PROMPT_NEAR_DUPLICATE,
+    PROMPT_MIN_PASSAGE_TOKENS
+)
+from bairdotr.metrics import get_pipeline_metrics
+
+WORD_RE = re.compile(r"\w+")
+
+
+class TokenCounter():
+    """Подсчёт и обрезка текста в токенах модели\n
+    Используется токенизатор модели с huggingface. Если его не удалось загрузить
+    (нет сети, закрытый репозиторий без токена), число токенов оценивается по длине текста"""
+    def __init__(self, tokenizer_name: str = None, chars_per_token: float = PROMPT_CHARS_PER_TOKEN) -> None:
+        self.chars_per_token = chars_per_token
+        self.tokenizer = None
+        self.tokenizer_name = None
+        # Почему токенизатор не загружен (None - загружен или не нужен)
+        self.error = None
+
+        if tokenizer_name is not None:
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+                self.tokenizer_name = tokenizer_name
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {e}".splitlines()[0]
+                print(
+                    f"Tokenizer {tokenizer_name} is not available ({self.error}), prompt token budgets use an estimate "
+                    f"of {chars_per_token} characters per token. For a gated repository set HF_TOKEN"
+                )
+
+    @property
+    def exact(self) -> bool:
+        return self.tokenizer is not None
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer(text, add_special_tokens = False)["input_ids"])
+        return max(1, round(len(text) / self.chars_per_token))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Начало текста не длиннее `max_tokens` токенов, обрезанное по границе слова"""
+        if max_tokens <= 0:
+            return ""
+        if self.tokenizer is not None:
+            ids = self.tokenizer(text, add_special_tokens = False)["input_ids"]
+            if len(ids) <= max_tokens:
+                return text
+            cut = self.tokenizer.decode(ids[:max_tokens])
+        else:
+            max_chars = int(max_tokens * self.chars_per_token)
+            if len(text) <= max_chars:
+                return text
+            cut = text[:max_chars]
+
+        space = cut.rfind(" ")
+        return (cut[:space] if space > 0 else cut).rstrip()
+
+
+_TOKEN_COUNTERS = {}
+
+def get_token_counter(tokenizer_name: str = PROMPT_TOKENIZER_NAME) -> TokenCounter:
+    """Счётчик токенов, общий для всего процесса (токенизатор загружается один раз)"""
+    counter = _TOKEN_COUNTERS.get(tokenizer_name)
+    if counter is None:
+        counter = _TOKEN_COUNTERS.setdefault(tokenizer_name, TokenCounter(tokenizer_name))
+    return counter
+
+
+@dataclass
+class Passage:
+    """Отрывок промпта: один чанк или несколько склеенных чанков одного файла.
+    `rank` - место лучшего из них в выдаче ретривера (0 - самый релевантный)"""
+    source: str
+    text: str
+    rank: int
+    tokens: int = 0
+
+
+@dataclass
+class RagContext:
+    """Отрывки документов для промпта и экономия токенов относительно вставки чанков целиком"""
+    passages: List[Passage]
+    retrieved_tokens: int
+    tokens: int
+    merged: int = 0
+    duplicates: int = 0
+    dropped: int = 0
+    truncated: int = 0
+    budget: int = RAG_CONTEXT_TOKEN_BUDGET
+    exact_tokens: bool = True
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.retrieved_tokens - self.tokens
+
+
+def find_overlap(left: str, right: str, min_overlap: int = PROMPT_MIN_OVERLAP) -> int:
+    """Длина самого длинного конца `left`, с которого начинается `right` (0, если она меньше `min_overlap`)"""
+    if len(left) < min_overlap or len(right) < min_overlap:
+        return 0
+
+    head = right[:min_overlap]
+    start = max(0, len(left) - len(right))
+    position = left.find(head, start)
+    while position != -1:
+        if right.startswith(left[position:]):
+            return len(left) - position
+        position = left.find(head, position + 1)
+    return 0
+
+def merge_texts(left: str, right: str, min_overlap: int = PROMPT_MIN_OVERLAP) -> Union[str, None]:
+    """Склейка двух отрывков одного файла: один содержит другой или конец одного совпадает
+    с началом другого (перекрытие чанков). None, если склеить нельзя"""
+    if right in left:
+        return left
+    if left in right:
+        return right
+
+    overlap = find_overlap(left, right, min_overlap)
+    if overlap:
+        return left + right[overlap:]
+    overlap = find_overlap(right, left, min_overlap)
+    if overlap:
+        return right + left[overlap:]
+    return None
+
+def shingles(text: str, size: int = 3) -> Set[tuple]:
+    words = WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def is_near_duplicate(candidate: Set[tuple], kept: Set[tuple], threshold: float = PROMPT_NEAR_DUPLICATE) -> bool:
+    """Отрывок почти целиком повторяет уже взятый: большая часть его триграмм слов уже есть"""
+    if not candidate:
+        return True
+    return len(candidate & kept) / len(candidate) >= threshold
+
+def assemble_rag_context(
+        documents: List[Document],
+        budget: int = RAG_CONTEXT_TOKEN_BUDGET,
+        counter: TokenCounter = None
+) -> RagContext:
+    """Отрывки документов для промпта из найденных чанков (в порядке выдачи ретривера):\n
+    1) чанки одного файла, которые перекрываются или содержат друг друга, склеиваются в один отрывок
+       (повтор перекрытия CHUNK_OVERLAP в промпт не попадает)
+    2) точные и почти точные повторы уже взятых отрывков отбрасываются
+    3) отрывки берутся по релевантности, пока помещаются в `budget` токенов;
+       на последний при достаточном остатке бюджета - обрезается"""
+    counter = counter or get_token_counter()
+    retrieved_tokens = sum(counter.count(doc.page_content) for doc in documents)
+
+    # 1. Склейка перекрывающихся чанков одного файла
+    passages: List[Passage] = []
+    merged = 0
+    for rank, doc in enumerate(documents):
+        passage = Passage(source = doc.metadata.get("source", ""), text = doc.page_content.strip(), rank = rank)
+        while True:
+            for other in passages:
+                if other.source != passage.source:
+                    continue
+                text = merge_texts(other.text, passage.text)
+                if text is not None:
+                    passages.remove(other)
+                    passage = Passage(source = passage.source, text = text, rank = min(other.rank, passage.rank))
+                    merged += 1
+                    break
+            else:
+                break
+        passages.append(passage)
+    passages.sort(key = lambda p: p.rank)
+
+    # 2. Дубликаты между файлами (одинаковые тексты в разных документах)
+    unique: List[Passage] = []
+    seen: Set[tuple] = set()
+    duplicates = 0
+    for passage in passages:
+        passage_shingles = shingles(passage.text)
+        if is_near_duplicate(passage_shingles, seen):
+            duplicates += 1
+            continue
+        seen |= passage_shingles
+        unique.append(passage)
+
+    # 3. Бюджет
+    selected: List[Passage] = []
+    used = 0
+    dropped = 0
+    truncated = 0
+    for passage in unique:
+        passage.tokens = counter.count(passage.text)
+        left = budget - used
+        if passage.tokens <= left:
+            selected.append(passage)
+            used += passage.tokens
+        elif left >= PROMPT_MIN_PASSAGE_TOKENS:
+            passage.text = counter.truncate(passage.text, left)
+            passage.tokens = counter.count(passage.text)
+            selected.append(passage)
+            used += passage.tokens
+            truncated += 1
+        else:
+            dropped += 1
+
+    context = RagContext(
+        passages = selected,
+        retrieved_tokens = retrieved_tokens,
+        tokens = used,
+        merged = merged,
+        duplicates = duplicates,
+        dropped = dropped,
+        truncated = truncated,
+        budget = budget,
+        exact_tokens = counter.exact
+    )
+
+    metrics = get_pipeline_metrics()
+    metrics.context_tokens.inc("retrieved", amount = context.retrieved_tokens)
+    metrics.context_tokens.inc("sent", amount = context.tokens)
+    return context
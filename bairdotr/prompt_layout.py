@@ -0,0 +1,121 @@
+import threading
+from typing import List, Tuple
+
+from langchain_core.messages import BaseMessage
+
+from bairdotr.config import (
+    HISTORY_TOKEN_BUDGET,
+    HISTORY_DROP_TURNS,
+    OLLAMA_NUM_CTX_MIN,
+    OLLAMA_NUM_CTX_MAX,
+    ANSWER_TOKEN_RESERVE,
+    OLLAMA_KEEP_ALIVE
+)
+from bairdotr.prompt_context import TokenCounter, get_token_counter
+
+# Служебные токены шаблона чата на одно сообщение (<start_of_turn>роль\n ... <end_of_turn>\n у gemma2)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Параметры ChatOllama, которые Ollama получает в `options`. При передаче `options` в вызов
+# langchain_ollama не подставляет значения модели, поэтому они переносятся сюда
+OLLAMA_OPTION_FIELDS = (
+    "mirostat", "mirostat_eta", "mirostat_tau", "num_ctx", "num_gpu", "num_thread", "num_predict",
+    "repeat_last_n", "repeat_penalty", "temperature", "seed", "tfs_z", "top_k", "top_p"
+)
+
+
+def count_message_tokens(messages: List[BaseMessage], counter: TokenCounter = None) -> int:
+    """Длина промпта в токенах модели (с учётом разметки сообщений)"""
+    counter = counter or get_token_counter()
+    return sum(counter.count(message.content) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+def split_turns(messages: List[BaseMessage]) -> Tuple[List[BaseMessage], List[List[BaseMessage]]]:
+    """Деление истории на начало (системный промпт и приветствие до первого вопроса) и ходы,
+    каждый ход - вопрос пользователя и всё, что после него до следующего вопроса"""
+    prefix, turns = [], []
+    for message in messages:
+        if message.type == "human":
+            turns.append([message])
+        elif turns:
+            turns[-1].append(message)
+        else:
+            prefix.append(message)
+    return prefix, turns
+
+def window_history(
+        messages: List[BaseMessage],
+        budget: int = HISTORY_TOKEN_BUDGET,
+        drop_turns: int = HISTORY_DROP_TURNS,
+        counter: TokenCounter = None
+) -> List[BaseMessage]:
+    """Окно истории не длиннее `budget` токенов: начало (системный промпт, приветствие) остаётся,
+    старые ходы отбрасываются целиком.\n
+    Число отбрасываемых ходов округляется вверх до кратного `drop_turns`: начало окна сдвигается
+    раз в несколько ходов, а между сдвигами промпт каждого хода продолжает промпт предыдущего,
+    и Ollama не пересчитывает его префикс"""
+    prefix, turns = split_turns(messages)
+    tokens = [count_message_tokens(turn, counter) for turn in turns]
+    total = sum(tokens)
+    if total <= budget:
+        return list(messages)
+
+    dropped = 0
+    while total > budget and dropped < len(turns):
+        total -= tokens[dropped]
+        dropped += 1
+    dropped = min(len(turns), -(-dropped // drop_turns) * drop_turns)
+
+    return prefix + [message for turn in turns[dropped:] for message in turn]
+
+
+class ContextSizer():
+    """Выбор num_ctx по длине промпта: промпт + запас на ответ, вверх до степени двойки
+    в пределах [minimum, maximum]\n
+    Ollama перезагружает модель при смене num_ctx, поэтому выбранное значение только растёт:
+    после первого длинного диалога все запросы идут с тем же num_ctx"""
+    def __init__(
+            self,
+            minimum: int = OLLAMA_NUM_CTX_MIN,
+            maximum: int = OLLAMA_NUM_CTX_MAX,
+            reserve: int = ANSWER_TOKEN_RESERVE
+    ) -> None:
+        self.minimum = minimum
+        self.maximum = maximum
+        self.reserve = reserve
+        self.current = minimum
+        self._lock = threading.Lock()
+
+    def size(self, prompt_tokens: int) -> int:
+        needed = prompt_tokens + self.reserve
+        num_ctx = self.minimum
+        while num_ctx < needed and num_ctx < self.maximum:
+            num_ctx *= 2
+
+        with self._lock:
+            self.current = max(self.current, min(num_ctx, self.maximum))
+            return self.current
+
+
+_CONTEXT_SIZERS = {}
+
+def get_context_sizer(model_name: str) -> ContextSizer:
+    """num_ctx для модели, общий для всего процесса"""
+    sizer = _CONTEXT_SIZERS.get(model_name)
+    if sizer is None:
+        sizer = _CONTEXT_SIZERS.setdefault(model_name, ContextSizer())
+    return sizer
+
+def make_request_kwargs(model, messages: List[BaseMessage]) -> dict:
+    """Параметры вызова ChatOllama для этого промпта: `options` с num_ctx по измеренной длине промпта
+    и `keep_alive`. Для других моделей (без num_ctx) - пустой словарь"""
+    if not hasattr(model, "num_ctx"):
+        return {}
+
+    options = {name: getattr(model, name, None) for name in OLLAMA_OPTION_FIELDS}
+    options["stop"] = model.stop
+    # num_ctx, заданный у модели явно, не меняется
+    if options["num_ctx"] is None:
+        options["num_ctx"] = get_context_sizer(model.model).size(count_message_tokens(messages))
+    return {
+        "options": options,
+        "keep_alive": model.keep_alive if model.keep_alive is not None else OLLAMA_KEEP_ALIVE
+    }
@@ -0,0 +1,285 @@
+import math
+import time
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Deque, Dict, Optional
+
+from bairdotr.config import OLLAMA_NUM_PARALLEL, LLM_PRIORITIES, LLM_MAX_QUEUED, LLM_QUEUE_DEADLINE
+from bairdotr.executors import CapacityExceeded
+from bairdotr.metrics import get_pipeline_metrics
+
+# Класс приоритета и клиент текущего вызова модели. Задаются на весь запрос через `llm_priority`
+# и `llm_client` и доходят до модели сквозь цепочки langchain и дочерние задачи asyncio
+_PRIORITY = contextvars.ContextVar("llm_priority", default = "generation")
+_CLIENT = contextvars.ContextVar("llm_client", default = "")
+# Вес нового замера в средней длительности вызова
+HOLD_SMOOTHING = 0.2
+
+
+class LlmOverloaded(CapacityExceeded):
+    """Вызов модели отклонён планировщиком: очередь переполнена или слот не освободится вовремя.
+    `retry_after` - через сколько секунд есть смысл повторить запрос"""
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@contextmanager
+def llm_priority(priority: str):
+    """Класс приоритета (ключ LLM_PRIORITIES) вызовов модели внутри блока"""
+    if priority not in LLM_PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}, expected one of {list(LLM_PRIORITIES)}")
+    token = _PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+@contextmanager
+def llm_client(client: str):
+    """Клиент (токен или сессия), от имени которого идут вызовы модели внутри блока"""
+    token = _CLIENT.set(client or "")
+    try:
+        yield
+    finally:
+        _CLIENT.reset(token)
+
+def current_llm_client(metadata: dict = None) -> str:
+    """Клиент вызова: из `llm_client`, иначе session_id из metadata вызова цепочки langchain
+    (туда попадает configurable цепочки с историей). Контекстную переменную нельзя держать
+    между yield потокового ответа, поэтому у генерации в цепочке клиент берётся из metadata"""
+    return _CLIENT.get() or str((metadata or {}).get("session_id", ""))
+
+
+class _Waiter():
+    """Вызов в очереди. Ждёт либо future своего event loop, либо threading.Event (синхронный вызов)"""
+    __slots__ = ("priority", "client", "enqueued", "granted", "loop", "future", "event")
+
+    def __init__(self, priority: str, client: str, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        self.priority = priority
+        self.client = client
+        self.enqueued = time.perf_counter()
+        self.granted = False
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+
+    def wake(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(_set_done, self.future)
+        else:
+            self.event.set()
+
+def _set_done(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class LlmScheduler():
+    """Допуск вызовов модели к Ollama\n
+    - не больше `max_concurrent` вызовов одновременно (слот держится всё время генерации, в том числе потоковой);
+    - свободный слот получает вызов самого важного класса LLM_PRIORITIES, внутри класса клиенты
+      обслуживаются по кругу: один клиент с десятком вызовов не задерживает остальных;
+    - вызов, который по оценке очереди не дождётся слота за `queue_deadline` секунд, или не дождался его,
+      или не поместился в очередь из `max_queued`, сразу получает `LlmOverloaded` с Retry-After.\n
+    После насыщения ответы уже принятых запросов продолжают идти (генерация важнее модификации новых вопросов),
+    а лишние запросы быстро получают отказ вместо долгого ожидания и таймаута.
+    Работает с вызовами из любых event loop и потоков"""
+    def __init__(
+            self,
+            max_concurrent: int = OLLAMA_NUM_PARALLEL,
+            max_queued: int = LLM_MAX_QUEUED,
+            queue_deadline: float = LLM_QUEUE_DEADLINE,
+            priorities: Dict[str, int] = None
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_deadline = queue_deadline
+        self.priorities = dict(priorities or LLM_PRIORITIES)
+        self.metrics = get_pipeline_metrics()
+
+        self._lock = threading.Lock()
+        self.active = 0
+        # Класс приоритета -> клиент -> его вызовы в порядке поступления. Порядок клиентов - очередь обхода
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {
+            priority: OrderedDict() for priority in sorted(self.priorities, key = self.priorities.get)
+        }
+        self._queued = {priority: 0 for priority in self.priorities}
+        # Средняя длительность вызова (секунды), None - ещё не было ни одного
+        self.mean_hold = None
+
+    def queued(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._queued)
+
+    def estimate_wait(self, priority: str, pending: int = 0) -> float:
+        """Оценка ожидания слота новым вызовом класса `priority`: вызовы того же и более важных классов
+        в очереди (и `pending` вызовов, которые вот-вот в неё встанут), не поместившиеся в свободные слоты,
+        умноженные на среднюю длительность вызова и делённые на число слотов"""
+        with self._lock:
+            return self._estimate_wait(priority, pending)
+
+    def _estimate_wait(self, priority: str, pending: int = 0) -> float:
+        if self.mean_hold is None:
+            return 0.0
+        ahead = pending + sum(n for p, n in self._queued.items() if self.priorities[p] <= self.priorities[priority])
+        behind_slots = ahead + 1 - (self.max_concurrent - self.active)
+        return max(0, behind_slots) * self.mean_hold / self.max_concurrent
+
+    def _reject(self, priority: str, reason: str, pending: int = 0) -> LlmOverloaded:
+        self.metrics.llm_calls.inc(priority, "rejected")
+        retry_after = max(1, math.ceil(self._estimate_wait(priority, pending) or self.queue_deadline))
+        return LlmOverloaded(reason, retry_after)
+
+    def _enter(self, priority: str, client: str, loop: Optional[asyncio.AbstractEventLoop]) -> Optional[_Waiter]:
+        """Слот сразу (None) или место в очереди. Под блокировкой"""
+        if priority not in self.priorities:
+            raise ValueError(f"Unknown priority: {priority}, expected one of {list(self.priorities)}")
+        if self.active < self.max_concurrent:
+            self.active += 1
+            self.metrics.llm_queue_seconds.observe(0.0, priority)
+            self.metrics.llm_calls.inc(priority, "admitted")
+            return None
+
+        self._admit(priority)
+        waiter = _Waiter(priority, client, loop)
+        self._queues[priority].setdefault(client, deque()).append(waiter)
+        self._queued[priority] += 1
+        return waiter
+
+    def _admit(self, priority: str, pending: int = 0) -> None:
+        """Отказ (LlmOverloaded) вызову, который не поместится в очередь или не дождётся слота. Под блокировкой"""
+        if self.active >= self.max_concurrent and sum(self._queued.values()) >= self.max_queued:
+            raise self._reject(priority, f"{self.active} model calls in progress, {self.max_queued} in queue")
+        wait = self._estimate_wait(priority, pending)
+        if wait > self.queue_deadline:
+            raise self._reject(priority, f"Expected wait for a model slot {wait:.1f} s exceeds {self.queue_deadline} s", pending)
+
+    def check(self, priority: str = "generation", pending: int = 0) -> None:
+        """Проверка до начала обработки запроса: `LlmOverloaded`, если вызов класса `priority` сейчас
+        получил бы отказ. `pending` - вызовы, которые ещё не дошли до планировщика, но встанут в очередь раньше
+        (запросы, уже принятые API). Позволяет ответить 503 с Retry-After до того, как начат потоковый ответ"""
+        with self._lock:
+            self._admit(priority, pending)
+
+    def _leave_queue(self, waiter: _Waiter) -> bool:
+        """Вызов перестал ждать (дедлайн, отмена). True, если слот ему уже отдан. Под блокировкой"""
+        if waiter.granted:
+            return True
+        clients = self._queues[waiter.priority]
+        calls = clients.get(waiter.client)
+        if calls is not None and waiter in calls:
+            calls.remove(waiter)
+            if not calls:
+                del clients[waiter.client]
+            self._queued[waiter.priority] -= 1
+        return False
+
+    def _granted(self, waiter: _Waiter) -> None:
+        self.metrics.llm_queue_seconds.observe(time.perf_counter() - waiter.enqueued, waiter.priority)
+        self.metrics.llm_calls.inc(waiter.priority, "admitted")
+
+    async def acquire(self, priority: str = None, client: str = None) -> None:
+        """Занять слот (класс и клиент по умолчанию - из `llm_priority` и `llm_client`).
+        Бросает `LlmOverloaded`, если слот не получен"""
+        priority = priority or _PRIORITY.get()
+        client = client if client is not None else _CLIENT.get()
+        with self._lock:
+            waiter = self._enter(priority, client, asyncio.get_running_loop())
+        if waiter is None:
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_deadline)
+        except asyncio.TimeoutError:
+            with self._lock:
+                granted = self._leave_queue(waiter)
+                if not granted:
+                    raise self._reject(priority, f"No free model slot in {self.queue_deadline} seconds") from None
+        except BaseException:
+            # Запрос отменён (клиент ушёл): слот, который успели отдать, возвращается
+            with self._lock:
+                granted = self._leave_queue(waiter)
+            if granted:
+                self.release()
+            raise
+        self._granted(waiter)
+
+    def acquire_sync(self, priority: str = None, client: str = None) -> None:
+        """`acquire` для синхронных вызовов модели (блокирует поток)"""
+        priority = priority or _PRIORITY.get()
+        client = client if client is not None else _CLIENT.get()
+        with self._lock:
+            waiter = self._enter(priority, client, None)
+        if waiter is None:
+            return
+
+        if not waiter.event.wait(self.queue_deadline):
+            with self._lock:
+                if not self._leave_queue(waiter):
+                    raise self._reject(priority, f"No free model slot in {self.queue_deadline} seconds")
+        self._granted(waiter)
+
+    def release(self, hold_seconds: float = None) -> None:
+        """Освободить слот: он сразу переходит к следующему вызову в очереди"""
+        with self._lock:
+            if hold_seconds is not None:
+                self.mean_hold = hold_seconds if self.mean_hold is None else (
+                    (1 - HOLD_SMOOTHING) * self.mean_hold + HOLD_SMOOTHING * hold_seconds
+                )
+
+            for priority, clients in self._queues.items():
+                if not clients:
+                    continue
+                client, calls = next(iter(clients.items()))
+                waiter = calls.popleft()
+                if calls:
+                    # Следующий вызов этого клиента - после вызовов остальных клиентов
+                    clients.move_to_end(client)
+                else:
+                    del clients[client]
+                self._queued[priority] -= 1
+                waiter.granted = True
+                waiter.wake()
+                return
+            self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: str = None, client: str = None):
+        """Слот на время блока `async with`"""
+        await self.acquire(priority, client)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    @contextmanager
+    def sync_slot(self, priority: str = None, client: str = None):
+        """Слот на время блока `with` (синхронные вызовы)"""
+        self.acquire_sync(priority, client)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+
+_LLM_SCHEDULERS = {}
+
+def get_llm_scheduler() -> LlmScheduler:
+    """Планировщик вызовов модели, общий для всего процесса (его очередь видна в /metrics)"""
+    scheduler = _LLM_SCHEDULERS.get("default")
+    if scheduler is None:
+        scheduler = _LLM_SCHEDULERS.setdefault("default", LlmScheduler())
+        scheduler.metrics.add_gauge(
+            "bairdotr_llm_calls_in_progress", "Model calls holding a scheduler slot", lambda: scheduler.active
+        )
+        scheduler.metrics.add_gauge(
+            "bairdotr_llm_calls_queued", "Model calls waiting for a scheduler slot",
+            lambda: {(priority,): n for priority, n in scheduler.queued().items()}, ("priority",)
+        )
+    return scheduler
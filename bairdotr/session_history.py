@@ -0,0 +1,237 @@
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from bairdotr.metrics import get_pipeline_metrics
+from typing import Callable, List, Optional, Sequence, Tuple
+
+
+def message_key(message: BaseMessage) -> Tuple[str, str]:
+    """Ключ для сравнения сообщений при синхронизации истории"""
+    return message.type, str(message.content)
+
+
+class _CachedSession():
+    """Закешированная история одной сессии: сообщения, их номера в БД и версия сессии"""
+    __slots__ = ("messages", "seqs", "version")
+
+    def __init__(self, messages: List[BaseMessage], seqs: List[int], version: int) -> None:
+        self.messages = messages
+        self.seqs = seqs
+        self.version = version
+
+
+class SessionHistoryStore():
+    """Хранилище истории диалогов в SQLite (режим WAL) с LRU-кешем последних сессий\n
+    Каждое сообщение - отдельная строка таблицы, поэтому добавление хода пишет на диск
+    только новые сообщения. Недавние сессии держатся в памяти, и повторное чтение истории
+    не обращается к диску, кроме одного запроса версии сессии (на случай, если её изменил
+    другой процесс). Для сессий, которых ещё нет в БД, можно указать `legacy_loader` -
+    функцию, поднимающую историю из старых файлов"""
+    def __init__(
+            self,
+            db_path: str,
+            cache_size: int = 1024,
+            legacy_loader: Callable[[str], Optional[List[BaseMessage]]] = None
+    ) -> None:
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.legacy_loader = legacy_loader
+
+        self._lock = threading.RLock()
+        self._cache: "OrderedDict[str, _CachedSession]" = OrderedDict()
+
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok = True)
+
+        self._conn = sqlite3.connect(db_path, check_same_thread = False, isolation_level = None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, "
+            "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, version INTEGER NOT NULL, next_seq INTEGER NOT NULL)"
+        )
+
+    # ---------- Работа с БД ----------
+
+    def _db_version(self, session_id: str) -> Optional[Tuple[int, int]]:
+        row = self._conn.execute(
+            "SELECT version, next_seq FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row
+
+    def _load_from_db(self, session_id: str) -> _CachedSession:
+        row = self._db_version(session_id)
+        if row is None:
+            entry = _CachedSession([], [], 0)
+            if self.legacy_loader is not None:
+                legacy = self.legacy_loader(session_id)
+                if legacy:
+                    self._insert(session_id, entry, legacy)
+            return entry
+
+        rows = self._conn.execute(
+            "SELECT seq, message FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+        ).fetchall()
+        seqs = [seq for seq, _ in rows]
+        messages = messages_from_dict([json.loads(message) for _, message in rows])
+        return _CachedSession(messages, seqs, row[0])
+
+    def _replace(
+            self,
+            session_id: str,
+            entry: _CachedSession,
+            start: int,
+            count: int,
+            messages: Sequence[BaseMessage]
+    ) -> None:
+        """Замена `count` сообщений сессии, начиная с позиции `start`, на `messages`, дописанные в конец
+        (в БД и в кеш). Удаление и вставка - одна транзакция и одно увеличение версии"""
+        if not count and not messages:
+            return
+        deleted = entry.seqs[start:start + count]
+        row = self._db_version(session_id)
+        next_seq = 0 if row is None else row[1]
+        seqs = list(range(next_seq, next_seq + len(messages)))
+
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "DELETE FROM messages WHERE session_id = ? AND seq = ?",
+                [(session_id, seq) for seq in deleted]
+            )
+            self._conn.executemany(
+                "INSERT INTO messages (session_id, seq, message) VALUES (?, ?, ?)",
+                [
+                    (session_id, seq, json.dumps(message_to_dict(message), ensure_ascii = False))
+                    for seq, message in zip(seqs, messages)
+                ]
+            )
+            entry.version = self._bump(session_id, next_seq + len(messages))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        del entry.messages[start:start + count]
+        del entry.seqs[start:start + count]
+        entry.messages.extend(messages)
+        entry.seqs.extend(seqs)
+
+    def _insert(self, session_id: str, entry: _CachedSession, messages: Sequence[BaseMessage]) -> None:
+        """Дописывание сообщений в конец сессии. Пустой список ничего не меняет (версия та же)"""
+        self._replace(session_id, entry, len(entry.messages), 0, messages)
+
+    def _delete_range(self, session_id: str, entry: _CachedSession, start: int, count: int) -> None:
+        """Удаление `count` сообщений сессии, начиная с позиции `start`"""
+        self._replace(session_id, entry, start, count, [])
+
+    def _bump(self, session_id: str, next_seq: int) -> int:
+        """Увеличение версии сессии (вызывается внутри транзакции)"""
+        self._conn.execute(
+            "INSERT INTO sessions (session_id, version, next_seq) VALUES (?, 1, ?) "
+            "ON CONFLICT(session_id) DO UPDATE SET version = version + 1, next_seq = excluded.next_seq",
+            (session_id, next_seq)
+        )
+        return self._db_version(session_id)[0]
+
+    # ---------- Кеш ----------
+
+    def _entry(self, session_id: str) -> _CachedSession:
+        """Запись кеша для сессии, при необходимости (промах или устаревшая версия) - из БД"""
+        entry = self._cache.get(session_id)
+        if entry is not None:
+            row = self._db_version(session_id)
+            if (row[0] if row is not None else 0) == entry.version:
+                self._cache.move_to_end(session_id)
+                return entry
+
+        entry = self._load_from_db(session_id)
+        self._cache[session_id] = entry
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last = False)
+        return entry
+
+    # ---------- Публичный интерфейс ----------
+
+    def get(self, session_id: str) -> List[BaseMessage]:
+        """История сессии (копия списка - его можно изменять)"""
+        with get_pipeline_metrics().stage("history_load"), self._lock:
+            return list(self._entry(session_id).messages)
+
+    def append(self, session_id: str, messages: Sequence[BaseMessage]) -> None:
+        """Добавление новых сообщений в конец истории сессии"""
+        if not messages:
+            return
+        with get_pipeline_metrics().stage("history_write"), self._lock:
+            self._insert(session_id, self._entry(session_id), messages)
+
+    def sync(self, session_id: str, messages: Sequence[BaseMessage]) -> None:
+        """Сохранение новой полной версии истории сессии\n
+        Новая история сравнивается с сохранённой: если она получена дописыванием сообщений
+        в конец и/или вырезанием сообщений после общего начала (как делает `cut_history`),
+        на диск пишутся только изменения. Иначе история перезаписывается целиком"""
+        with get_pipeline_metrics().stage("history_write"), self._lock:
+            entry = self._entry(session_id)
+            old = [message_key(m) for m in entry.messages]
+            new = [message_key(m) for m in messages]
+
+            prefix = 0
+            while prefix < min(len(old), len(new)) and old[prefix] == new[prefix]:
+                prefix += 1
+
+            if prefix == len(old):
+                if prefix < len(new):
+                    self._insert(session_id, entry, messages[prefix:])
+                return
+
+            # Ищем, сколько сообщений вырезано сразу после общего начала
+            tail = len(old) - prefix
+            for dropped in range(1, tail + 1):
+                kept = tail - dropped
+                if old[prefix + dropped:] == new[prefix:prefix + kept]:
+                    self._replace(session_id, entry, prefix, dropped, messages[prefix + kept:])
+                    return
+
+            self._replace(session_id, entry, 0, len(entry.messages), messages)
+
+    def clear(self, session_id: str) -> None:
+        """Удаление истории сессии"""
+        with self._lock:
+            entry = self._entry(session_id)
+            if entry.messages:
+                self._delete_range(session_id, entry, 0, len(entry.messages))
+
+    def close(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._conn.close()
+
+
+class StoredChatMessageHistory(BaseChatMessageHistory):
+    """История сообщений langchain поверх `SessionHistoryStore`"""
+    def __init__(self, store: SessionHistoryStore, session_id: str) -> None:
+        self.store = store
+        self.session_id = session_id
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.get(self.session_id)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.store.append(self.session_id, list(messages))
+
+    def clear(self) -> None:
+        self.store.clear(self.session_id)
@@ -1,10 +1,24 @@
 from bairdotr.documents import FaissStoreHandler
 from bairdotr.ollama_llm import get_emdeddings
+from bairdotr.faiss_index import IndexParams, get_index_params_from_config
+from bairdotr.store_manifest import StoreManifest
 from bairdotr.config import PREPARED, JUST_CLEANED, PATH_TO_VECTOR_STORE, EMBEDDINGS_NAME
 
 import os
+import argparse
+from dataclasses import replace
 
-def main():
+def can_update_incrementally(path: str) -> bool:
+    """Можно ли дополнить существующую базу: у неё есть манифест и параметры индекса совпадают с config"""
+    if StoreManifest.load(path) is None:
+        return False
+
+    saved = IndexParams.load(path) or IndexParams()
+    wanted = get_index_params_from_config()
+    # nlist/nprobe могли быть подогнаны под корпус при обучении, тип индекса и PQ/HNSW должны совпадать
+    return replace(saved, nlist = 0, nprobe = 0, ef_search = 0) == replace(wanted, nlist = 0, nprobe = 0, ef_search = 0)
+
+def main(full_rebuild: bool = False):
     print("Start to prepare vector store and new documents...")
     path_to_prepared_docs = PREPARED + "/"
     path_to_just_cleaned_docs = JUST_CLEANED + "/"
@@ -19,38 +33,61 @@ def main():
     print(just_cleaned_docs)
     print()
 
-    print("Creating new blank vector store")
-    vector_store = FaissStoreHandler(get_emdeddings(EMBEDDINGS_NAME))
+    embeddings = get_emdeddings(EMBEDDINGS_NAME)
+    if not full_rebuild and can_update_incrementally(PATH_TO_VECTOR_STORE):
+        print("Loading existing vector store for incremental update")
+        vector_store = FaissStoreHandler(
+            embeddings,
+            need_load = True,
+            load_path = PATH_TO_VECTOR_STORE,
+            use_mmap = False
+        )
+    else:
+        print("Creating new blank vector store")
+        vector_store = FaissStoreHandler(
+            embeddings,
+            index_params = get_index_params_from_config()
+        )
 
+    # Файлы, которых больше нет в папках, удаляются из базы
+    present = set(prepared_docs) | set(just_cleaned_docs)
+    removed = [source for source in vector_store.manifest.sources if source not in present]
+    for source in removed:
+        print(f"Removing {source}")
+        vector_store.delete_source(source)
+
+    updated = []
     print("Adding cleaned and prepared docs...")
     for doc in prepared_docs:
-        print(doc)
         doc_path = path_to_prepared_docs + doc
-        vector_store.add_and_save_raw_files(
-            path_to_file = doc_path,
-            source_name = doc,
-            splitter = "standard"
-        )
-        print()
-    
+        if vector_store.upsert_file(path_to_file = doc_path, source_name = doc, splitter = "standard"):
+            print(doc)
+            updated.append(doc)
+    print()
+
     print("Addding just cleaned docs...")
     for doc in just_cleaned_docs:
-        print(doc)
         doc_path = path_to_just_cleaned_docs + doc
-        vector_store.add_and_save_raw_files(
-            path_to_file = doc_path,
-            source_name = doc,
-            splitter = "recursive"
-        )
-        print()
-    
+        if vector_store.upsert_file(path_to_file = doc_path, source_name = doc, splitter = "recursive"):
+            print(doc)
+            updated.append(doc)
+    print()
+
+    if vector_store.n_deleted > 0:
+        print("Compacting...")
+        vector_store.compact()
+
     print("Saving...")
     vector_store.save(PATH_TO_VECTOR_STORE)
 
-    print("New vector store build completed.")
-    print(f"There is {len(prepared_docs) + len(just_cleaned_docs)} new documents")
+    print("Vector store build completed.")
+    print(f"There is {len(updated)} new or changed documents, {len(removed)} removed, {len(present)} in total")
     print(f"Path to actual vector store: {PATH_TO_VECTOR_STORE}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = "Build or incrementally update the vector store")
+    parser.add_argument("--full", action = "store_true", help = "rebuild the vector store from scratch")
+    args = parser.parse_args()
+
+    main(full_rebuild = args.full)
@@ -0,0 +1,98 @@
+import numpy as np
+
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SOURCE_INDEX_FILE = "sources.npz"
+
+
+class SourceIndex():
+    """Соответствие исходный файл (metadata["source"] чанка) -> позиции его векторов в индексе faiss\n
+    Нужно для поиска только по части документов: позиции выбранных файлов передаются в faiss
+    как IDSelector, и индекс просматривает только их, а не отбрасывает лишнее после поиска"""
+    def __init__(self, positions: Dict[str, List[int]] = None) -> None:
+        self._positions: Dict[str, List[int]] = positions or {}
+        # Отсортированные массивы позиций по наборам файлов (сбрасываются при любом изменении)
+        self._cache: Dict[Tuple[str, ...], np.ndarray] = {}
+
+    @classmethod
+    def build(cls, items: Iterable[Tuple[int, Optional[str]]]) -> "SourceIndex":
+        """Построение по парам (позиция, source). Чанки без source не попадают в индекс"""
+        source_index = cls()
+        for position, source in items:
+            if source is not None:
+                source_index._positions.setdefault(source, []).append(position)
+        return source_index
+
+    @classmethod
+    def load(cls, folder: str) -> Optional["SourceIndex"]:
+        """Индекс, сохранённый рядом с базой, или None, если его нет"""
+        path = os.path.join(folder, SOURCE_INDEX_FILE)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            names, offsets, positions = data["names"], data["offsets"], data["positions"]
+        return cls({
+            str(name): positions[offsets[i]:offsets[i + 1]].tolist() for i, name in enumerate(names)
+        })
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok = True)
+        names = sorted(self._positions)
+        lengths = [len(self._positions[name]) for name in names]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        positions = np.array([p for name in names for p in self._positions[name]], dtype = np.int64)
+
+        # np.savez дописывает .npz к имени без этого расширения
+        tmp_path = os.path.join(folder, SOURCE_INDEX_FILE + ".tmp.npz")
+        np.savez(tmp_path, names = np.array(names, dtype = str), offsets = offsets, positions = positions)
+        os.replace(tmp_path, os.path.join(folder, SOURCE_INDEX_FILE))
+
+    def add(self, source: Optional[str], positions: Iterable[int]) -> None:
+        if source is None:
+            return
+        self._positions.setdefault(source, []).extend(positions)
+        self._cache.clear()
+
+    def remove_positions(self, positions: Iterable[int]) -> None:
+        """Удаление позиций (удалённых чанков) из всех файлов"""
+        positions = set(positions)
+        if not positions:
+            return
+        for source in list(self._positions):
+            kept = [p for p in self._positions[source] if p not in positions]
+            if kept:
+                self._positions[source] = kept
+            else:
+                del self._positions[source]
+        self._cache.clear()
+
+    def remap(self, mapping: Dict[int, int]) -> None:
+        """Перенумерация позиций после `compact` (позиции, которых нет в `mapping`, удаляются)"""
+        self._positions = {
+            source: [mapping[p] for p in positions if p in mapping] for source, positions in self._positions.items()
+        }
+        self._positions = {source: positions for source, positions in self._positions.items() if positions}
+        self._cache.clear()
+
+    def positions(self, sources: Iterable[str]) -> np.ndarray:
+        """Отсортированные позиции векторов всех чанков указанных файлов (int64, для IDSelector)"""
+        key = tuple(sorted(set(sources)))
+        result = self._cache.get(key)
+        if result is None:
+            parts = [self._positions[source] for source in key if source in self._positions]
+            result = np.unique(np.concatenate(parts)).astype(np.int64) if parts else np.empty(0, dtype = np.int64)
+            if len(self._cache) >= 256:
+                self._cache.clear()
+            self._cache[key] = result
+        return result
+
+    def sources(self) -> Dict[str, int]:
+        """Файлы и число их чанков"""
+        return {source: len(positions) for source, positions in sorted(self._positions.items())}
+
+    def __contains__(self, source: str) -> bool:
+        return source in self._positions
+
+    def __len__(self) -> int:
+        return len(self._positions)
@@ -0,0 +1,133 @@
+import time
+import threading
+import traceback
+
+from bairdotr.config import WARMUP_QUESTION, K_DOCUMENTS_FOR_RAG
+from bairdotr.scheduler import llm_priority
+
+
+class RagRuntime():
+    """Модель, база и цепочка с историей для API, которые загружаются уже после старта сервера\n
+    Состояние `status`: "starting" -> "loading" -> "warming" -> "ready" (или "failed" при ошибке).
+    Пока `ready` ложно, атрибуты model, vector_store, runnable_with_history и answer_cache равны None\n
+    .. code-block:: python
+        runtime = RagRuntime()
+        runtime.start()  # загрузка в фоновом потоке
+        ...
+        if runtime.ready:
+            runtime.model.invoke(...)
+    """
+    def __init__(self, warmup: bool = True) -> None:
+        self.warmup_enabled = warmup
+
+        self.status = "starting"
+        self.error = None
+        self.warmup_error = None
+        # Токенизатор модели не загружен - бюджет промпта считается по оценке длины текста
+        self.tokenizer_error = None
+        self.timings = {}
+
+        self.model = None
+        self.vector_store = None
+        self.runnable_with_history = None
+        self.answer_cache = None
+
+        self._ready = threading.Event()
+        self._thread = None
+        self._created = time.perf_counter()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Ожидание окончания загрузки. Возвращает `ready`"""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def start(self) -> None:
+        """Загрузка в фоновом потоке (повторный вызов ничего не делает)"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target = self._load_in_background, name = "rag-startup", daemon = True)
+        self._thread.start()
+
+    def _load_in_background(self) -> None:
+        try:
+            self.load()
+        except Exception:
+            # Ошибка уже записана в self.error, /readyz покажет её
+            pass
+
+    def load(self) -> None:
+        """Загрузка модели эмбеддингов, базы и модели Ollama в текущем потоке, затем прогрев"""
+        try:
+            self.status = "loading"
+            start = time.perf_counter()
+
+            # Тяжёлые модули (torch, sentence-transformers, faiss) импортируются только здесь,
+            # чтобы импорт API и открытие порта не ждали их
+            from bairdotr.ollama_llm import get_all_in_one_rag, get_answer_cache
+            from bairdotr.llm_wrapper import get_runnable_chain
+            from bairdotr.prompt_context import get_token_counter
+
+            model, vector_store = get_all_in_one_rag()
+            runnable_with_history = get_runnable_chain(model)
+            answer_cache = get_answer_cache()
+            # Токенизатор для бюджета промпта - тоже заранее, а не на первом вопросе
+            self.tokenizer_error = get_token_counter().error
+            self.timings["load_seconds"] = time.perf_counter() - start
+
+            if self.warmup_enabled:
+                self.status = "warming"
+                start = time.perf_counter()
+                self.warmup(model, vector_store)
+                self.timings["warmup_seconds"] = time.perf_counter() - start
+
+            self.model = model
+            self.vector_store = vector_store
+            self.runnable_with_history = runnable_with_history
+            self.answer_cache = answer_cache
+
+            self.timings["ready_after_seconds"] = time.perf_counter() - self._created
+            self.status = "ready"
+            self._ready.set()
+            print(f"RAG runtime is ready in {self.timings['ready_after_seconds']:.1f} s")
+
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+            raise
+
+    def warmup(self, model, vector_store) -> None:
+        """Пробный запрос через эмбеддинг и поиск по базе и через Ollama\n
+        Ollama при этом загружает модель в память и держит её там согласно OLLAMA_KEEP_ALIVE.
+        Недоступность Ollama не считается ошибкой запуска: сервис станет готов, а ошибка попадёт в `warmup_error`"""
+        vector_store.similarity_search(WARMUP_QUESTION, k = K_DOCUMENTS_FOR_RAG)
+
+        from langchain_core.messages import HumanMessage
+        from bairdotr.prompt_layout import make_request_kwargs
+
+        try:
+            # Достаточно одного токена: главное - загрузить веса модели. Параметры - те же, что у запросов
+            # пользователей (make_request_kwargs): с другим num_ctx Ollama перезагрузила бы модель на первом запросе
+            messages = [HumanMessage(content = WARMUP_QUESTION)]
+            kwargs = make_request_kwargs(model, messages)
+            kwargs.setdefault("options", {})["num_predict"] = 1
+            with llm_priority("background"):
+                model.invoke(messages, **kwargs)
+        except Exception as e:
+            self.warmup_error = f"{type(e).__name__}: {e}"
+            print(f"Ollama warmup failed: {self.warmup_error}")
+
+    def state(self) -> dict:
+        """Состояние для /readyz"""
+        return {
+            "status": self.status,
+            "ready": self.ready,
+            "error": self.error,
+            "warmup_error": self.warmup_error,
+            "tokenizer_error": self.tokenizer_error,
+            "timings": self.timings
+        }
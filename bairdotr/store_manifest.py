@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+from typing import Dict, List, Optional
+
+MANIFEST_FILE = "manifest.json"
+
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    """sha256 содержимого файла (файл читается блоками)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StoreManifest():
+    """Манифест исходных файлов базы: хэш содержимого, тип разделителя и id чанков каждого файла\n
+    Позволяет при пересборке базы обрабатывать только новые и изменённые файлы,
+    а чанки удалённых и изменённых файлов - удалять из индекса"""
+    def __init__(self, sources: Dict[str, dict] = None) -> None:
+        self.sources: Dict[str, dict] = sources or {}
+
+    @classmethod
+    def load(cls, folder: str) -> Optional["StoreManifest"]:
+        """Манифест, сохранённый рядом с базой, или None, если его нет"""
+        path = os.path.join(folder, MANIFEST_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path, encoding = "utf-8") as f:
+            return cls(json.load(f)["sources"])
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok = True)
+        tmp_path = os.path.join(folder, MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w", encoding = "utf-8") as f:
+            json.dump({"sources": self.sources}, f, ensure_ascii = False)
+        os.replace(tmp_path, os.path.join(folder, MANIFEST_FILE))
+
+    def is_current(self, source: str, content_hash: str, splitter: str) -> bool:
+        """Есть ли в базе актуальная версия файла"""
+        entry = self.sources.get(source)
+        return entry is not None and entry["sha256"] == content_hash and entry["splitter"] == splitter
+
+    def get_ids(self, source: str) -> List[str]:
+        entry = self.sources.get(source)
+        return list(entry["ids"]) if entry is not None else []
+
+    def set(self, source: str, content_hash: str, splitter: str, ids: List[str]) -> None:
+        self.sources[source] = {"sha256": content_hash, "splitter": splitter, "ids": list(ids)}
+
+    def remove(self, source: str) -> None:
+        self.sources.pop(source, None)
+
+    def __contains__(self, source: str) -> bool:
+        return source in self.sources
+
+    def __len__(self) -> int:
+        return len(self.sources)
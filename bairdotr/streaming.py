@@ -0,0 +1,186 @@
+import json
+import asyncio
+from contextlib import aclosing
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Optional, Union
+
+import anyio
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from bairdotr.config import STREAM_FLUSH_INTERVAL, STREAM_FLUSH_BYTES, STREAM_DISCONNECT_POLL
+
+# Кадры компактного протокола: {"type": ..., "delta": ...} (пустой delta не передаётся)
+# - context: найденные отрывки документов (delta - текст)
+# - start: начало ответа
+# - delta: очередной кусок ответа
+# - end: конец ответа
+# - error: отказ (delta - текст для пользователя, name - причина: not_ready, overloaded, bad_request)
+FRAME_TYPES = ("context", "start", "delta", "end", "error")
+# Кодировка "binary": первый байт - тип кадра, дальше - delta в UTF-8 (для error - "name\ntext")
+BINARY_CODES = {"context": b"C", "start": b"S", "delta": b"D", "end": b"E", "error": b"X"}
+ENCODINGS = ("json", "binary", "msgpack")
+
+
+class ClientDisconnected(Exception):
+    """Клиент закрыл соединение, не дочитав ответ"""
+
+
+class FrameEncoder():
+    """Кодирование кадров компактного протокола: "json" - текстовые кадры, "binary" и "msgpack" - двоичные"""
+    def __init__(self, encoding: str = "json") -> None:
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown stream encoding: {encoding}, expected one of {ENCODINGS}")
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("msgpack encoding requires the msgpack package")
+        self.encoding = encoding
+
+    def encode(self, frame_type: str, delta: str = "", name: str = None) -> Union[str, bytes]:
+        if self.encoding == "binary":
+            payload = f"{name}\n{delta}" if name is not None else delta
+            return BINARY_CODES[frame_type] + payload.encode("utf-8")
+
+        frame = {"type": frame_type}
+        if delta:
+            frame["delta"] = delta
+        if name is not None:
+            frame["name"] = name
+        if self.encoding == "msgpack":
+            return msgpack.packb(frame)
+        return json.dumps(frame, ensure_ascii = False, separators = (",", ":"))
+
+
+async def close_stream(iterator: Optional[AsyncIterator[str]], pending: asyncio.Future = None) -> None:
+    """Остановка исходного потока: ожидаемый следующий кусок отменяется, поток закрывается (`aclose`).\n
+    Выполняется под защитой от отмены: starlette при отключении клиента отменяет задачу ответа через
+    cancel scope anyio, и без защиты отмена прервала бы и закрытие - запрос к Ollama остался бы открытым"""
+    with anyio.CancelScope(shield = True):
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions = True)
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+_END_OF_STREAM = object()
+
+async def stream_in_task(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Поток `chunks`, который читает отдельная задача (так же устроен `astream_events` в langchain).\n
+    Если потребитель прекратил чтение (клиент отключился), задача отменяется: отмена приходит в самый глубокий
+    await - чтение ответа Ollama - и по порядку закрывает весь стек генераторов цепочки вместе с запросом к Ollama.
+    Закрытие (`aclose`) внешнего генератора `chain.astream` до них не доходит: генераторы tee и transform
+    внутри цепочки остаются приостановленными (и держат слот планировщика), пока их не соберёт сборщик мусора"""
+    queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async with aclosing(chunks) as stream:
+                async for chunk in stream:
+                    queue.put_nowait((chunk, None))
+        except Exception as e:
+            queue.put_nowait((None, e))
+        else:
+            queue.put_nowait((_END_OF_STREAM, None))
+
+    task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            chunk, error = await queue.get()
+            if error is not None:
+                raise error
+            if chunk is _END_OF_STREAM:
+                break
+            yield chunk
+    finally:
+        await close_stream(None, task)
+
+async def coalesce(
+        chunks: AsyncIterable[str],
+        interval: float = STREAM_FLUSH_INTERVAL,
+        max_bytes: int = STREAM_FLUSH_BYTES
+) -> AsyncIterator[str]:
+    """Склейка потока токенов в куски: кусок отдаётся, когда с первого токена в нём прошло `interval` секунд
+    или набралось `max_bytes` байт. Первый токен отдаётся сразу - время до первого токена не растёт.
+    Таймер работает и при паузе в потоке: накопленное не ждёт следующего токена"""
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer, size, deadline = [], 0, None
+    first = True
+    pending = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout = timeout)
+
+            if not done:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if not chunk:
+                continue
+            if first:
+                first = False
+                yield chunk
+                continue
+
+            buffer.append(chunk)
+            size += len(chunk.encode("utf-8"))
+            if deadline is None:
+                deadline = loop.time() + interval
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # Потребитель прекратил чтение (клиент отключился): останавливаем и исходный поток
+        await close_stream(iterator, pending)
+
+async def stop_on_disconnect(
+        chunks: AsyncIterable[str],
+        is_disconnected: Callable[[], Awaitable[bool]],
+        interval: float = STREAM_DISCONNECT_POLL
+) -> AsyncIterator[str]:
+    """Поток `chunks`, прерываемый `ClientDisconnected`, как только `is_disconnected()` вернёт True.
+    Проверка идёт раз в `interval` секунд и между токенами, и пока модели нечего отдать (обработка промпта).
+    Исходный поток при этом закрывается - вместе с ним закрывается и запрос к Ollama, и она прекращает генерацию"""
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    next_check = loop.time() + interval
+    pending = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout = max(0.0, next_check - loop.time()))
+
+            if loop.time() >= next_check:
+                if await is_disconnected():
+                    raise ClientDisconnected()
+                next_check = loop.time() + interval
+            if not done:
+                continue
+
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+            yield chunk
+    finally:
+        await close_stream(iterator, pending)
@@ -0,0 +1,124 @@
+import os
+import time
+import secrets
+import threading
+from typing import Dict, Optional, Tuple
+
+
+class TokenRegistry():
+    """Реестр токенов пользователей, загружаемый из csv один раз в память\n
+    Хранит два словаря (id -> token и token -> id), поэтому проверка токена и поиск
+    токена пользователя выполняются за O(1). Новые токены дописываются в конец файла
+    без его перечитывания. Изменения файла извне (правка руками, замена файла)
+    отслеживаются по inode, mtime и размеру файла - в этом случае реестр перечитывается"""
+    def __init__(self, path: str, check_interval: float = 1.0) -> None:
+        """`path`: путь до csv-файла с токенами (формат `id;token`, первая строка - заголовок)
+
+        `check_interval`: как часто (в секундах) проверять, не изменился ли файл извне.
+        При значении 0 проверка выполняется при каждом обращении"""
+        self.path = path
+        self.check_interval = check_interval
+
+        self._lock = threading.RLock()
+        self._id_to_token: Dict[str, str] = {}
+        self._token_to_id: Dict[str, str] = {}
+        self._file_key: Optional[Tuple[int, int, int]] = None
+        self._last_check = 0.0
+        self._loaded = False
+
+    def _stat_key(self) -> Optional[Tuple[int, int, int]]:
+        """Отпечаток файла: (inode, mtime в наносекундах, размер). None, если файла нет"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _load(self) -> None:
+        """Полное чтение файла с токенами в память"""
+        id_to_token = {}
+        token_to_id = {}
+
+        file_key = self._stat_key()
+        if file_key is not None:
+            with open(self.path, encoding = "utf-8") as f:
+                next(f, None) # Заголовок
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    user_id, _, token = line.partition(";")
+                    id_to_token.setdefault(user_id, token)
+                    token_to_id.setdefault(token, user_id)
+
+        self._id_to_token = id_to_token
+        self._token_to_id = token_to_id
+        self._file_key = file_key
+        self._loaded = True
+
+    def _refresh(self) -> None:
+        """Перечитывание реестра, если файл был изменён извне"""
+        now = time.monotonic()
+        if self._loaded and now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            self._last_check = now
+            if not self._loaded or self._stat_key() != self._file_key:
+                self._load()
+
+    def check(self, token: str) -> bool:
+        """Проверка наличия токена в реестре"""
+        self._refresh()
+        return token in self._token_to_id
+
+    def get_token(self, user_id: str) -> Optional[str]:
+        """Токен пользователя или None, если пользователь не зарегистрирован"""
+        self._refresh()
+        return self._id_to_token.get(user_id)
+
+    def get_user_id(self, token: str) -> Optional[str]:
+        """id пользователя по токену или None, если такого токена нет"""
+        self._refresh()
+        return self._token_to_id.get(token)
+
+    def add(self, user_id: str, token: str = None) -> str:
+        """Регистрация нового токена для пользователя с записью в конец файла"""
+        if token is None:
+            token = secrets.token_hex(16)
+
+        with self._lock:
+            # Перед дозаписью убеждаемся, что в памяти актуальное состояние файла
+            if not self._loaded or self._stat_key() != self._file_key:
+                self._load()
+
+            need_header = self._file_key is None
+            with open(self.path, mode = "a", encoding = "utf-8") as f:
+                if need_header:
+                    f.write("id;token")
+                f.write("\n" + user_id + ";" + token)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._id_to_token.setdefault(user_id, token)
+            self._token_to_id.setdefault(token, user_id)
+            self._file_key = self._stat_key()
+
+        return token
+
+    def get_or_create(self, user_id: str) -> str:
+        """Получение существующего токена пользователя или создание нового"""
+        token = self.get_token(user_id)
+        if token is not None:
+            return token
+
+        with self._lock:
+            # Повторная проверка под блокировкой, чтобы не выдать два токена одному id
+            token = self._id_to_token.get(user_id)
+            if token is None:
+                token = self.add(user_id)
+        return token
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self._id_to_token)
@@ -4,6 +4,10 @@ from langchain_core.runnables import RunnablePassthrough
 from langchain_core.documents import Document
 
 from bairdotr.documents import FaissStoreHandler
+from bairdotr.executors import run_retrieval
+from bairdotr.metrics import get_pipeline_metrics
+from bairdotr.prompt_context import RagContext, assemble_rag_context
+from bairdotr.scheduler import llm_priority
 from bairdotr.config import (
     K_DOCUMENTS_FOR_RAG,
     ENABLE_EXTRA_STEPS,
@@ -22,27 +26,42 @@ from bairdotr.blanks import (
 )
 
 import time
+import asyncio
+import logging
 from collections import Counter
-from typing import Union, List
+from dataclasses import dataclass, field
+from typing import Dict, Union, List
 
-def add_rag_docs_to_question(question: str, retriever_answer: list) -> str:
-    """Добавление к промпту найденные RAGом документы"""
+logger = logging.getLogger(__name__)
+
+def get_rag_context(retriever_answer: Union[List[Document], RagContext]) -> RagContext:
+    """Отрывки для промпта из первых K_DOCUMENTS_FOR_RAG найденных чанков (см. `assemble_rag_context`)"""
+    if isinstance(retriever_answer, RagContext):
+        return retriever_answer
+    return assemble_rag_context(retriever_answer[:K_DOCUMENTS_FOR_RAG])
+
+def add_rag_docs_to_question(question: str, retriever_answer: Union[List[Document], RagContext]) -> str:
+    """Добавление к промпту найденные RAGом документы\n
+    Перекрывающиеся чанки склеиваются, повторы отбрасываются, длина ограничена RAG_CONTEXT_TOKEN_BUDGET"""
+    context = get_rag_context(retriever_answer)
     answer = f"Вопрос пользователя: {question}\nОтрывок из документа, на который можно ориентироваться в случае, если в нём представлена релевантная вопросу пользователя информация (но ни в коем случае не упоминать о том, что документ был предоставлен):\nНАЧАЛО ДОКУМЕНТА\n"
 
-    for i in range(K_DOCUMENTS_FOR_RAG):
-        answer += retriever_answer[i].page_content
+    for passage in context.passages:
+        answer += passage.text
         answer += "\n"
     
     answer += "КОНЕЦ ДОКУМЕНТА\nНапоминаю, что **нельзя** упоминать, что тебе были предоставлены отрывки из документа"
 
     return answer
 
-def merge_documents(retriever_answer: List[Document]) -> str:
+def merge_documents(retriever_answer: Union[List[Document], RagContext]) -> str:
+    """Отрывки, попавшие в промпт, - для показа пользователю"""
+    context = get_rag_context(retriever_answer)
     answer = "Отрывки из документов, найденные ретривером\n\n"
 
-    for i in range(K_DOCUMENTS_FOR_RAG):
-        answer += f"## Открывок {i + 1} из {retriever_answer[i].metadata["source"]}\n\n"
-        answer += retriever_answer[i].page_content
+    for i, passage in enumerate(context.passages):
+        answer += f"## Открывок {i + 1} из {passage.source}\n\n"
+        answer += passage.text
         answer += "\n\n"
     
     return answer
@@ -52,34 +71,81 @@ def question_with_RAG(
         vector_store: FaissStoreHandler, 
         model = None, 
         history = None,
-        need_to_rag_docs_return: bool = False
+        need_to_rag_docs_return: bool = False,
+        sources: List[str] = None
 ) -> str:
-    """Вызов RAG по вопросу пользователя"""
+    """Вызов RAG по вопросу пользователя\n
+    `sources` - искать чанки только в этих исходных файлах (None - во всей базе)"""
     if ENABLE_EXTRA_STEPS:
-        extra_steps = MultipleCall(model, vector_store)
+        extra_steps = MultipleCall(model, vector_store, sources = sources)
         retriever_answer = extra_steps.caller(question, history)
     
     else:
-        retriever_answer = vector_store.similarity_search(question, k = K_DOCUMENTS_FOR_RAG)
+        retriever_answer = vector_store.similarity_search(question, k = K_DOCUMENTS_FOR_RAG, sources = sources)
+    
+    with get_pipeline_metrics().stage("prompt_build"):
+        context = get_rag_context(retriever_answer)
+        answer = add_rag_docs_to_question(question, context)
+        docs = merge_documents(context) if need_to_rag_docs_return else None
+    log_rag_context(context)
+
+    if need_to_rag_docs_return:
+        return answer, docs
+    
+    return answer
+
+async def aquestion_with_RAG(
+        question: str, 
+        vector_store: FaissStoreHandler, 
+        model = None, 
+        history = None,
+        need_to_rag_docs_return: bool = False,
+        sources: List[str] = None
+) -> str:
+    """Асинхронный вариант `question_with_RAG`: вызовы модели через ainvoke,
+    поиск по базе - в пуле потоков поиска, event loop не блокируется"""
+    if ENABLE_EXTRA_STEPS:
+        extra_steps = MultipleCall(model, vector_store, sources = sources)
+        retriever_answer = await extra_steps.acaller(question, history)
+    
+    else:
+        retriever_answer = await run_retrieval(
+            vector_store.similarity_search, question, k = K_DOCUMENTS_FOR_RAG, sources = sources
+        )
     
-    answer = add_rag_docs_to_question(question, retriever_answer)
+    with get_pipeline_metrics().stage("prompt_build"):
+        context = get_rag_context(retriever_answer)
+        answer = add_rag_docs_to_question(question, context)
+        docs = merge_documents(context) if need_to_rag_docs_return else None
+    log_rag_context(context)
 
     if need_to_rag_docs_return:
-        docs = merge_documents(retriever_answer)
         return answer, docs
     
     return answer
 
+def log_rag_context(context: RagContext) -> None:
+    if context.saved_tokens > 0:
+        logger.info(
+            "RAG context: %d -> %d tokens (%d saved; merged %d, duplicates %d, dropped %d, truncated %d)",
+            context.retrieved_tokens, context.tokens, context.saved_tokens,
+            context.merged, context.duplicates, context.dropped, context.truncated
+        )
+
 #---------------------------------
 #---------RAG extra steps---------
 #---------------------------------
 
-def get_top_unique_docs(doc_counts, initial_question_docs, top_n: int = 5):
+def get_top_unique_docs(doc_counts, initial_question_docs, top_n: int = 5, doc_scores: dict = None):
+    initial_question_docs = set(initial_question_docs)
+    doc_scores = doc_scores or {}
+
     sorted_docs = sorted(
         doc_counts.items(),
         key = lambda x: (
             -x[1],
             x[0] not in initial_question_docs,
+            doc_scores.get(x[0], 0.0)
         ),  # Prioritize relevance in case of ties
     )
 
@@ -91,36 +157,31 @@ def get_top_unique_docs(doc_counts, initial_question_docs, top_n: int = 5):
 def rearrange_docs(
         queries: List[str], 
         vector_store: FaissStoreHandler, 
-        need_time_count: bool = False
+        need_time_count: bool = False,
+        sources: List[str] = None
 ) -> List[Document]:
+    """Поиск чанков по всем вариантам вопроса одним батчем и их слияние:
+    выше те чанки, что нашлись по большему числу вариантов, затем найденные по исходному вопросу,
+    затем более близкие к запросу. `sources` - искать только в этих исходных файлах"""
     if need_time_count:
         time_start = time.time()
-    
-    initial_question = queries[0]
-    extracted = []
 
-    initial_retriever_answer = vector_store.similarity_search(
-        initial_question, k=K_DOCUMENTS_FOR_EXTRA_STEPS
-    )
-    initial_ids = [doc.metadata["id"] for doc in initial_retriever_answer]
+    retriever_answers = vector_store.similarity_search_batch(queries, k = K_DOCUMENTS_FOR_EXTRA_STEPS, sources = sources)
 
-    extracted.extend(initial_retriever_answer)
+    initial_ids = [doc.metadata["id"] for doc, _ in retriever_answers[0]]
 
-    for question in queries[1:]:
-        retriever_answer = vector_store.similarity_search(
-            question, k=K_DOCUMENTS_FOR_EXTRA_STEPS
-        )
-        extracted.extend(retriever_answer)
+    source_counts = Counter()
+    best_scores = {}
+    docs_by_id = {}
+    for retriever_answer in retriever_answers:
+        for doc, score in retriever_answer:
+            doc_id = doc.metadata["id"]
+            source_counts[doc_id] += 1
+            best_scores[doc_id] = min(score, best_scores.get(doc_id, score))
+            docs_by_id.setdefault(doc_id, doc)
 
-    source_counts = Counter(doc.metadata["id"] for doc in extracted)
-
-    top_docs_ids = get_top_unique_docs(source_counts, initial_ids)[:K_DOCUMENTS_FOR_RAG]
-
-    final_result = []
-    for i in extracted:
-        if i.metadata["id"] in top_docs_ids:
-            if i not in final_result:
-                final_result.append(i)
+    top_docs_ids = get_top_unique_docs(source_counts, initial_ids, doc_scores = best_scores)[:K_DOCUMENTS_FOR_RAG]
+    final_result = [docs_by_id[doc_id] for doc_id in top_docs_ids]
 
     if need_time_count:
         time_finish = time.time()
@@ -128,50 +189,77 @@ def rearrange_docs(
     
     return final_result
 
+def observe_augmentation(timings: Dict[str, float]) -> None:
+    """Время этапов модификации вопроса - в метрики (этапы augmentation_preprocess, augmentation_hyde и т.д.)"""
+    metrics = get_pipeline_metrics()
+    for stage, seconds in timings.items():
+        metrics.observe_stage(stage if stage.startswith("augmentation") else f"augmentation_{stage}", seconds)
+
+@dataclass
+class AugmentationResult:
+    """Результат модификации вопроса пользователя: варианты вопроса, найденные по ним чанки
+    и время (в секундах) каждого этапа"""
+    queries: List[str]
+    documents: List[Document] = field(default_factory = list)
+    timings: Dict[str, float] = field(default_factory = dict)
+
 class MultipleCall:
     """Класс для реализации модификации вопроса пользователя для RAG-системы"""
-    def __init__(self, model, vector_store: FaissStoreHandler) -> None:
-        """Для работы модуля при инициации необходима модель для генерации и ретривер для получения документов"""
+    def __init__(self, model, vector_store: FaissStoreHandler, sources: List[str] = None) -> None:
+        """Для работы модуля при инициации необходима модель для генерации и ретривер для получения документов\n
+        `sources` - искать чанки только в этих исходных файлах"""
         self.model = model
         self.vectorstore = vector_store
+        self.sources = sources
 
-    def hyde(self, query: str) -> dict:
+    def get_hyde_chain(self):
         prompt = get_hyde_message()
         qa_no_context = prompt | self.model | StrOutputParser()
-        hyde_chain = RunnablePassthrough.assign(hypothetical_document=qa_no_context)
+        return RunnablePassthrough.assign(hypothetical_document=qa_no_context)
+
+    def hyde(self, query: str) -> str:
+        with llm_priority("augmentation"):
+            result = self.get_hyde_chain().invoke({"question": query})
+        return result["hypothetical_document"]
 
-        result = hyde_chain.invoke({"question": query})
+    async def ahyde(self, query: str) -> str:
+        with llm_priority("augmentation"):
+            result = await self.get_hyde_chain().ainvoke({"question": query})
         return result["hypothetical_document"]
 
+    @staticmethod
+    def make_messages(human_message: str, system_m: SystemMessage, history: list = None) -> list:
+        """Сообщения для вызова модели. История пользователя не изменяется"""
+        h_message = HumanMessage(content = human_message)
+
+        if history is None:
+            return [system_m, h_message]
+        else:
+            return history + [h_message]
+
     def generate_answer(
             self, 
             human_message: str, 
             system_m: SystemMessage, 
             history: list = None
     ) -> str:
-        h_message = HumanMessage(content = human_message)
-
-        if history is None:
-            history = [system_m, h_message]
-        else:
-            history.append(h_message)
-        
-        answer = self.model.invoke(history)
+        """Вызов модели для модификации вопроса (класс приоритета "augmentation" - после ответов пользователям)"""
+        with llm_priority("augmentation"):
+            answer = self.model.invoke(self.make_messages(human_message, system_m, history))
         return answer.content
 
-    def caller(
+    async def agenerate_answer(
             self, 
-            query: str, 
-            history: Union[list, None] = None,
-            need_time_count: bool = True
-    ) -> List[Document]:
-        """Создание модифицированных запросов для ретривера и возвращение чанков из базы знаний
-        
-        :params: - query: оригинальный вопрос пользователя\n
-                 - history: история запросов к модели\n  
-                 - need_time_count: debug-параметр, вывод времени, затраченного на модификацию вопроса
+            human_message: str, 
+            system_m: SystemMessage, 
+            history: list = None
+    ) -> str:
+        with llm_priority("augmentation"):
+            answer = await self.model.ainvoke(self.make_messages(human_message, system_m, history))
+        return answer.content
 
-        :returns: Список чанков из базы знаний
+    def augment(self, query: str, history: Union[list, None] = None) -> AugmentationResult:
+        """Последовательная модификация вопроса и поиск чанков по всем его вариантам
         
         Настройка осуществляется через config:
         1) ENABLE_CONTEXT_PARAPHRASE: перефразирование вопроса пользователя с учётом контекста истории (если она есть)
@@ -179,52 +267,114 @@ class MultipleCall:
         3) ENABNLE_HYDE: создание гипотетического отрыка, отвечающего на вопрос пользователя (на основе (1), если доступно)
         4) ENABLE_STEPBACK: генерация более общего вопроса на основе вопроса пользователя.
         """
-        if need_time_count:
-            time1_start = time.time()
+        timings = {}
+        time_start = time.perf_counter()
+
+        def timed(stage: str, func, *args, **kwargs):
+            stage_start = time.perf_counter()
+            result = func(*args, **kwargs)
+            timings[stage] = time.perf_counter() - stage_start
+            return result
 
         # Очистка от мусора
-        query_itself = self.generate_answer(query, get_preprocess_message())
+        query_itself = timed("preprocess", self.generate_answer, query, get_preprocess_message())
 
         # Генерация вопроса с учетом контекста (если он есть)
         if history and ENABLE_CONTEXT_PARAPHRASE:
-            query_context = self.generate_answer(
-                human_message = query_itself, 
-                system_m = get_prompt_with_context(), 
-                history=history
+            query_context = timed(
+                "context_paraphrase", self.generate_answer,
+                human_message = query_itself, system_m = get_prompt_with_context(), history = history
             )
         else:
             query_context = query_itself
 
+        query_augments = [query_context]
+
         # Перефразирование другими словами
         if ENABLE_PARAPHRASE:
-            query_paraphrase = self.generate_answer(
-                human_message = query_context, 
-                system_m = get_paraphrase()
-            )
+            query_augments.append(timed("paraphrase", self.generate_answer, query_context, get_paraphrase()))
 
         # Гипотетический документ
         if ENABNLE_HYDE:
-            query_hyde = self.hyde(query_context)
+            query_augments.append(timed("hyde", self.hyde, query_context))
 
         # Общий вопрос по теме
         if ENABLE_STEPBACK:
-            query_stepback = self.generate_answer(
-                human_message = query_context, 
-                system_m = get_general_question()
-            )
+            query_augments.append(timed("stepback", self.generate_answer, query_context, get_general_question()))
 
-        if need_time_count:
-            time1_finish = time.time()
-            print(f"QUESTION AUGMENTATIONS: {time1_finish-time1_start}")
+        timings["augmentation_total"] = time.perf_counter() - time_start
 
-        query_augments = [query_context, query_paraphrase, query_hyde, query_stepback]
+        documents = timed("retrieval", rearrange_docs, query_augments, self.vectorstore, sources = self.sources)
+        observe_augmentation(timings)
+        return AugmentationResult(queries = query_augments, documents = documents, timings = timings)
 
-        if need_time_count:
-            print("Modified question:")
-            for q in query_augments:
-                print(q)
-                print()
+    async def aaugment(self, query: str, history: Union[list, None] = None) -> AugmentationResult:
+        """Асинхронная модификация вопроса: очистка и перефразирование с учётом контекста
+        выполняются по очереди, а перефразирование, HyDE и общий вопрос (зависят только от
+        вопроса с учётом контекста) - одновременно. Поиск чанков выполняется в пуле потоков поиска"""
+        timings = {}
+        time_start = time.perf_counter()
+
+        async def timed(stage: str, coro):
+            stage_start = time.perf_counter()
+            result = await coro
+            timings[stage] = time.perf_counter() - stage_start
+            return result
+
+        query_itself = await timed("preprocess", self.agenerate_answer(query, get_preprocess_message()))
+
+        if history and ENABLE_CONTEXT_PARAPHRASE:
+            query_context = await timed("context_paraphrase", self.agenerate_answer(
+                human_message = query_itself, system_m = get_prompt_with_context(), history = history
+            ))
+        else:
+            query_context = query_itself
+
+        independent = []
+        if ENABLE_PARAPHRASE:
+            independent.append(timed("paraphrase", self.agenerate_answer(query_context, get_paraphrase())))
+        if ENABNLE_HYDE:
+            independent.append(timed("hyde", self.ahyde(query_context)))
+        if ENABLE_STEPBACK:
+            independent.append(timed("stepback", self.agenerate_answer(query_context, get_general_question())))
+
+        query_augments = [query_context] + list(await asyncio.gather(*independent))
+
+        timings["augmentation_total"] = time.perf_counter() - time_start
 
-        final_k_docs = rearrange_docs(query_augments, self.vectorstore, need_time_count)
+        documents = await timed("retrieval", run_retrieval(rearrange_docs, query_augments, self.vectorstore, sources = self.sources))
+        observe_augmentation(timings)
+        return AugmentationResult(queries = query_augments, documents = documents, timings = timings)
 
-        return final_k_docs
\ No newline at end of file
+    def caller(
+            self, 
+            query: str, 
+            history: Union[list, None] = None,
+            need_time_count: bool = False
+    ) -> List[Document]:
+        """Создание модифицированных запросов для ретривера и возвращение чанков из базы знаний
+        
+        :params: - query: оригинальный вопрос пользователя\n
+                 - history: история запросов к модели\n  
+                 - need_time_count: debug-параметр, логирование времени этапов модификации вопроса
+
+        :returns: Список чанков из базы знаний
+
+        Подробный результат (варианты вопроса и время этапов) возвращает `augment`
+        """
+        result = self.augment(query, history)
+        if need_time_count:
+            logger.info("Question augmentation timings: %s; queries: %s", result.timings, result.queries)
+        return result.documents
+
+    async def acaller(
+            self, 
+            query: str, 
+            history: Union[list, None] = None,
+            need_time_count: bool = False
+    ) -> List[Document]:
+        """Асинхронный вариант `caller`, этапы модификации выполняются конкурентно (см. `aaugment`)"""
+        result = await self.aaugment(query, history)
+        if need_time_count:
+            logger.info("Question augmentation timings: %s; queries: %s", result.timings, result.queries)
+        return result.documents
@@ -0,0 +1,169 @@
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+
+import os
+import json
+import mmap
+from collections.abc import Mapping
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+from bairdotr.store_manifest import MANIFEST_FILE
+
+# Формат хранилища без pickle:
+# - index.faiss  - faiss-индекс (открывается через mmap)
+# - chunks.bin   - тексты и метаданные чанков, JSON-записи подряд, по одной на позицию в индексе
+# - chunks.idx   - int64-смещения записей в chunks.bin (n + 1 значение), пустая запись - удалённый чанк
+# - storage.json - описание формата и число записей
+STORAGE_META_FILE = "storage.json"
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.bin"
+OFFSETS_FILE = "chunks.idx"
+STORAGE_FORMAT = "mmap-v1"
+
+
+def is_mmap_store(folder: str) -> bool:
+    """Сохранено ли хранилище в mmap-формате"""
+    return os.path.isfile(os.path.join(folder, STORAGE_META_FILE))
+
+def store_version(folder: str) -> Tuple[Tuple[str, int, int, int], ...]:
+    """Отпечаток сохранённой базы: (имя, inode, mtime, размер) файлов индекса и чанков.
+    Меняется при любом пересохранении базы (файлы подменяются через os.replace)"""
+    version = []
+    # index.pkl - docstore базы, сохранённой через FAISS.save_local
+    for name in (INDEX_FILE, CHUNKS_FILE, STORAGE_META_FILE, "index.pkl", MANIFEST_FILE):
+        try:
+            stat = os.stat(os.path.join(folder, name))
+        except FileNotFoundError:
+            continue
+        version.append((name, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+def encode_document(doc: Optional[Document]) -> bytes:
+    if doc is None:
+        return b""
+    return json.dumps(
+        {"id": doc.id, "page_content": doc.page_content, "metadata": doc.metadata},
+        ensure_ascii = False
+    ).encode("utf-8")
+
+def decode_document(data: bytes) -> Optional[Document]:
+    if not data:
+        return None
+    record = json.loads(data)
+    return Document(id = record["id"], page_content = record["page_content"], metadata = record["metadata"])
+
+def write_mmap_store(folder: str, index: faiss.Index, documents: Iterable[Optional[Document]]) -> None:
+    """Сохранение индекса и чанков (чанк на каждую позицию индекса, None - удалённая позиция)\n
+    Файлы пишутся во временные и подменяются через os.replace, поэтому процессы, которые уже
+    открыли старую версию через mmap, продолжают работать с ней. Атомарна подмена каждого файла
+    по отдельности, но не всех четырёх сразу: загрузка во время сохранения может застать файлы
+    разных версий (`ChunkStore` и `FaissStoreHandler` в этом случае падают с ValueError),
+    поэтому базу загружают после завершения сохранения"""
+    os.makedirs(folder, exist_ok = True)
+    tmp = ".tmp"
+
+    offsets = [0]
+    with open(os.path.join(folder, CHUNKS_FILE + tmp), "wb") as f:
+        for doc in documents:
+            f.write(encode_document(doc))
+            offsets.append(f.tell())
+
+    if len(offsets) - 1 != index.ntotal:
+        raise ValueError(f"Got {len(offsets) - 1} documents for an index with {index.ntotal} vectors")
+
+    np.asarray(offsets, dtype = np.int64).tofile(os.path.join(folder, OFFSETS_FILE + tmp))
+    faiss.write_index(index, os.path.join(folder, INDEX_FILE + tmp))
+    with open(os.path.join(folder, STORAGE_META_FILE + tmp), "w", encoding = "utf-8") as f:
+        json.dump({"format": STORAGE_FORMAT, "count": index.ntotal}, f)
+
+    for name in (CHUNKS_FILE, OFFSETS_FILE, INDEX_FILE, STORAGE_META_FILE):
+        os.replace(os.path.join(folder, name + tmp), os.path.join(folder, name))
+
+def mmap_flags(index_type: str) -> int:
+    """Флаги чтения faiss-индекса через mmap: для IVF отображаются инвертированные списки,
+    для плоского и HNSW - массив векторов (IO_FLAG_MMAP_IFC, если есть в этой версии faiss)"""
+    if index_type.startswith("ivf"):
+        flag = faiss.IO_FLAG_MMAP
+    else:
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return flag | faiss.IO_FLAG_READ_ONLY
+
+def read_index(folder: str, index_type: str, use_mmap: bool = True) -> faiss.Index:
+    """Чтение faiss-индекса, по возможности через mmap (страницы общие для всех процессов)"""
+    path = os.path.join(folder, INDEX_FILE)
+    if use_mmap:
+        try:
+            return faiss.read_index(path, mmap_flags(index_type))
+        except RuntimeError as e:
+            print(f"Faiss index can't be memory-mapped, reading it into memory: {e}")
+    return faiss.read_index(path)
+
+
+class ChunkStore(Docstore):
+    """Чанки из `chunks.bin`, читаемые лениво через mmap только для найденных позиций\n
+    Ключ для `search` - позиция вектора в индексе (строкой)"""
+    def __init__(self, folder: str) -> None:
+        with open(os.path.join(folder, STORAGE_META_FILE), encoding = "utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != STORAGE_FORMAT:
+            raise ValueError(f"Unsupported vector store format: {meta.get('format')}")
+
+        self.count = meta["count"]
+        self._offsets = np.memmap(os.path.join(folder, OFFSETS_FILE), dtype = np.int64, mode = "r")
+        if len(self._offsets) != self.count + 1:
+            raise ValueError(f"{OFFSETS_FILE} has {len(self._offsets) - 1} records, {STORAGE_META_FILE} expects {self.count}")
+        self.deleted_count = int(np.count_nonzero(np.diff(self._offsets) == 0))
+
+        self._file = open(os.path.join(folder, CHUNKS_FILE), "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self._data = b""
+
+    def is_deleted(self, position: int) -> bool:
+        return self._offsets[position + 1] == self._offsets[position]
+
+    def get(self, position: int) -> Optional[Document]:
+        """Чанк на позиции индекса или None, если позиции нет или чанк удалён"""
+        if position < 0 or position >= self.count:
+            return None
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        return decode_document(self._data[start:end])
+
+    def search(self, search: str) -> Union[str, Document]:
+        try:
+            doc = self.get(int(search))
+        except ValueError:
+            doc = None
+        if doc is None:
+            return f"ID {search} not found."
+        return doc
+
+    def documents(self) -> Iterator[Tuple[int, Optional[Document]]]:
+        """Все позиции с чанками (None - удалённые позиции)"""
+        for position in range(self.count):
+            yield position, self.get(position)
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class PositionIdMap(Mapping):
+    """Отображение позиция -> ключ `ChunkStore` без хранения словаря в памяти"""
+    def __init__(self, chunk_store: ChunkStore) -> None:
+        self.chunk_store = chunk_store
+
+    def __getitem__(self, position: int) -> str:
+        if position < 0 or position >= len(self.chunk_store) or self.chunk_store.is_deleted(position):
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self) -> Iterator[int]:
+        for position in range(len(self.chunk_store)):
+            if not self.chunk_store.is_deleted(position):
+                yield position
+
+    def __len__(self) -> int:
+        return len(self.chunk_store) - self.chunk_store.deleted_count
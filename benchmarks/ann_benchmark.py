@@ -0,0 +1,164 @@
+"""Отчёт recall@k / задержка для ANN-индексов faiss относительно точного плоского индекса
+
+Запуск из корня репозитория:
+
+.. code-block:: bash
+
+    # на синтетических векторах
+    python -m benchmarks.ann_benchmark --n 100000 --dim 1024
+    # на векторах уже собранной базы (берутся из index.faiss плоского индекса)
+    python -m benchmarks.ann_benchmark --store data/mirea_faiss_index --output ann_report.json
+"""
+import faiss
+import numpy as np
+
+import os
+import json
+import time
+import argparse
+from dataclasses import replace
+from typing import List
+
+from bairdotr.faiss_index import IndexParams, train_index
+
+
+def synthetic_vectors(n: int, dim: int, n_clusters: int, seed: int) -> np.ndarray:
+    """Кластеризованные нормированные векторы (похожи на эмбеддинги текстов больше, чем равномерный шум)"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, n)
+    vectors = centers[labels] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def store_vectors(path: str) -> np.ndarray:
+    """Векторы из сохранённого хранилища (индекс должен поддерживать reconstruct)"""
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    return index.reconstruct_n(0, index.ntotal)
+
+def make_queries(corpus: np.ndarray, n_queries: int, seed: int) -> np.ndarray:
+    """Запросы - случайные векторы корпуса с шумом (запрос похож на документ, но не совпадает с ним)"""
+    rng = np.random.default_rng(seed + 1)
+    picked = corpus[rng.choice(len(corpus), n_queries, replace = len(corpus) < n_queries)]
+    queries = picked + 0.1 * rng.standard_normal(picked.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+    return np.ascontiguousarray(queries, dtype = np.float32)
+
+def measure(index: faiss.Index, queries: np.ndarray, k: int, ground_truth: np.ndarray) -> dict:
+    """recall@k и задержки одиночных запросов (как в API - по одному запросу)"""
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+        found.append(ids[0])
+
+    recall = np.mean([
+        len(set(row.tolist()) & set(truth.tolist())) / k for row, truth in zip(found, ground_truth)
+    ])
+    latencies = np.array(latencies) * 1000
+    return {
+        "recall_at_k": float(recall),
+        "latency_ms_mean": float(latencies.mean()),
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+        "latency_ms_p99": float(np.percentile(latencies, 99))
+    }
+
+def default_grid(n: int, dim: int) -> List[IndexParams]:
+    nlist = int(min(4 * np.sqrt(n), max(1, n // 39)))
+    pq_m = next(m for m in (64, 32, 16, 8, 4, 2, 1) if dim % m == 0)
+    grid = []
+    for nprobe in (1, 4, 16, 64):
+        grid.append(IndexParams(index_type = "ivf_flat", nlist = nlist, nprobe = nprobe))
+    for nprobe in (4, 16, 64):
+        grid.append(IndexParams(index_type = "ivf_pq", nlist = nlist, nprobe = nprobe, pq_m = pq_m))
+    for ef_search in (16, 32, 64, 128):
+        grid.append(IndexParams(index_type = "hnsw", ef_search = ef_search))
+    return grid
+
+def run(corpus: np.ndarray, queries: np.ndarray, k: int, grid: List[IndexParams]) -> dict:
+    dim = corpus.shape[1]
+
+    flat = faiss.IndexFlatL2(dim)
+    flat.add(corpus)
+    _, ground_truth = flat.search(queries, k)
+
+    report = {
+        "n_vectors": int(len(corpus)),
+        "dim": int(dim),
+        "n_queries": int(len(queries)),
+        "k": k,
+        "results": [dict(index_type = "flat", build_s = 0.0, **measure(flat, queries, k, ground_truth))]
+    }
+
+    # Индексы с одинаковыми параметрами построения строятся один раз, меняется только параметр поиска
+    built = {}
+    for params in grid:
+        build_key = json.dumps(replace(params, nprobe = 0, ef_search = 0).to_dict(), sort_keys = True)
+        if build_key not in built:
+            start = time.perf_counter()
+            rng = np.random.default_rng(0)
+            n_train = min(len(corpus), max(params.min_train_points(), 10000))
+            index, fitted = train_index(dim, params, corpus[rng.choice(len(corpus), n_train, replace = False)])
+            index.add(corpus)
+            built[build_key] = (index, fitted, time.perf_counter() - start)
+
+        index, fitted, build_s = built[build_key]
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = params.ef_search
+        else:
+            faiss.extract_index_ivf(index).nprobe = min(params.nprobe, fitted.nlist)
+
+        result = replace(fitted, nprobe = params.nprobe, ef_search = params.ef_search).to_dict()
+        result["build_s"] = build_s
+        result.update(measure(index, queries, k, ground_truth))
+        report["results"].append(result)
+
+    return report
+
+def print_report(report: dict) -> None:
+    print(f"{report['n_vectors']} vectors, dim = {report['dim']}, {report['n_queries']} queries, k = {report['k']}")
+    print(f"{'index':<10}{'nlist':>7}{'nprobe':>8}{'ef':>6}{'recall':>9}{'p50 ms':>9}{'p95 ms':>9}{'build s':>9}")
+    for r in report["results"]:
+        is_ivf = r["index_type"].startswith("ivf")
+        print(
+            f"{r['index_type']:<10}"
+            f"{r['nlist'] if is_ivf else '-':>7}"
+            f"{r['nprobe'] if is_ivf else '-':>8}"
+            f"{r['ef_search'] if r['index_type'] == 'hnsw' else '-':>6}"
+            f"{r['recall_at_k']:>9.3f}{r['latency_ms_p50']:>9.3f}{r['latency_ms_p95']:>9.3f}{r['build_s']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "recall@k vs latency for faiss index types")
+    parser.add_argument("--store", default = None, help = "path to a saved vector store (flat index)")
+    parser.add_argument("--n", type = int, default = 50000, help = "number of synthetic vectors")
+    parser.add_argument("--dim", type = int, default = 1024, help = "dimension of synthetic vectors")
+    parser.add_argument("--clusters", type = int, default = 200, help = "clusters in synthetic data")
+    parser.add_argument("--queries", type = int, default = 200)
+    parser.add_argument("--k", type = int, default = 10)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "path to write the JSON report")
+    args = parser.parse_args()
+
+    if args.store is not None:
+        corpus = store_vectors(args.store)
+    else:
+        corpus = synthetic_vectors(args.n, args.dim, args.clusters, args.seed)
+    corpus = np.ascontiguousarray(corpus, dtype = np.float32)
+
+    queries = make_queries(corpus, args.queries, args.seed)
+    report = run(corpus, queries, args.k, default_grid(len(corpus), corpus.shape[1]))
+    print_report(report)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(report, f, indent = 2)
+        print(f"Report saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Время импорта модулей проекта по данным `python -X importtime`: общее время
+и самые дорогие зависимости. Каждый модуль импортируется в отдельном чистом процессе
+
+Запуск из корня репозитория:
+
+.. code-block:: bash
+
+    python -m benchmarks.import_profile
+    # проверка на регрессию: код возврата 1, если какой-то импорт дольше бюджета
+    python -m benchmarks.import_profile --budget bairdotr=50 --budget api_activation=3000 --output import_report.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from typing import Dict, List
+
+# По умолчанию: сам пакет (должен импортироваться почти мгновенно), config и модуль API,
+# импорт которого задерживает открытие порта uvicorn
+DEFAULT_MODULES = ["bairdotr", "bairdotr.config", "api_activation"]
+
+
+def run_importtime(code: str, root: str) -> List[dict]:
+    """Строки отчёта `-X importtime` в порядке импорта: модуль, глубина вложенности, собственное и накопленное время (мс)"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root, os.path.join(root, "api_backend"), env.get("PYTHONPATH", "")])
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env = env,
+        capture_output = True,
+        text = True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{code} failed:\n{result.stderr[-2000:]}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append({
+            "module": name.strip(),
+            # Имя отделено одним пробелом, каждый уровень вложенности добавляет ещё два
+            "level": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000
+        })
+    return rows
+
+def import_time(module: str, root: str) -> List[dict]:
+    """Строки отчёта для `import module` без модулей, которые интерпретатор импортирует при запуске"""
+    n_startup = len(run_importtime("pass", root))
+    return run_importtime(f"import {module}", root)[n_startup:]
+
+def summarize(module: str, rows: List[dict], top: int) -> dict:
+    """Время импорта модуля и `top` самых дорогих пакетов, которые он импортирует"""
+    total = sum(row["cumulative_ms"] for row in rows if row["level"] == 0)
+
+    # Прямые зависимости модуля (и родительские пакеты вроде bairdotr для bairdotr.config), сгруппированные по пакету
+    packages: Dict[str, float] = {}
+    for row in rows:
+        if row["module"] == module or row["level"] > 1:
+            continue
+        package = row["module"].split(".")[0]
+        packages[package] = packages.get(package, 0.0) + row["cumulative_ms"]
+
+    heaviest = sorted(packages.items(), key = lambda item: item[1], reverse = True)[:top]
+    return {
+        "module": module,
+        "total_ms": total,
+        "n_modules": len(rows),
+        "heaviest": [{"package": package, "cumulative_ms": ms} for package, ms in heaviest]
+    }
+
+def print_report(reports: List[dict]) -> None:
+    for report in reports:
+        print(f"import {report['module']}: {report['total_ms']:.0f} ms, {report['n_modules']} modules")
+        for item in report["heaviest"]:
+            print(f"    {item['package']:<32}{item['cumulative_ms']:>10.0f} ms")
+
+def parse_budgets(budgets: List[str]) -> Dict[str, float]:
+    result = {}
+    for budget in budgets:
+        module, ms = budget.split("=")
+        result[module] = float(ms)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "import-time profile of the package and the API module")
+    parser.add_argument("modules", nargs = "*", default = DEFAULT_MODULES)
+    parser.add_argument("--top", type = int, default = 10, help = "number of heaviest packages to show")
+    parser.add_argument("--budget", action = "append", default = [], help = "module=milliseconds, fail if exceeded")
+    parser.add_argument("--output", default = None, help = "path to write the JSON report")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    reports = [summarize(module, import_time(module, root), args.top) for module in args.modules]
+    print_report(reports)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(reports, f, indent = 2)
+        print(f"Report saved in {args.output}")
+
+    budgets = parse_budgets(args.budget)
+    exceeded = [r for r in reports if r["module"] in budgets and r["total_ms"] > budgets[r["module"]]]
+    for report in exceeded:
+        print(f"Import of {report['module']} takes {report['total_ms']:.0f} ms, budget is {budgets[report['module']]:.0f} ms")
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Пропускная способность и пиковая память загрузки документа: прежняя реализация
+(весь файл в одной строке, шесть проходов regex, список всех чанков) против потоковой `iter_split_file`
+
+Запуск из корня репозитория:
+
+.. code-block:: bash
+
+    # на синтетическом тексте заданного размера
+    python -m benchmarks.ingest_benchmark --size-mb 50
+    # на реальном файле
+    python -m benchmarks.ingest_benchmark --file data/docs/just_cleaned/book.txt --output ingest_report.json
+"""
+import os
+import re
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from typing import Callable, List
+from uuid import uuid4
+
+from langchain_core.documents import Document
+
+from bairdotr.documents import get_splitter, iter_split_file
+
+
+def legacy_preprocess_re(text: str) -> str:
+    """Очистка текста в том виде, в каком она была до потоковой загрузки"""
+    cleaned_text = re.sub(r"[^а-яёА-Я-Z0-9.,\n \-:!;?\[\]\(\)]", "", text)
+    cleaned_text = re.sub(r"[`*~{}=<>##§]", " ", cleaned_text)
+    cleaned_text = re.sub(r"\/\/\.\.", " ", cleaned_text)
+    cleaned_text = re.sub(r"([а-я])-\s+([а-я])", r"\1\2", cleaned_text)
+    cleaned_text = re.sub(r"\n", " ", cleaned_text)
+    cleaned_text = re.sub(r"\s+ ", " ", cleaned_text)
+    return cleaned_text
+
+def legacy_load_and_split_file(path_to_file: str, source_name: str, splitter_type: str) -> List[Document]:
+    """Загрузка и деление документа в том виде, в каком они были до потоковой загрузки"""
+    splitter = get_splitter(splitter_type)
+    with open(path_to_file, encoding = "utf8") as f:
+        document_original = f.read()
+
+    if splitter_type != "standard":
+        document_original = legacy_preprocess_re(document_original)
+
+    document_split = splitter.create_documents(texts = [document_original], metadatas = [{"source": source_name}])
+    for doc in document_split:
+        doc.metadata["id"] = str(uuid4())
+    return document_split
+
+def streaming_load_and_split_file(path_to_file: str, source_name: str, splitter_type: str) -> int:
+    """Потоковая загрузка: чанки не накапливаются, как при добавлении в базу пачками"""
+    return sum(1 for _ in iter_split_file(path_to_file, source_name, splitter_type))
+
+def synthetic_text(size_mb: float, seed: int) -> str:
+    """Текст, похожий на учебник после конвертации: русские слова, переносы, мусорные символы"""
+    rng = random.Random(seed)
+    words = [
+        "функция", "значение", "определение", "теорема", "доказательство", "пример", "учеб-\nник",
+        "мате- матика", "рис. 1", "(см. выше)", "т.д.", "§5", "x = y", "___", "вопрос?", "и", "в", "на"
+    ]
+    target = int(size_mb * 1024 * 1024)
+    parts, length = [], 0
+    while length < target:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(5, 15)))
+        line += "\n\n" if rng.random() < 0.1 else "\n"
+        parts.append(line)
+        length += len(line.encode("utf8"))
+    return "".join(parts)
+
+def measure(load: Callable, path: str, splitter_type: str) -> dict:
+    """Время (без tracemalloc, он замедляет работу) и пиковая память (отдельным прогоном)"""
+    start = time.perf_counter()
+    result = load(path, "benchmark", splitter_type)
+    elapsed = time.perf_counter() - start
+    n_chunks = result if isinstance(result, int) else len(result)
+    del result
+
+    tracemalloc.start()
+    load(path, "benchmark", splitter_type)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    return {
+        "seconds": elapsed,
+        "mb_per_s": size_mb / elapsed,
+        "chunks": n_chunks,
+        "peak_memory_mb": peak / 1024 / 1024
+    }
+
+def run(path: str, splitter_type: str) -> dict:
+    return {
+        "file_mb": os.path.getsize(path) / 1024 / 1024,
+        "splitter": splitter_type,
+        "legacy": measure(legacy_load_and_split_file, path, splitter_type),
+        "streaming": measure(streaming_load_and_split_file, path, splitter_type)
+    }
+
+def print_report(report: dict) -> None:
+    print(f"file: {report['file_mb']:.1f} MB, splitter = {report['splitter']}")
+    print(f"{'implementation':<16}{'seconds':>9}{'MB/s':>9}{'chunks':>9}{'peak MB':>10}")
+    for name in ("legacy", "streaming"):
+        r = report[name]
+        print(f"{name:<16}{r['seconds']:>9.2f}{r['mb_per_s']:>9.2f}{r['chunks']:>9}{r['peak_memory_mb']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "legacy vs streaming document ingestion throughput")
+    parser.add_argument("--file", default = None, help = "path to a text document")
+    parser.add_argument("--size-mb", type = float, default = 20, help = "size of synthetic text")
+    parser.add_argument("--splitter", default = "recursive", choices = ["recursive", "standard"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "path to write the JSON report")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        report = run(args.file, args.splitter)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "synthetic.txt")
+            with open(path, "w", encoding = "utf8") as f:
+                f.write(synthetic_text(args.size_mb, args.seed))
+            report = run(path, args.splitter)
+    print_report(report)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(report, f, indent = 2)
+        print(f"Report saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
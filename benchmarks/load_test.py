@@ -0,0 +1,326 @@
+"""Нагрузочный тест API: много одновременных сессий через `/chat/completions`, `/stream_chat/` и `/ws/chat/`\n
+Для каждого уровня конкурентности (`--concurrency 1 2 4 8 ...`) виртуальные пользователи в течение
+`--duration` секунд ведут диалоги по `--turns` вопросов. Отчёт по уровню: пропускная способность, доля ошибок,
+перцентили задержки и времени до первого байта (для потоковых - и до первого токена ответа), задержка
+по номеру хода диалога (рост истории) и среднее время этапов конвейера из /metrics за время уровня.
+Уровень, после которого пропускная способность почти не растёт, - "колено" одного воркера API.
+
+Без GPU API можно направить на заглушку Ollama:
+
+.. code-block:: bash
+
+    python -m benchmarks.ollama_stub --port 11434 --ttft 0.3 --tps 40 --parallel 4 &
+    OLLAMA_BASE_URL=http://localhost:11434 python api_backend/api_activation.py &
+    python -m benchmarks.load_test --endpoint stream --concurrency 1 2 4 8 16 32 --duration 30 --output load_report.json
+
+Повторяющиеся первые вопросы отвечаются из семантического кеша: чтобы нагружать генерацию,
+выключите ANSWER_CACHE_ENABLED в config или смотрите на долю ответов `cached` в /metrics
+"""
+import numpy as np
+import httpx
+import websockets
+
+import json
+import time
+import random
+import asyncio
+import argparse
+from uuid import uuid4
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+TEMPLATES = [
+    "Что такое {}?",
+    "Объясни простыми словами, что такое {}",
+    "Приведи пример, где используется {}",
+    "Как связаны {} и предел функции?",
+    "Какие свойства есть у понятия {}?",
+    "Почему важна {} в математическом анализе?",
+    "Расскажи историю появления понятия {}",
+    "Как вычислить {} на практике?"
+]
+TOPICS = [
+    "производная", "интеграл", "ряд Тейлора", "матрица", "определитель", "собственный вектор",
+    "дифференциальное уравнение", "предел последовательности", "непрерывность", "градиент",
+    "частная производная", "комплексное число", "векторное пространство", "линейное отображение",
+    "ряд Фурье", "кратный интеграл", "криволинейный интеграл", "экстремум функции", "выпуклость",
+    "асимптота", "теорема Лагранжа", "правило Лопиталя", "норма вектора", "ортогональность"
+]
+# Ответы API при отказе (см. OVERLOADED_TEXT, NOT_READY_TEXT в api_activation)
+REJECTION_MARKERS = {"Сервер перегружен": "overloaded", "Сервер запускается": "not_ready"}
+
+
+@dataclass
+class TurnResult:
+    endpoint: str
+    turn: int
+    latency: float
+    ttfb: Optional[float] = None
+    ttft: Optional[float] = None
+    error: Optional[str] = None
+
+
+def make_question(rng: random.Random) -> str:
+    return rng.choice(TEMPLATES).format(rng.choice(TOPICS))
+
+def rejection(text: str) -> Optional[str]:
+    for marker, kind in REJECTION_MARKERS.items():
+        if text.startswith(marker):
+            return kind
+    return None
+
+
+async def completions_turn(client: httpx.AsyncClient, token: str, session_id: str, question: str, turn: int) -> TurnResult:
+    start = time.perf_counter()
+    async with client.stream(
+        "POST", "/chat/completions", headers = {"token": token}, json = {"question": question, "session_id": session_id}
+    ) as response:
+        ttfb = time.perf_counter() - start
+        body = await response.aread()
+    latency = time.perf_counter() - start
+
+    if response.status_code != 200:
+        return TurnResult("completions", turn, latency, ttfb, error = f"http_{response.status_code}")
+    code = json.loads(body).get("response")
+    error = None if code == 200 else {503: "overloaded"}.get(code, f"response_{code}")
+    return TurnResult("completions", turn, latency, ttfb, error = error)
+
+async def stream_turn(client: httpx.AsyncClient, token: str, session_id: str, question: str, turn: int) -> TurnResult:
+    start = time.perf_counter()
+    ttfb, ttft, text = None, None, ""
+    async with client.stream("POST", "/stream_chat/", json = {"question": question, "session_id": session_id}) as response:
+        ttfb = time.perf_counter() - start
+        if response.status_code != 200:
+            # 503 с Retry-After - быстрый отказ планировщика вызовов модели
+            text = (await response.aread()).decode("utf-8", errors = "replace")
+            error = rejection(text) if response.status_code == 503 else None
+            return TurnResult("stream", turn, time.perf_counter() - start, ttfb, error = error or f"http_{response.status_code}")
+        async for chunk in response.aiter_text():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+            text += chunk
+            if "END_OF_STREAM" in text:
+                break
+    latency = time.perf_counter() - start
+
+    if "END_OF_STREAM" not in text:
+        return TurnResult("stream", turn, latency, ttfb, ttft, error = "no_end_of_stream")
+    return TurnResult("stream", turn, latency, ttfb, ttft, error = rejection(text))
+
+async def ws_turn(ws, question: str, turn: int) -> TurnResult:
+    """Один ход по websocket; кадры протокола "delta" ({"type": ...}) и события "events" ({"event": ...})"""
+    start = time.perf_counter()
+    ttfb, ttft = None, None
+    await ws.send(json.dumps({"message": question}, ensure_ascii = False))
+    while True:
+        message = json.loads(await ws.recv())
+        now = time.perf_counter() - start
+        if ttfb is None:
+            ttfb = now
+        kind = message.get("type") or message.get("event")
+        if kind == "error":
+            return TurnResult("ws", turn, now, ttfb, ttft, error = message.get("name", "error"))
+        if kind in ("delta", "on_parser_stream") and ttft is None:
+            ttft = now
+        if kind in ("end", "on_parser_end"):
+            return TurnResult("ws", turn, now, ttfb, ttft)
+
+async def virtual_user(
+        endpoint: str,
+        client: httpx.AsyncClient,
+        ws_url: str,
+        token: str,
+        turns: int,
+        deadline: float,
+        timeout: float,
+        rng: random.Random,
+        results: List[TurnResult]
+) -> None:
+    """Диалоги по `turns` вопросов подряд до дедлайна. Для /ws/chat/ диалог - отдельное соединение"""
+    while time.monotonic() < deadline:
+        session_id = uuid4().hex
+        ws = None
+        try:
+            if endpoint == "ws":
+                ws = await websockets.connect(ws_url, open_timeout = timeout, max_size = None)
+
+            for turn in range(turns):
+                if time.monotonic() >= deadline:
+                    break
+                question = make_question(rng)
+                start = time.perf_counter()
+                try:
+                    if endpoint == "completions":
+                        coro = completions_turn(client, token, session_id, question, turn)
+                    elif endpoint == "stream":
+                        coro = stream_turn(client, token, session_id, question, turn)
+                    else:
+                        coro = ws_turn(ws, question, turn)
+                    result = await asyncio.wait_for(coro, timeout)
+                except Exception as e:
+                    result = TurnResult(endpoint, turn, time.perf_counter() - start, error = type(e).__name__)
+                results.append(result)
+                if result.error is not None and endpoint == "ws" and result.error not in REJECTION_MARKERS.values():
+                    break
+
+        except Exception as e:
+            results.append(TurnResult(endpoint, 0, 0.0, error = type(e).__name__))
+            await asyncio.sleep(0.1)
+        finally:
+            if ws is not None:
+                await ws.close()
+
+
+def percentiles(values: List[float], prefix: str) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = np.array(values) * 1000
+    return {f"{prefix}_ms_{p}": float(np.percentile(values, int(p[1:]))) for p in ("p50", "p90", "p99")}
+
+def parse_stage_metrics(text: str) -> Dict[str, List[float]]:
+    """Сумма и число наблюдений по этапам из bairdotr_stage_seconds (формат Prometheus)"""
+    stages = {}
+    for line in text.splitlines():
+        for suffix, position in (("_sum", 0), ("_count", 1)):
+            prefix = f"bairdotr_stage_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                stage = line[len(prefix):line.index("\"}")]
+                stages.setdefault(stage, [0.0, 0.0])[position] = float(line.rsplit(" ", 1)[1])
+    return stages
+
+async def scrape_stages(client: httpx.AsyncClient) -> Dict[str, List[float]]:
+    try:
+        response = await client.get("/metrics")
+        return parse_stage_metrics(response.text)
+    except Exception:
+        return {}
+
+def stage_means(before: Dict[str, List[float]], after: Dict[str, List[float]]) -> Dict[str, dict]:
+    """Среднее время этапов (мс) за интервал между двумя снимками /metrics"""
+    means = {}
+    for stage, (total, count) in after.items():
+        old_total, old_count = before.get(stage, [0.0, 0.0])
+        if count > old_count:
+            means[stage] = {"mean_ms": (total - old_total) / (count - old_count) * 1000, "count": int(count - old_count)}
+    return means
+
+def summarize(results: List[TurnResult], duration: float) -> dict:
+    ok = [r for r in results if r.error is None]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r.error is not None:
+            errors[r.error] = errors.get(r.error, 0) + 1
+
+    by_turn = {}
+    for r in ok:
+        by_turn.setdefault(r.turn, []).append(r.latency)
+
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "throughput_rps": len(ok) / duration,
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": errors
+    }
+    summary.update(percentiles([r.latency for r in ok], "latency"))
+    summary.update(percentiles([r.ttfb for r in ok if r.ttfb is not None], "ttfb"))
+    summary.update(percentiles([r.ttft for r in ok if r.ttft is not None], "ttft"))
+    summary["latency_ms_mean_by_turn"] = {turn: float(np.mean(v) * 1000) for turn, v in sorted(by_turn.items())}
+    return summary
+
+def find_knee(levels: List[dict], min_gain: float = 0.1) -> Optional[int]:
+    """Уровень конкурентности, после которого пропускная способность растёт меньше чем на `min_gain`"""
+    for previous, current in zip(levels, levels[1:]):
+        if previous["throughput_rps"] > 0 and current["throughput_rps"] < previous["throughput_rps"] * (1 + min_gain):
+            return previous["concurrency"]
+    return None
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/readyz")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(1)
+    raise TimeoutError(f"API is not ready after {timeout} seconds")
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections = max(args.concurrency) * 2, max_keepalive_connections = max(args.concurrency) * 2)
+    async with httpx.AsyncClient(base_url = args.url, timeout = args.timeout, limits = limits) as client:
+        await wait_ready(client, args.ready_timeout)
+        token = (await client.get("/registry", params = {"user_id": "load_test"})).json()["token"]
+        ws_url = args.url.replace("http", "ws", 1) + f"/ws/chat/?protocol={args.ws_protocol}"
+
+        levels = []
+        for concurrency in args.concurrency:
+            print(f"concurrency {concurrency}: {args.duration} s of {args.endpoint}...")
+            rng = random.Random(args.seed + concurrency)
+            results: List[TurnResult] = []
+            before = await scrape_stages(client)
+
+            start = time.monotonic()
+            deadline = start + args.duration
+            await asyncio.gather(*[
+                virtual_user(
+                    args.endpoint, client, ws_url, token, args.turns, deadline, args.timeout,
+                    random.Random(rng.random()), results
+                )
+                for _ in range(concurrency)
+            ])
+            # Запросы, начатые до дедлайна, дожидаются окончания - в длительность уровня входит и это время
+            duration = time.monotonic() - start
+
+            level = {"concurrency": concurrency, "duration_s": duration}
+            level.update(summarize(results, duration))
+            level["stages"] = stage_means(before, await scrape_stages(client))
+            levels.append(level)
+            print_level(level)
+
+    return {
+        "url": args.url,
+        "endpoint": args.endpoint,
+        "ws_protocol": args.ws_protocol,
+        "turns": args.turns,
+        "levels": levels,
+        "knee_concurrency": find_knee(levels)
+    }
+
+def print_level(level: dict) -> None:
+    print(
+        f"  {level['throughput_rps']:.2f} rps, errors {level['error_rate']:.1%} {level['errors'] or ''}, "
+        f"latency p50/p99 {level.get('latency_ms_p50', 0):.0f}/{level.get('latency_ms_p99', 0):.0f} ms, "
+        f"ttfb p50 {level.get('ttfb_ms_p50', 0):.0f} ms, ttft p50 {level.get('ttft_ms_p50', 0):.0f} ms"
+    )
+    for stage, value in sorted(level["stages"].items()):
+        print(f"    {stage:<32}{value['mean_ms']:>10.1f} ms x {value['count']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "load test of the chat API with many concurrent sessions")
+    parser.add_argument("--url", default = "http://localhost:1702")
+    parser.add_argument("--endpoint", default = "stream", choices = ["completions", "stream", "ws"])
+    parser.add_argument("--ws-protocol", default = "delta", choices = ["delta", "events"], help = "response format of /ws/chat/")
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = [1, 2, 4, 8, 16, 32])
+    parser.add_argument("--duration", type = float, default = 30, help = "seconds per concurrency level")
+    parser.add_argument("--turns", type = int, default = 3, help = "questions per dialog")
+    parser.add_argument("--timeout", type = float, default = 300, help = "seconds per request")
+    parser.add_argument("--ready-timeout", type = float, default = 600, help = "seconds to wait for /readyz")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "path to write the JSON report")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(f"Knee of throughput at concurrency {report['knee_concurrency']}")
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(report, f, indent = 2, ensure_ascii = False)
+        print(f"Report saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Заглушка Ollama для нагрузочного тестирования API без GPU\n
+Реализует `/api/chat` (потоковый и обычный ответ) в формате Ollama с настраиваемым временем
+до первого токена и скоростью генерации. `--parallel` ограничивает число одновременно генерируемых
+ответов, остальные ждут в очереди - как Ollama с OLLAMA_NUM_PARALLEL
+
+С `--prefill-tps` время до первого токена зависит от длины промпта, и, как в Ollama, каждый слот помнит
+последний промпт с ответом: общее с ним начало нового промпта повторно не обрабатывается (KV-кеш префикса)
+
+Запуск из корня репозитория:
+
+.. code-block:: bash
+
+    python -m benchmarks.ollama_stub --port 11434 --ttft 0.3 --tps 40 --tokens 200 --parallel 4
+    # API, направленный на заглушку
+    OLLAMA_BASE_URL=http://localhost:11434 python api_backend/api_activation.py
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+WORDS = (
+    "функция производная предел интеграл значит что поэтому например таким образом "
+    "определение теорема следует из того это можно показать рассмотрим случай"
+).split()
+
+
+class StubSettings():
+    """Параметры генерации заглушки\n
+    - ttft: время до первого токена (секунды), включает обработку промпта
+    - tps: токенов в секунду после первого
+    - tokens: длина ответа в токенах (± `jitter` долей)
+    - parallel: сколько ответов генерируется одновременно
+    - prefill_tps: скорость обработки промпта (токенов в секунду), None - время до первого токена не зависит от промпта.
+      Токены промпта оцениваются по длине текста (`chars_per_token`)
+    """
+    def __init__(
+            self,
+            ttft: float = 0.3,
+            tps: float = 40.0,
+            tokens: int = 200,
+            jitter: float = 0.2,
+            parallel: int = 4,
+            prefill_tps: float = None,
+            chars_per_token: float = 3.5
+    ) -> None:
+        self.ttft = ttft
+        self.tps = tps
+        self.tokens = tokens
+        self.jitter = jitter
+        self.parallel = parallel
+        self.prefill_tps = prefill_tps
+        self.chars_per_token = chars_per_token
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+def render_messages(messages: list) -> str:
+    """Промпт одной строкой (как шаблон чата): общее начало двух промптов - общий префикс в KV-кеше"""
+    return "".join(f"<{message.get('role')}>{message.get('content', '')}</{message.get('role')}>" for message in messages)
+
+def make_app(settings: StubSettings) -> FastAPI:
+    app = FastAPI()
+    slots = asyncio.Semaphore(settings.parallel)
+    # Последний промпт с ответом в каждом слоте и свободные слоты
+    slot_prompts = [""] * settings.parallel
+    free_slots = set(range(settings.parallel))
+    stats = {
+        "requests": 0, "active": 0, "queued": 0,
+        "prompt_tokens": 0, "cached_prompt_tokens": 0, "num_ctx": None, "num_ctx_changes": 0,
+        "generated_tokens": 0, "aborted": 0
+    }
+
+    def take_slot(prompt: str) -> int:
+        """Свободный слот с самым длинным общим началом кеша и промпта (так выбирает слот Ollama)"""
+        slot = max(free_slots, key = lambda i: len(os.path.commonprefix([slot_prompts[i], prompt])))
+        free_slots.remove(slot)
+        return slot
+
+    def track_num_ctx(options: dict) -> None:
+        num_ctx = (options or {}).get("num_ctx")
+        if num_ctx is None:
+            return
+        if stats["num_ctx"] is not None and num_ctx != stats["num_ctx"]:
+            stats["num_ctx_changes"] += 1
+        stats["num_ctx"] = num_ctx
+
+    def n_tokens(options: dict) -> int:
+        n = round(settings.tokens * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+        num_predict = (options or {}).get("num_predict")
+        if num_predict is not None and num_predict > 0:
+            n = min(n, num_predict)
+        return max(n, 1)
+
+    def final_chunk(model: str, n: int, prompt_eval: float, eval_duration: float, content: str = "", prompt_eval_count: int = 100) -> dict:
+        return {
+            "model": model,
+            "created_at": now_iso(),
+            "message": {"role": "assistant", "content": content},
+            "done_reason": "stop",
+            "done": True,
+            "total_duration": int((prompt_eval + eval_duration) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": prompt_eval_count,
+            "prompt_eval_duration": int(prompt_eval * 1e9),
+            "eval_count": n,
+            "eval_duration": int(eval_duration * 1e9)
+        }
+
+    async def generate(model: str, n: int, messages: list):
+        """Токены ответа: первый - через ttft (плюс обработка не закешированной части промпта),
+        остальные - со скоростью tps. Если клиент закрыл соединение, генерация прекращается (как в Ollama)"""
+        prompt = render_messages(messages)
+        stats["queued"] += 1
+        async with slots:
+            stats["queued"] -= 1
+            stats["active"] += 1
+            slot = take_slot(prompt)
+            finished = False
+            try:
+                start = time.perf_counter()
+                cached = len(os.path.commonprefix([slot_prompts[slot], prompt]))
+                prompt_tokens = round(len(prompt) / settings.chars_per_token)
+                new_tokens = max(1, round((len(prompt) - cached) / settings.chars_per_token))
+                stats["prompt_tokens"] += prompt_tokens
+                stats["cached_prompt_tokens"] += prompt_tokens - new_tokens
+
+                prefill = new_tokens / settings.prefill_tps if settings.prefill_tps else 0.0
+                await asyncio.sleep(settings.ttft + prefill)
+                first = time.perf_counter()
+                answer = []
+                for i in range(n):
+                    if i > 0:
+                        await asyncio.sleep(1 / settings.tps)
+                    answer.append(random.choice(WORDS) + " ")
+                    stats["generated_tokens"] += 1
+                    yield answer[-1]
+                end = time.perf_counter()
+                slot_prompts[slot] = prompt + render_messages([{"role": "assistant", "content": "".join(answer)}])
+                finished = True
+                yield final_chunk(model, n, first - start, end - first, prompt_eval_count = new_tokens)
+            finally:
+                if not finished:
+                    stats["aborted"] += 1
+                free_slots.add(slot)
+                stats["active"] -= 1
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        model = body.get("model", "stub")
+        n = n_tokens(body.get("options"))
+        track_num_ctx(body.get("options"))
+        messages = body.get("messages", [])
+
+        if body.get("stream", True):
+            async def stream():
+                async for item in generate(model, n, messages):
+                    if isinstance(item, dict):
+                        yield json.dumps(item) + "\n"
+                    else:
+                        yield json.dumps({
+                            "model": model,
+                            "created_at": now_iso(),
+                            "message": {"role": "assistant", "content": item},
+                            "done": False
+                        }, ensure_ascii = False) + "\n"
+            return StreamingResponse(stream(), media_type = "application/x-ndjson")
+
+        parts = []
+        final = None
+        async for item in generate(model, n, messages):
+            if isinstance(item, dict):
+                final = item
+            else:
+                parts.append(item)
+        final["message"]["content"] = "".join(parts)
+        return JSONResponse(final)
+
+    @app.get("/api/tags")
+    def tags():
+        return {"models": [{"name": "stub", "model": "stub", "modified_at": now_iso(), "size": 0, "details": {}}]}
+
+    @app.get("/api/version")
+    def version():
+        return {"version": "0.0.0-stub"}
+
+    @app.get("/stub/stats")
+    def stub_stats():
+        """Запросы всего, генерируемые сейчас и ожидающие слота, токены промптов (всего и взятых из кеша),
+        последний num_ctx и число его смен (в Ollama каждая смена перезагружает модель),
+        сгенерированные токены и генерации, прерванные отключением клиента"""
+        return stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Ollama-compatible stub server for load testing")
+    parser.add_argument("--host", default = "0.0.0.0")
+    parser.add_argument("--port", type = int, default = 11434)
+    parser.add_argument("--ttft", type = float, default = 0.3, help = "seconds to the first token")
+    parser.add_argument("--tps", type = float, default = 40.0, help = "tokens per second after the first one")
+    parser.add_argument("--tokens", type = int, default = 200, help = "answer length in tokens")
+    parser.add_argument("--jitter", type = float, default = 0.2, help = "relative spread of the answer length")
+    parser.add_argument("--parallel", type = int, default = 4, help = "answers generated at the same time")
+    parser.add_argument("--prefill-tps", type = float, default = None, help = "prompt tokens processed per second (enables prefix cache simulation)")
+    args = parser.parse_args()
+
+    settings = StubSettings(
+        ttft = args.ttft,
+        tps = args.tps,
+        tokens = args.tokens,
+        jitter = args.jitter,
+        parallel = args.parallel,
+        prefill_tps = args.prefill_tps
+    )
+    uvicorn.run(make_app(settings), host = args.host, port = args.port, log_level = "warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""Офлайн-бенчмарк основных этапов пакета bairdotr: без сети, GPU и настоящих моделей\n
+Эмбеддинги - детерминированное хеширование слов, модель чата - FakeListChatModel из langchain_core,
+корпус - синтетический русский текст. Замеряются:
+
+- load_and_split_file: пропускная способность (МБ/с) на корпусах разного размера
+- FaissStoreHandler.add_documents и similarity_search / similarity_search_batch на индексах разного размера
+- rearrange_docs и MultipleCall.augment (доп. шаги с фейковой моделью)
+- read_hot_history / write_hot_history и история сессии для RunnableWithMessageHistory на диалогах разной длины
+- check_token на реестрах разного размера
+
+Результат - JSON. Сравнение с прошлым прогоном: `--compare` печатает ухудшения больше `--tolerance`
+и завершается с кодом 1, если они есть.
+
+Запуск из корня репозитория:
+
+.. code-block:: bash
+
+    python -m benchmarks.pipeline_benchmark --output bench_main.json
+    python -m benchmarks.pipeline_benchmark --compare bench_main.json --tolerance 0.2
+    # быстрый прогон
+    python -m benchmarks.pipeline_benchmark --quick
+"""
+import numpy as np
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import platform
+import tempfile
+from typing import Callable, Dict, List
+from uuid import uuid4
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from benchmarks.ingest_benchmark import synthetic_text
+
+
+WORDS = (
+    "функция значение определение теорема доказательство пример учебник матрица вектор интеграл "
+    "производная предел ряд уравнение система множество граница последовательность алгоритм программа "
+    "сеть данные модель обучение студент экзамен кафедра лекция семинар практика задача решение ответ"
+).split()
+
+
+class HashEmbeddings(Embeddings):
+    """Детерминированные эмбеддинги без модели: слова хешируются в координаты вектора (со знаком),
+    вектор нормируется. Похожие по словам тексты получают близкие векторы"""
+    def __init__(self, dim: int = 256) -> None:
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype = np.float32)
+        for word in text.lower().split():
+            h = zlib.crc32(word.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 1 << 31 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm > 0 else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def synthetic_sentence(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+def synthetic_chunks(n: int, seed: int) -> List[Document]:
+    rng = random.Random(seed)
+    return [
+        Document(
+            page_content = synthetic_sentence(rng, rng.randint(60, 120)),
+            metadata = {"source": f"book_{i % 20}.txt", "id": str(uuid4())}
+        )
+        for i in range(n)
+    ]
+
+def latency_stats(latencies: List[float]) -> Dict[str, float]:
+    latencies = np.array(latencies) * 1000
+    return {
+        "latency_ms_mean": float(latencies.mean()),
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+        "latency_ms_p99": float(np.percentile(latencies, 99))
+    }
+
+def time_calls(func: Callable, args_list: list) -> Dict[str, float]:
+    """Задержки вызовов `func(*args)` по одному на каждый элемент `args_list`"""
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return latency_stats(latencies)
+
+
+def bench_ingest(folder: str, sizes_mb: List[float], seed: int) -> dict:
+    from bairdotr.documents import load_and_split_file
+
+    results = {}
+    for size_mb in sizes_mb:
+        path = os.path.join(folder, f"corpus_{size_mb}mb.txt")
+        with open(path, "w", encoding = "utf8") as f:
+            f.write(synthetic_text(size_mb, seed))
+        real_mb = os.path.getsize(path) / 1024 / 1024
+
+        for splitter in ("recursive", "standard"):
+            start = time.perf_counter()
+            chunks = load_and_split_file(path, "benchmark", splitter)
+            elapsed = time.perf_counter() - start
+            results[f"{size_mb}mb_{splitter}"] = {
+                "file_mb": real_mb,
+                "chunks": len(chunks),
+                "seconds": elapsed,
+                "mb_per_s": real_mb / elapsed
+            }
+    return results
+
+def bench_vector_store(index_sizes: List[int], n_queries: int, seed: int) -> dict:
+    from bairdotr.documents import FaissStoreHandler
+
+    embeddings = HashEmbeddings()
+    rng = random.Random(seed + 1)
+    queries = [synthetic_sentence(rng, rng.randint(5, 15)) for _ in range(n_queries)]
+
+    results = {}
+    for size in index_sizes:
+        chunks = synthetic_chunks(size, seed)
+        vector_store = FaissStoreHandler(embeddings)
+
+        start = time.perf_counter()
+        vector_store.add_documents(chunks)
+        elapsed = time.perf_counter() - start
+
+        search = time_calls(vector_store.similarity_search, [(q, 3) for q in queries])
+        batch = time_calls(
+            vector_store.similarity_search_batch, [(queries[i:i + 4], 5) for i in range(0, len(queries), 4)]
+        )
+        results[f"{size}_chunks"] = {
+            "add_documents_seconds": elapsed,
+            "add_documents_per_s": size / elapsed,
+            "similarity_search": search,
+            "similarity_search_batch_4": batch
+        }
+    return results
+
+def bench_extra_steps(index_size: int, n_queries: int, seed: int) -> dict:
+    from bairdotr.documents import FaissStoreHandler
+    from bairdotr.tools import MultipleCall, rearrange_docs
+
+    vector_store = FaissStoreHandler(HashEmbeddings())
+    vector_store.add_documents(synthetic_chunks(index_size, seed))
+
+    rng = random.Random(seed + 2)
+    query_sets = [[synthetic_sentence(rng, rng.randint(5, 15)) for _ in range(4)] for _ in range(n_queries)]
+
+    # Фейковая модель отвечает мгновенно: замеряется только накладная часть доп. шагов, без генерации
+    model = FakeListChatModel(responses = [synthetic_sentence(rng, 20) for _ in range(16)])
+    extra_steps = MultipleCall(model, vector_store)
+    history = [HumanMessage(content = "вопрос"), AIMessage(content = "ответ")]
+
+    return {
+        "index_chunks": index_size,
+        "rearrange_docs_4_queries": time_calls(rearrange_docs, [(queries, vector_store) for queries in query_sets]),
+        "augment_fake_llm": time_calls(extra_steps.augment, [(queries[0], history) for queries in query_sets])
+    }
+
+def make_dialog(length: int, seed: int) -> list:
+    rng = random.Random(seed)
+    messages = []
+    for i in range(length):
+        message_class = HumanMessage if i % 2 == 0 else AIMessage
+        messages.append(message_class(content = synthetic_sentence(rng, 40 if i % 2 == 0 else 150)))
+    return messages
+
+def bench_history(lengths: List[int], n_sessions: int, seed: int) -> dict:
+    from bairdotr.session_history import SessionHistoryStore
+    from bairdotr.database_management import (
+        read_hot_history,
+        write_hot_history,
+        get_hot_history_store,
+        get_session_history_with_local_file
+    )
+
+    results = {}
+    for length in lengths:
+        dialog = make_dialog(length, seed)
+        sessions = [f"bench_{length}_{i}" for i in range(n_sessions)]
+
+        # Первая запись - вся история, затем - по одному новому ходу (как в API)
+        write_full = time_calls(write_hot_history, [(s, dialog) for s in sessions])
+        write_turn = time_calls(
+            write_hot_history, [(s, dialog + [HumanMessage(content = "ещё вопрос"), AIMessage(content = "ответ")]) for s in sessions]
+        )
+        read_warm = time_calls(read_hot_history, [(s,) for s in sessions])
+
+        # Холодное чтение - новое хранилище на том же файле, без кеша сессий
+        cold_store = SessionHistoryStore(get_hot_history_store().db_path)
+        read_cold = time_calls(cold_store.get, [(s,) for s in sessions])
+        cold_store.close()
+
+        chat_histories = [get_session_history_with_local_file(s) for s in sessions]
+        for chat_history in chat_histories:
+            chat_history.add_messages(dialog)
+        add_turn = time_calls(
+            lambda h: h.add_messages([HumanMessage(content = "ещё вопрос"), AIMessage(content = "ответ")]),
+            [(h,) for h in chat_histories]
+        )
+        session_read = time_calls(lambda h: h.messages, [(h,) for h in chat_histories])
+
+        results[f"{length}_messages"] = {
+            "write_hot_history_full": write_full,
+            "write_hot_history_turn": write_turn,
+            "read_hot_history_warm": read_warm,
+            "read_hot_history_cold": read_cold,
+            "session_history_add_turn": add_turn,
+            "session_history_read": session_read
+        }
+    return results
+
+def bench_tokens(registry_sizes: List[int], n_checks: int, seed: int) -> dict:
+    from bairdotr.config import DATA_FOLDER, CSV_TOKENS_NAME
+    from bairdotr import database_management
+    from bairdotr.database_management import check_token
+
+    # check_token - тот же путь, что у API: общий реестр из get_token_registry и стадия token_check в метриках
+    # Путь БД токенов в config относительный, а бенчмарк запускается во временной папке
+    path = DATA_FOLDER + "/" + CSV_TOKENS_NAME
+    os.makedirs(DATA_FOLDER, exist_ok = True)
+
+    rng = random.Random(seed + 3)
+    results = {}
+    for size in registry_sizes:
+        tokens = [f"{rng.getrandbits(128):032x}" for _ in range(size)]
+        with open(path, "w", encoding = "utf-8") as f:
+            f.write("id;token")
+            for i, token in enumerate(tokens):
+                f.write(f"\n{i};{token}")
+
+        # Реестр создаётся заново, чтобы первая проверка измеряла загрузку файла этого размера
+        database_management._TOKEN_REGISTRIES.pop(path, None)
+        start = time.perf_counter()
+        check_token(tokens[0])
+        load = time.perf_counter() - start
+
+        known = [(tokens[rng.randrange(size)],) for _ in range(n_checks)]
+        unknown = [(f"{rng.getrandbits(128):032x}",) for _ in range(n_checks)]
+        results[f"{size}_tokens"] = {
+            "load_seconds": load,
+            "check_token_known": time_calls(check_token, known),
+            "check_token_unknown": time_calls(check_token, unknown)
+        }
+    return results
+
+
+def flatten(report: dict, prefix: str = "") -> Dict[str, float]:
+    """Плоский словарь `раздел.подраздел.метрика -> значение` для сравнения прогонов"""
+    flat = {}
+    for key, value in report.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Ухудшения относительно `baseline`: медианная задержка (`latency_ms_p50`) выросла
+    или пропускная способность (`*_per_s`) упала больше чем на `tolerance`.
+    Хвосты (p95, p99) и одиночные замеры слишком шумные для автоматической проверки, они только сохраняются в отчёте"""
+    current, previous = flatten(report["results"]), flatten(baseline["results"])
+    regressions = []
+    for name, value in current.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        metric = name.rsplit(".", 1)[-1]
+        if metric == "latency_ms_p50":
+            change = value / old - 1
+        elif metric.endswith("_per_s"):
+            change = old / value - 1 if value else float("inf")
+        else:
+            continue
+        if change > tolerance:
+            regressions.append(f"{name}: {old:.4g} -> {value:.4g} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "offline benchmark of bairdotr pipeline stages (fake embeddings and LLM)")
+    parser.add_argument("--corpus-mb", type = float, nargs = "+", default = [1, 5, 20])
+    parser.add_argument("--index-sizes", type = int, nargs = "+", default = [1000, 10000, 50000])
+    parser.add_argument("--history-lengths", type = int, nargs = "+", default = [2, 12, 50, 200])
+    parser.add_argument("--registry-sizes", type = int, nargs = "+", default = [100, 10000, 100000])
+    parser.add_argument("--queries", type = int, default = 200, help = "calls per latency measurement")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--quick", action = "store_true", help = "small sizes for a smoke run")
+    parser.add_argument("--output", default = None, help = "path to write the JSON report")
+    parser.add_argument("--compare", default = None, help = "JSON report of a previous run")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "allowed relative slowdown")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.corpus_mb, args.index_sizes, args.history_lengths, args.registry_sizes = [0.5], [1000], [2, 12], [100, 10000]
+        args.queries = 50
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        # Пути истории и токенов в config относительные: все файлы бенчмарка - во временной папке
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            print("load_and_split_file...")
+            results["ingest"] = bench_ingest(folder, args.corpus_mb, args.seed)
+            print("FaissStoreHandler...")
+            results["vector_store"] = bench_vector_store(args.index_sizes, args.queries, args.seed)
+            print("Extra steps...")
+            results["extra_steps"] = bench_extra_steps(min(args.index_sizes), args.queries, args.seed)
+            print("History...")
+            results["history"] = bench_history(args.history_lengths, args.queries, args.seed)
+            print("Tokens...")
+            results["tokens"] = bench_tokens(args.registry_sizes, args.queries * 10, args.seed)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args)
+        },
+        "results": results
+    }
+    print(json.dumps(results, indent = 2))
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump(report, f, indent = 2)
+        print(f"Report saved in {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, encoding = "utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
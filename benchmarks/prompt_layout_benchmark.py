@@ -0,0 +1,168 @@
+"""Время до первого токена в многоходовых диалогах при раскладках промпта "legacy" и "prefix_cache"\n
+Каждая сессия задаёт несколько вопросов подряд через `aget_model_answer_rag`, история между ходами
+обрабатывается так же, как в API (`clean_history` + `cut_history`). Сессии идут одновременно.
+Время до первого токена и число обработанных токенов промпта берутся из ответа Ollama
+(load_duration + prompt_eval_duration, prompt_eval_count): Ollama не пересчитывает начало промпта,
+совпадающее с закешированным в слоте, так что разница раскладок видна прямо в этих числах.
+
+По умолчанию запросы идут в заглушку Ollama (benchmarks/ollama_stub.py), которая моделирует
+обработку промпта со скоростью `--prefill-tps` и KV-кеш префикса в каждом слоте. С `--ollama-url`
+замер идёт на настоящей Ollama.
+
+Запуск из корня репозитория:
+
+.. code-block:: bash
+
+    python -m benchmarks.prompt_layout_benchmark --sessions 4 --turns 8
+    python -m benchmarks.prompt_layout_benchmark --ollama-url http://localhost:11434 --model gemma2 --output layout.json
+"""
+import numpy as np
+
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import threading
+from typing import Dict, List
+
+import uvicorn
+from langchain_ollama import ChatOllama
+
+from bairdotr.documents import FaissStoreHandler
+from bairdotr.llm_wrapper import aget_model_answer_rag, clean_history, cut_history
+from bairdotr.prompt_layout import get_context_sizer
+from benchmarks.ollama_stub import StubSettings, make_app
+from benchmarks.pipeline_benchmark import HashEmbeddings, synthetic_chunks, synthetic_sentence
+
+
+LAYOUTS = ("legacy", "prefix_cache")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_stub(settings: StubSettings) -> str:
+    """Заглушка Ollama в фоновом потоке. Возвращает её адрес"""
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(make_app(settings), host = "127.0.0.1", port = port, log_level = "warning"))
+    threading.Thread(target = server.run, daemon = True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+async def run_session(model, vector_store: FaissStoreHandler, questions: List[str], layout: str) -> List[dict]:
+    """Диалог из `questions`: замеры каждого хода"""
+    history = None
+    turns = []
+    for question in questions:
+        start = time.perf_counter()
+        _, history = await aget_model_answer_rag(
+            human_message = question,
+            model = model,
+            vector_store = vector_store,
+            history = history,
+            layout = layout
+        )
+        latency = time.perf_counter() - start
+        metadata = history[-1].response_metadata
+
+        turns.append({
+            "ttft": (metadata.get("load_duration", 0) + metadata.get("prompt_eval_duration", 0)) / 1e9,
+            "prompt_eval_count": metadata.get("prompt_eval_count", 0),
+            "latency": latency
+        })
+        history = cut_history(clean_history(history), layout)
+    return turns
+
+def summarize(sessions: List[List[dict]]) -> Dict[str, object]:
+    n_turns = max(len(turns) for turns in sessions)
+    by_turn = []
+    for i in range(n_turns):
+        turn = [turns[i] for turns in sessions if i < len(turns)]
+        by_turn.append({
+            "turn": i + 1,
+            "ttft_ms_mean": float(np.mean([t["ttft"] for t in turn]) * 1000),
+            "prompt_eval_count_mean": float(np.mean([t["prompt_eval_count"] for t in turn]))
+        })
+
+    flat = [t for turns in sessions for t in turns]
+    later = [t for turns in sessions for t in turns[1:]]
+    return {
+        "ttft_ms_mean": float(np.mean([t["ttft"] for t in flat]) * 1000),
+        "ttft_ms_p50": float(np.percentile([t["ttft"] for t in flat], 50) * 1000),
+        # Первый ход одинаков при любой раскладке, разница - в последующих
+        "ttft_ms_mean_after_first_turn": float(np.mean([t["ttft"] for t in later]) * 1000) if later else None,
+        "prompt_eval_tokens_total": int(sum(t["prompt_eval_count"] for t in flat)),
+        "latency_ms_mean": float(np.mean([t["latency"] for t in flat]) * 1000),
+        "by_turn": by_turn
+    }
+
+async def bench_layout(model, vector_store: FaissStoreHandler, layout: str, n_sessions: int, n_turns: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    dialogs = [[synthetic_sentence(rng, rng.randint(8, 20)) + "?" for _ in range(n_turns)] for _ in range(n_sessions)]
+    sessions = await asyncio.gather(*(run_session(model, vector_store, questions, layout) for questions in dialogs))
+    return summarize(sessions)
+
+async def bench_layouts(model, vector_store: FaissStoreHandler, n_sessions: int, n_turns: int, seed: int) -> dict:
+    """Все раскладки в одном event loop (асинхронный клиент ChatOllama привязан к нему)"""
+    results = {}
+    for layout in LAYOUTS:
+        print(f"{layout}...")
+        results[layout] = await bench_layout(model, vector_store, layout, n_sessions, n_turns, seed)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "time to first token of multi-turn sessions: legacy vs prefix_cache prompt layout")
+    parser.add_argument("--ollama-url", default = None, help = "real Ollama; by default an in-process stub is started")
+    parser.add_argument("--model", default = "gemma2")
+    parser.add_argument("--sessions", type = int, default = 4, help = "concurrent dialogs")
+    parser.add_argument("--turns", type = int, default = 8, help = "questions per dialog")
+    parser.add_argument("--answer-tokens", type = int, default = 120, help = "num_predict of every answer")
+    parser.add_argument("--chunks", type = int, default = 2000, help = "synthetic chunks in the vector store")
+    parser.add_argument("--prefill-tps", type = float, default = 800.0, help = "stub: prompt tokens processed per second")
+    parser.add_argument("--tps", type = float, default = 200.0, help = "stub: generated tokens per second")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "path to write the JSON report")
+    args = parser.parse_args()
+
+    base_url = args.ollama_url
+    if base_url is None:
+        base_url = start_stub(StubSettings(
+            ttft = 0.02,
+            tps = args.tps,
+            tokens = args.answer_tokens,
+            jitter = 0.0,
+            parallel = args.sessions,
+            prefill_tps = args.prefill_tps
+        ))
+        print(f"Ollama stub started at {base_url}")
+
+    model = ChatOllama(model = args.model, base_url = base_url, num_predict = args.answer_tokens, keep_alive = -1)
+    vector_store = FaissStoreHandler(HashEmbeddings())
+    vector_store.add_documents(synthetic_chunks(args.chunks, args.seed))
+
+    results = asyncio.run(bench_layouts(model, vector_store, args.sessions, args.turns, args.seed))
+    results["num_ctx"] = get_context_sizer(args.model).current
+
+    legacy, prefix = results["legacy"]["ttft_ms_mean_after_first_turn"], results["prefix_cache"]["ttft_ms_mean_after_first_turn"]
+    if legacy and prefix:
+        results["ttft_speedup_after_first_turn"] = legacy / prefix
+
+    print(json.dumps(results, indent = 2))
+    for layout in LAYOUTS:
+        per_turn = " ".join(f"{turn['ttft_ms_mean']:.0f}" for turn in results[layout]["by_turn"])
+        print(f"{layout:>12} TTFT by turn, ms: {per_turn}")
+
+    if args.output is not None:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent = 2)
+        print(f"Report saved in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
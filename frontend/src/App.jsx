@@ -18,8 +18,9 @@ const StreamLangchain = () => {
     // Function to setup the WebSocket connection and define event handlers
     const setupWebSocket = () => {
         // ws.current = new WebSocket('ws://127.0.0.1:8000/ws/chat/');
-        ws.current = new WebSocket('ws://localhost:1702/ws/chat/');
+        ws.current = new WebSocket('ws://localhost:1702/ws/chat/?protocol=delta');
         let ongoingStream = null; // To track the ongoing stream's ID
+        let answerCounter = 0;
 
         ws.current.onopen = () => {
             console.log("WebSocket connected!");
@@ -27,20 +28,26 @@ const StreamLangchain = () => {
         };
 
         ws.current.onmessage = (event) => {
+            // Compact delta protocol: {"type": "context" | "start" | "delta" | "end" | "error", "delta": text}
             const data = JSON.parse(event.data);
-            let sender = data.name;
-
-            // Handle different types of events from the WebSocket
-            if (data.event === 'on_parser_start') {
-                // When a new stream starts
-                ongoingStream = { id: data.run_id, content: '' };
-                setResponses(prevResponses => [...prevResponses, { sender, message: '', id: data.run_id }]);
-            } else if (data.event === 'rag_system') {
-                setResponses(prevResponses => [...prevResponses, { sender, message: data.data, id: data.run_id }]);
-            } else if (data.event === 'on_parser_stream' && ongoingStream && data.run_id === ongoingStream.id) {
-                // During a stream, appending new chunks of data
+            const text = data.delta || '';
+
+            if (data.type === 'context') {
+                setResponses(prevResponses => [...prevResponses, { sender: 'RAG', message: text, id: 'rag_system' }]);
+            } else if (data.type === 'start') {
+                // When a new answer starts
+                ongoingStream = { id: `answer-${++answerCounter}` };
+                const id = ongoingStream.id;
+                setResponses(prevResponses => [...prevResponses, { sender: 'Bairdotr', message: '', id }]);
+            } else if (data.type === 'delta' && ongoingStream) {
+                // During a stream, appending new chunks of text
+                const id = ongoingStream.id;
                 setResponses(prevResponses => prevResponses.map(msg =>
-                    msg.id === data.run_id ? { ...msg, message: msg.message + data.data.chunk } : msg));
+                    msg.id === id ? { ...msg, message: msg.message + text } : msg));
+            } else if (data.type === 'end') {
+                ongoingStream = null;
+            } else if (data.type === 'error') {
+                setResponses(prevResponses => [...prevResponses, { sender: 'Bairdotr', message: text, id: data.name }]);
             }
         };
 
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(scope = "session", autouse = True)
+def workdir(tmp_path_factory):
+    """Все данные (история, кеши, токены) пишутся по относительным путям из config - во временную папку"""
+    path = tmp_path_factory.mktemp("workdir")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(path)
+        yield path
@@ -0,0 +1,80 @@
+import errno
+import os
+import time
+
+from bairdotr import cold_history
+from bairdotr.cold_history import ColdHistoryWriter
+
+
+def read_numbers(folder) -> list:
+    numbers = []
+    for name in ColdHistoryWriter(str(folder)).list_segments():
+        with open(os.path.join(folder, name), encoding = "utf-8") as f:
+            numbers += [int(line.split(";", 1)[0]) for line in f]
+    return numbers
+
+def make_writer(folder) -> ColdHistoryWriter:
+    return ColdHistoryWriter(str(folder), flush_interval = 0.01, retry_interval = 0.05)
+
+
+def test_records_are_numbered_in_order(tmp_path):
+    writer = make_writer(tmp_path)
+    for i in range(5):
+        writer.write("token", f"вопрос {i}\nвторая строка", i, f"ответ {i}")
+    writer.close()
+    assert read_numbers(tmp_path) == list(range(10))
+
+    writer = make_writer(tmp_path)
+    assert writer.write("token", "вопрос", 0, "ответ") == (10, 11)
+    writer.close()
+
+def test_failed_batch_is_written_on_retry(tmp_path, monkeypatch):
+    fsync = os.fsync
+    failures = []
+
+    def failing_fsync(fd):
+        if len(failures) < 2:
+            failures.append(fd)
+            raise OSError(errno.ENOSPC, "No space left on device")
+        fsync(fd)
+
+    monkeypatch.setattr(cold_history.os, "fsync", failing_fsync)
+    writer = make_writer(tmp_path)
+    writer.write("token", "вопрос 1", 0, "ответ 1")
+    writer.flush()
+    assert read_numbers(tmp_path) == []
+
+    # Пачка дописывается повторными попытками в фоне
+    deadline = time.monotonic() + 5
+    while read_numbers(tmp_path) != [0, 1] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.write("token", "вопрос 2", 0, "ответ 2")
+    writer.close()
+
+    assert len(failures) == 2
+    # Ни одна запись не потеряна и не записана дважды
+    assert read_numbers(tmp_path) == [0, 1, 2, 3]
+
+def test_pending_records_are_capped(tmp_path, monkeypatch):
+    def failing_fsync(fd):
+        raise OSError(errno.EIO, "I/O error")
+
+    monkeypatch.setattr(cold_history.os, "fsync", failing_fsync)
+    writer = ColdHistoryWriter(str(tmp_path), flush_interval = 0.01, retry_interval = 0, max_pending = 4)
+    for i in range(4):
+        writer.write("token", f"вопрос {i}", 0, f"ответ {i}")
+        writer.flush()
+    monkeypatch.undo()
+    writer.close()
+
+    # Остались последние max_pending записей, недописанные куски обрезаны
+    assert read_numbers(tmp_path) == [4, 5, 6, 7]
+
+def test_atexit_handler_is_registered_once(tmp_path, monkeypatch):
+    registered = []
+    monkeypatch.setattr(cold_history.atexit, "register", registered.append)
+    writer = make_writer(tmp_path)
+    for _ in range(3):
+        writer.start()
+        writer.close()
+    assert registered == [writer.close]
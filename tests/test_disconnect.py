@@ -0,0 +1,80 @@
+import time
+import threading
+
+import httpx
+import pytest
+
+uvloop = pytest.importorskip("uvloop")
+import uvicorn
+from langchain_ollama import ChatOllama
+
+from benchmarks.ollama_stub import StubSettings
+from benchmarks.pipeline_benchmark import HashEmbeddings, synthetic_chunks
+from benchmarks.prompt_layout_benchmark import free_port, start_stub
+from bairdotr.documents import FaissStoreHandler
+from bairdotr.llm_wrapper import get_runnable_chain
+
+# Ответ заглушки идёт ~6 секунд: без отмены генерация не закончится раньше проверки
+STUB = StubSettings(ttft = 0.05, tps = 50, tokens = 300, parallel = 4, prefill_tps = 5000, jitter = 0.0)
+RUNS = 10
+
+
+@pytest.fixture(scope = "module")
+def api_server():
+    """API на uvloop (как с uvicorn[standard]) поверх заглушки Ollama. Возвращает адреса API и заглушки"""
+    import api_backend.api_activation as api
+
+    stub_url = start_stub(STUB)
+    model = ChatOllama(model = "gemma2", base_url = stub_url, keep_alive = -1)
+    vector_store = FaissStoreHandler(HashEmbeddings())
+    vector_store.add_documents(synthetic_chunks(200, 0))
+    api.RUNTIME.model = model
+    api.RUNTIME.vector_store = vector_store
+    api.RUNTIME.runnable_with_history = get_runnable_chain(model)
+    api.RUNTIME.answer_cache = None
+    api.RUNTIME._ready.set()
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        api.app, host = "127.0.0.1", port = port, log_level = "warning", lifespan = "off", loop = "uvloop"
+    ))
+    threading.Thread(target = server.run, daemon = True).start()
+    while not server.started:
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}", stub_url
+    server.should_exit = True
+    api.RUNTIME._ready.clear()
+
+def wait_aborted(stub_url: str, expected: int, timeout: float = 0.5) -> dict:
+    deadline = time.perf_counter() + timeout
+    while True:
+        stats = httpx.get(stub_url + "/stub/stats").json()
+        if (stats["aborted"] >= expected and stats["active"] == 0) or time.perf_counter() > deadline:
+            return stats
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize("protocol", ["delta", "events"])
+def test_stream_chat_disconnect_aborts_generation(api_server, protocol):
+    """Клиент /stream_chat/ уходит после первого куска ответа: запрос к Ollama должен закрываться сразу и каждый раз
+    (раньше в delta примерно каждый пятый запрос оставался открытым, пока цепочку не соберёт сборщик мусора)"""
+    base_url, stub_url = api_server
+    aborted = httpx.get(stub_url + "/stub/stats").json()["aborted"]
+
+    for i in range(RUNS):
+        with httpx.Client(base_url = base_url, timeout = 30) as client:
+            body = {"question": f"вопрос {i}", "session_id": f"{protocol}-{i}"}
+            with client.stream("POST", f"/stream_chat/?protocol={protocol}", json = body) as response:
+                assert response.status_code == 200
+                next(response.iter_text())
+
+        aborted += 1
+        stats = wait_aborted(stub_url, aborted)
+        assert stats["aborted"] == aborted, f"run {i}: generation was not aborted"
+        assert stats["active"] == 0
+
+def test_stream_chat_full_answer(api_server):
+    base_url, stub_url = api_server
+    response = httpx.post(base_url + "/stream_chat/", json = {"question": "полный вопрос", "session_id": "full"}, timeout = 30)
+    assert response.text.endswith("END_OF_STREAM")
+    assert "прерван" not in response.text
@@ -0,0 +1,65 @@
+from langchain_core.documents import Document
+
+from bairdotr.prompt_context import TokenCounter, assemble_rag_context, merge_texts
+
+# Оценка по длине: 1 токен = 4 символа, удобно считать в тестах
+COUNTER = TokenCounter(chars_per_token = 4)
+
+
+def words(prefix: str, n: int) -> str:
+    return " ".join(f"{prefix}{i:03d}" for i in range(n))
+
+def doc(text: str, source: str) -> Document:
+    return Document(page_content = text, metadata = {"source": source})
+
+
+def test_unavailable_tokenizer_falls_back_to_estimate(tmp_path):
+    counter = TokenCounter(str(tmp_path / "missing-tokenizer"), chars_per_token = 4)
+    assert not counter.exact
+    assert counter.error
+    assert counter.count("a" * 40) == 10
+
+def test_truncate_by_word_boundary():
+    text = words("w", 50)
+    cut = COUNTER.truncate(text, 10)
+    assert len(cut) <= 40
+    assert text.startswith(cut) and not cut.endswith(" ")
+    assert cut.split()[-1] in text.split()
+    assert COUNTER.truncate(text, 0) == ""
+    assert COUNTER.truncate("коротко", 10) == "коротко"
+
+def test_merge_overlapping_chunks():
+    text = words("w", 40)
+    left, right = text[:200], text[150:]
+    assert merge_texts(left, right) == text
+    assert merge_texts(right, left) == text
+    assert merge_texts(text, text[20:80]) == text
+    assert merge_texts(words("a", 10), words("b", 10)) is None
+
+def test_context_merges_and_drops_duplicates():
+    text = words("w", 40)
+    documents = [
+        doc(text[:200], "a.txt"),
+        doc(words("x", 30), "b.txt"),
+        doc(text[150:], "a.txt"),
+        # Тот же текст в другом файле
+        doc(words("x", 30), "c.txt"),
+    ]
+    context = assemble_rag_context(documents, budget = 10_000, counter = COUNTER)
+    assert [p.text for p in context.passages] == [text, words("x", 30)]
+    assert context.merged == 1 and context.duplicates == 1
+    assert context.tokens < context.retrieved_tokens
+    assert not context.exact_tokens
+
+def test_context_respects_budget():
+    documents = [doc(words(f"d{i}_", 60), f"{i}.txt") for i in range(5)]
+    one = COUNTER.count(documents[0].page_content)
+    budget = 2 * one + 60
+    context = assemble_rag_context(documents, budget = budget, counter = COUNTER)
+
+    assert context.tokens <= budget
+    assert sum(p.tokens for p in context.passages) == context.tokens
+    # Два отрывка целиком, третий обрезан по остатку бюджета, остальные не поместились
+    assert [p.source for p in context.passages] == ["0.txt", "1.txt", "2.txt"]
+    assert context.truncated == 1 and context.dropped == 2
+    assert documents[2].page_content.startswith(context.passages[2].text)
@@ -0,0 +1,118 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_ollama import ChatOllama
+
+from bairdotr import prompt_layout
+from bairdotr.llm_wrapper import make_chain_input, make_prompt_messages
+from bairdotr.prompt_context import TokenCounter
+from bairdotr.prompt_layout import (
+    MESSAGE_OVERHEAD_TOKENS,
+    ContextSizer,
+    count_message_tokens,
+    make_request_kwargs,
+    split_turns,
+    window_history
+)
+
+# Оценка по длине: 1 токен = 4 символа, без загрузки токенизатора
+COUNTER = TokenCounter(chars_per_token = 4)
+# Ход из вопроса и ответа по 40 символов - 2 * (10 + MESSAGE_OVERHEAD_TOKENS) токенов
+TURN_TOKENS = 2 * (10 + MESSAGE_OVERHEAD_TOKENS)
+
+
+@pytest.fixture(autouse = True)
+def estimate_tokens(monkeypatch):
+    monkeypatch.setattr(prompt_layout, "get_token_counter", lambda: COUNTER)
+    monkeypatch.setattr(prompt_layout, "_CONTEXT_SIZERS", {})
+
+
+def dialog(n_turns: int) -> list:
+    messages = [SystemMessage(content = "system"), AIMessage(content = "hello")]
+    for i in range(n_turns):
+        messages += [HumanMessage(content = f"q{i:02d}".ljust(40, ".")), AIMessage(content = f"a{i:02d}".ljust(40, "."))]
+    return messages
+
+def questions(messages: list) -> list:
+    return [message.content[:3] for message in messages if message.type == "human"]
+
+
+def test_split_turns():
+    prefix, turns = split_turns(dialog(3))
+    assert [message.content for message in prefix] == ["system", "hello"]
+    assert len(turns) == 3
+    assert all([message.type for message in turn] == ["human", "ai"] for turn in turns)
+    assert split_turns([]) == ([], [])
+
+def test_window_under_budget_keeps_history():
+    messages = dialog(4)
+    assert count_message_tokens(messages[2:], COUNTER) == 4 * TURN_TOKENS
+    assert window_history(messages, budget = 4 * TURN_TOKENS, drop_turns = 1, counter = COUNTER) == messages
+
+def test_window_drops_whole_turns_and_keeps_prefix():
+    window = window_history(dialog(6), budget = 4 * TURN_TOKENS, drop_turns = 1, counter = COUNTER)
+    assert [message.content for message in window[:2]] == ["system", "hello"]
+    assert questions(window) == ["q02", "q03", "q04", "q05"]
+    assert window[-1].type == "ai"
+
+def test_window_drops_turns_in_steps():
+    # Нужно отбросить 1 ход, отбрасывается сразу 3
+    window = window_history(dialog(6), budget = 5 * TURN_TOKENS, drop_turns = 3, counter = COUNTER)
+    assert questions(window) == ["q03", "q04", "q05"]
+    # Пока окно не сдвигается, промпт следующего хода продолжает промпт предыдущего
+    longer = window_history(dialog(7), budget = 5 * TURN_TOKENS, drop_turns = 3, counter = COUNTER)
+    assert longer[:len(window)] == window
+    # Больше ходов, чем есть, не отбрасывается
+    assert questions(window_history(dialog(2), budget = 0, drop_turns = 3, counter = COUNTER)) == []
+
+def test_context_sizer_grows_by_powers_of_two():
+    sizer = ContextSizer(minimum = 1024, maximum = 8192, reserve = 500)
+    assert sizer.size(100) == 1024
+    assert sizer.size(600) == 2048
+    assert sizer.size(3000) == 4096
+    assert sizer.size(100000) == 8192
+
+def test_context_sizer_never_shrinks():
+    sizer = ContextSizer(minimum = 1024, maximum = 8192, reserve = 500)
+    assert sizer.size(2000) == 4096
+    assert sizer.size(10) == 4096
+    assert sizer.current == 4096
+
+def test_request_kwargs_size_num_ctx_by_prompt():
+    model = ChatOllama(model = "layout-test", temperature = 0.2, stop = ["<end_of_turn>"], keep_alive = "1h")
+    kwargs = make_request_kwargs(model, dialog(1))
+    assert kwargs["keep_alive"] == "1h"
+    # Параметры модели не теряются при передаче `options`
+    assert kwargs["options"]["temperature"] == 0.2
+    assert kwargs["options"]["stop"] == ["<end_of_turn>"]
+    short_ctx = kwargs["options"]["num_ctx"]
+    assert short_ctx == prompt_layout.get_context_sizer("layout-test").current
+
+    long_prompt = [HumanMessage(content = "x" * 4 * 2 * short_ctx)]
+    assert make_request_kwargs(model, long_prompt)["options"]["num_ctx"] > short_ctx
+    # После длинного промпта num_ctx не уменьшается
+    assert make_request_kwargs(model, dialog(1))["options"]["num_ctx"] > short_ctx
+
+def test_request_kwargs_keep_explicit_num_ctx():
+    model = ChatOllama(model = "layout-test", num_ctx = 2048)
+    kwargs = make_request_kwargs(model, [HumanMessage(content = "x" * 100000)])
+    assert kwargs["options"]["num_ctx"] == 2048
+    assert kwargs["keep_alive"] == prompt_layout.OLLAMA_KEEP_ALIVE
+
+def test_request_kwargs_empty_for_other_models():
+    assert make_request_kwargs(object(), dialog(1)) == {}
+
+def test_prefix_cache_layout_keeps_plain_questions_in_history():
+    history = dialog(1)
+    messages, new_history = make_prompt_messages("вопрос", "вопрос с чанками", list(history), layout = "prefix_cache")
+    assert messages[:-1] == new_history[:-1] == history
+    assert messages[-1].content == "вопрос с чанками"
+    assert new_history[-1].content == "вопрос"
+    assert make_chain_input("вопрос", "вопрос с чанками", layout = "prefix_cache") == {
+        "input": "вопрос", "rag_input": "вопрос с чанками"
+    }
+
+def test_legacy_layout_keeps_rag_prompt_in_history():
+    messages, new_history = make_prompt_messages("вопрос", "вопрос с чанками", dialog(1), layout = "legacy")
+    assert messages is new_history
+    assert new_history[-1].content == "вопрос с чанками"
+    assert make_chain_input("вопрос", "вопрос с чанками", layout = "legacy") == {"input": "вопрос с чанками"}
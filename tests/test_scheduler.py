@@ -0,0 +1,148 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from bairdotr.scheduler import LlmOverloaded, LlmScheduler, llm_client, llm_priority
+
+
+async def call(scheduler: LlmScheduler, order: list, name: str, priority: str, client: str, hold: float = 0.02) -> None:
+    with llm_priority(priority), llm_client(client):
+        async with scheduler.slot():
+            order.append(name)
+            await asyncio.sleep(hold)
+
+
+def test_priority_and_round_robin():
+    """Свободный слот получает самый важный класс, внутри класса клиенты чередуются"""
+    async def main():
+        scheduler = LlmScheduler(max_concurrent = 1, max_queued = 10, queue_deadline = 5)
+        order = []
+        blocker = asyncio.ensure_future(call(scheduler, order, "first", "background", "x", 0.1))
+        await asyncio.sleep(0.01)
+        calls = [
+            ("bg-a", "background", "a"),
+            ("aug-a1", "augmentation", "a"),
+            ("aug-a2", "augmentation", "a"),
+            ("aug-a3", "augmentation", "a"),
+            ("aug-b1", "augmentation", "b"),
+            ("gen-c", "generation", "c"),
+            ("aug-b2", "augmentation", "b"),
+        ]
+        tasks = []
+        for name, priority, client in calls:
+            tasks.append(asyncio.ensure_future(call(scheduler, order, name, priority, client)))
+            await asyncio.sleep(0)
+        await asyncio.gather(blocker, *tasks)
+        return order, scheduler.active
+
+    order, active = asyncio.run(main())
+    assert order == ["first", "gen-c", "aug-a1", "aug-b1", "aug-a2", "aug-b2", "aug-a3", "bg-a"]
+    assert active == 0
+
+def test_queue_deadline():
+    async def main():
+        scheduler = LlmScheduler(max_concurrent = 1, queue_deadline = 0.2)
+        async with scheduler.slot():
+            start = time.perf_counter()
+            with pytest.raises(LlmOverloaded) as e:
+                await scheduler.acquire()
+            waited = time.perf_counter() - start
+        return scheduler, waited, e.value
+
+    scheduler, waited, error = asyncio.run(main())
+    assert 0.15 < waited < 1
+    assert error.retry_after >= 1
+    assert scheduler.active == 0 and sum(scheduler.queued().values()) == 0
+
+def test_check_rejects_by_estimate():
+    """После первых замеров длительности вызова заведомо долгое ожидание отклоняется сразу"""
+    async def main():
+        scheduler = LlmScheduler(max_concurrent = 1, queue_deadline = 0.5)
+        await scheduler.acquire()
+        scheduler.release(hold_seconds = 2.0)
+        # Слот свободен - ждать не придётся
+        scheduler.check()
+        async with scheduler.slot():
+            with pytest.raises(LlmOverloaded) as e:
+                scheduler.check()
+        return e.value
+
+    error = asyncio.run(main())
+    assert error.retry_after >= 2
+
+def test_max_queued():
+    async def main():
+        scheduler = LlmScheduler(max_concurrent = 1, max_queued = 1, queue_deadline = 5)
+        async with scheduler.slot():
+            waiter = asyncio.ensure_future(scheduler.acquire())
+            await asyncio.sleep(0.01)
+            with pytest.raises(LlmOverloaded):
+                await scheduler.acquire()
+        await waiter
+        scheduler.release()
+        return scheduler
+
+    assert asyncio.run(main()).active == 0
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        scheduler = LlmScheduler(max_concurrent = 1, queue_deadline = 5)
+        async with scheduler.slot():
+            waiter = asyncio.ensure_future(scheduler.acquire(priority = "augmentation"))
+            await asyncio.sleep(0.01)
+            assert scheduler.queued()["augmentation"] == 1
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions = True)
+            assert scheduler.queued()["augmentation"] == 0
+        return scheduler
+
+    assert asyncio.run(main()).active == 0
+
+def test_sync_slot_waits_for_async_holder():
+    scheduler = LlmScheduler(max_concurrent = 1, queue_deadline = 5)
+    order = []
+
+    def worker():
+        with scheduler.sync_slot(priority = "augmentation"):
+            order.append("thread")
+
+    async def main():
+        async with scheduler.slot():
+            thread = threading.Thread(target = worker)
+            thread.start()
+            await asyncio.sleep(0.05)
+            order.append("async")
+        await asyncio.to_thread(thread.join)
+
+    asyncio.run(main())
+    assert order == ["async", "thread"]
+    assert scheduler.active == 0
+
+
+def test_abandoned_stream_releases_slot_after_closing_ollama_request():
+    """Брошенный поток ScheduledChatOllama закрывает запрос к Ollama, и только потом слот освобождается"""
+    pytest.importorskip("langchain_huggingface")
+    import httpx
+    from benchmarks.ollama_stub import StubSettings
+    from benchmarks.prompt_layout_benchmark import start_stub
+    from bairdotr.ollama_llm import ScheduledChatOllama
+    from bairdotr.scheduler import get_llm_scheduler
+
+    stub_url = start_stub(StubSettings(ttft = 0.05, tps = 50, tokens = 300, parallel = 2, prefill_tps = 5000, jitter = 0.0))
+    model = ScheduledChatOllama(model = "gemma2", base_url = stub_url, keep_alive = -1)
+    scheduler = get_llm_scheduler()
+
+    async def main():
+        stream = model.astream("вопрос")
+        await stream.__anext__()
+        assert scheduler.active == 1
+        await stream.aclose()
+        return scheduler.active
+
+    assert asyncio.run(main()) == 0
+    deadline = time.perf_counter() + 1
+    while httpx.get(stub_url + "/stub/stats").json()["aborted"] < 1 and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    assert httpx.get(stub_url + "/stub/stats").json()["aborted"] == 1
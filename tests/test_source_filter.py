@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from benchmarks.pipeline_benchmark import HashEmbeddings, synthetic_chunks
+from bairdotr.documents import FaissStoreHandler
+from bairdotr.faiss_index import IndexParams
+from bairdotr.source_index import SourceIndex
+
+SELECTED = ["book_3.txt", "book_7.txt"]
+QUERY = "предел функции и производная интеграла"
+
+
+def make_store(index_params: IndexParams = None) -> FaissStoreHandler:
+    store = FaissStoreHandler(HashEmbeddings(), index_params = index_params)
+    store.add_documents(synthetic_chunks(400, 0))
+    return store
+
+
+def test_source_index_positions_and_save(tmp_path):
+    source_index = SourceIndex.build([(0, "a.txt"), (1, "b.txt"), (2, "a.txt"), (3, None)])
+    assert source_index.positions(["a.txt"]).tolist() == [0, 2]
+    assert source_index.positions(["b.txt", "a.txt", "a.txt"]).tolist() == [0, 1, 2]
+    assert source_index.positions(["unknown.txt"]).tolist() == []
+    assert source_index.sources() == {"a.txt": 2, "b.txt": 1}
+
+    source_index.remove_positions([0])
+    source_index.remap({1: 0, 2: 1})
+    assert source_index.positions(["a.txt", "b.txt"]).tolist() == [0, 1]
+
+    source_index.save(str(tmp_path))
+    loaded = SourceIndex.load(str(tmp_path))
+    assert loaded.sources() == {"a.txt": 1, "b.txt": 1}
+    assert loaded.positions(["a.txt"]).tolist() == [1]
+
+@pytest.mark.parametrize("index_params", [
+    IndexParams(),
+    IndexParams(index_type = "hnsw", hnsw_m = 16, ef_construction = 40),
+    IndexParams(index_type = "ivf_flat", nlist = 4, nprobe = 4),
+], ids = lambda params: params.index_type)
+def test_filtered_search_keeps_k_results_from_selected_sources(index_params):
+    store = make_store(index_params)
+    found = store.similarity_search(QUERY, k = 8, sources = SELECTED)
+    assert len(found) == 8
+    assert {doc.metadata["source"] for doc in found} <= set(SELECTED)
+
+def test_filtered_search_is_exact_on_flat_index():
+    """Фильтр внутри индекса даёт те же k лучших, что и полный перебор с отбрасыванием чужих чанков"""
+    store = make_store()
+    vector = store.embed_query(QUERY)
+    filtered = store.search_by_vectors([vector], k = 5, sources = SELECTED)[0]
+    everything = store.search_by_vectors([vector], k = 400)[0]
+    expected = [doc for doc, _ in everything if doc.metadata["source"] in SELECTED][:5]
+    assert [doc.metadata["id"] for doc, _ in filtered] == [doc.metadata["id"] for doc in expected]
+
+def test_filtered_search_after_delete_and_compact():
+    store = make_store()
+    ids = [id_ for id_, doc in store.vector_store_faiss.docstore._dict.items() if doc.metadata["source"] == "book_3.txt"]
+    store.delete_ids(ids)
+    assert store.similarity_search(QUERY, k = 8, sources = ["book_3.txt"]) == []
+    assert {doc.metadata["source"] for doc in store.similarity_search(QUERY, k = 8, sources = SELECTED)} == {"book_7.txt"}
+
+    store.compact()
+    found = store.similarity_search(QUERY, k = 8, sources = SELECTED)
+    assert len(found) == 8 and {doc.metadata["source"] for doc in found} == {"book_7.txt"}
+
+
+@pytest.mark.parametrize("sources", ["book_3.txt", [1, 2], [None], {"book_3.txt": 1}])
+def test_websocket_rejects_invalid_sources(sources):
+    from fastapi.testclient import TestClient
+    import api_backend.api_activation as api
+
+    api.RUNTIME._ready.clear()
+    with TestClient(api.app).websocket_connect("/ws/chat/?protocol=delta") as ws:
+        ws.send_text(json.dumps({"message": "вопрос", "sources": sources}))
+        assert json.loads(ws.receive_text())["name"] == "bad_request"
+        # Список строк проходит проверку (дальше - отказ not_ready: база не загружена)
+        ws.send_text(json.dumps({"message": "вопрос", "sources": SELECTED}))
+        assert json.loads(ws.receive_text())["name"] == "not_ready"
@@ -0,0 +1,172 @@
+import json
+import asyncio
+
+import pytest
+
+from bairdotr.streaming import ClientDisconnected, FrameEncoder, coalesce, stop_on_disconnect, stream_in_task
+
+
+class Source():
+    """Бесконечный поток токенов с паузой: запоминает, закрыт ли он и как (отменой или aclose)"""
+    def __init__(self, pause: float = 0.01) -> None:
+        self.pause = pause
+        self.sent = 0
+        self.closed_by = None
+
+    async def stream(self):
+        try:
+            while True:
+                await asyncio.sleep(self.pause)
+                self.sent += 1
+                yield f"t{self.sent} "
+        except asyncio.CancelledError:
+            self.closed_by = "cancel"
+            raise
+        except GeneratorExit:
+            self.closed_by = "aclose"
+            raise
+
+
+async def timed(tokens):
+    """Поток токенов: (пауза перед токеном, токен)"""
+    for pause, token in tokens:
+        await asyncio.sleep(pause)
+        yield token
+
+def collect(chunks) -> list:
+    async def main():
+        return [chunk async for chunk in chunks]
+    return asyncio.run(main())
+
+
+def test_frame_encoder_json():
+    encoder = FrameEncoder("json")
+    assert json.loads(encoder.encode("delta", "привет")) == {"type": "delta", "delta": "привет"}
+    # Пустой delta не передаётся
+    assert json.loads(encoder.encode("end")) == {"type": "end"}
+    assert json.loads(encoder.encode("error", "текст", "overloaded")) == {"type": "error", "delta": "текст", "name": "overloaded"}
+    assert "привет" in encoder.encode("delta", "привет")
+
+def test_frame_encoder_binary():
+    encoder = FrameEncoder("binary")
+    assert encoder.encode("delta", "привет") == b"D" + "привет".encode("utf-8")
+    assert encoder.encode("start") == b"S"
+    assert encoder.encode("error", "текст", "not_ready") == b"X" + "not_ready\nтекст".encode("utf-8")
+
+def test_frame_encoder_msgpack():
+    msgpack = pytest.importorskip("msgpack")
+    assert msgpack.unpackb(FrameEncoder("msgpack").encode("delta", "а")) == {"type": "delta", "delta": "а"}
+
+def test_frame_encoder_unknown_encoding():
+    with pytest.raises(ValueError):
+        FrameEncoder("xml")
+
+def test_coalesce_first_token_immediately_then_by_interval():
+    tokens = [(0, "a"), (0, "b"), (0, "c"), (0.2, "d"), (0, "e")]
+    assert collect(coalesce(timed(tokens), interval = 0.05, max_bytes = 1000)) == ["a", "bc", "de"]
+
+def test_coalesce_flushes_by_size():
+    tokens = [(0, "x")] + [(0, "ab")] * 5
+    assert collect(coalesce(timed(tokens), interval = 10, max_bytes = 4)) == ["x", "abab", "abab", "ab"]
+
+def test_coalesce_flushes_during_pause():
+    """Накопленный кусок уходит по таймеру, не дожидаясь следующего токена"""
+    async def main():
+        received = []
+        start = asyncio.get_running_loop().time()
+        async for chunk in coalesce(timed([(0, "a"), (0, "b"), (1.0, "c")]), interval = 0.05, max_bytes = 1000):
+            received.append((chunk, asyncio.get_running_loop().time() - start))
+        return received
+
+    received = asyncio.run(main())
+    assert [chunk for chunk, _ in received] == ["a", "b", "c"]
+    assert received[1][1] < 0.5
+
+def test_coalesce_closes_source():
+    source = Source()
+
+    async def main():
+        chunks = coalesce(source.stream(), interval = 0.05)
+        await chunks.__anext__()
+        await chunks.aclose()
+
+    asyncio.run(main())
+    assert source.closed_by is not None
+
+
+def test_stream_in_task_passes_chunks_and_errors():
+    async def finite():
+        yield "a"
+        yield "b"
+
+    async def failing():
+        yield "a"
+        raise RuntimeError("boom")
+
+    assert collect(stream_in_task(finite())) == ["a", "b"]
+    with pytest.raises(RuntimeError, match = "boom"):
+        collect(stream_in_task(failing()))
+
+def test_stream_in_task_cancels_source_on_close():
+    """Закрытие потока отменяет читающую задачу: отмена доходит до await внутри исходного генератора"""
+    source = Source()
+
+    async def main():
+        stream = stream_in_task(source.stream())
+        assert await stream.__anext__() == "t1 "
+        await stream.aclose()
+
+    asyncio.run(main())
+    assert source.closed_by == "cancel"
+
+def test_stream_in_task_cancels_source_when_consumer_cancelled():
+    source = Source()
+
+    async def consume():
+        async for _ in stream_in_task(source.stream()):
+            pass
+
+    async def main():
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions = True)
+
+    asyncio.run(main())
+    assert source.closed_by == "cancel"
+
+def test_stop_on_disconnect():
+    source = Source()
+    checks = []
+
+    async def is_disconnected():
+        checks.append(source.sent)
+        return len(checks) >= 3
+
+    async def main():
+        received = []
+        with pytest.raises(ClientDisconnected):
+            async for chunk in stop_on_disconnect(source.stream(), is_disconnected, interval = 0.02):
+                received.append(chunk)
+        return received
+
+    received = asyncio.run(main())
+    assert len(checks) == 3
+    assert received and source.closed_by is not None
+    # После отключения исходный поток больше не читается
+    assert source.sent <= len(received) + 1
+
+def test_stop_on_disconnect_checks_while_source_is_silent():
+    """Пока модель обрабатывает промпт и токенов нет, отключение всё равно замечается"""
+    source = Source(pause = 10)
+
+    async def is_disconnected():
+        return True
+
+    async def main():
+        async for _ in stop_on_disconnect(source.stream(), is_disconnected, interval = 0.02):
+            pass
+
+    with pytest.raises(ClientDisconnected):
+        asyncio.run(asyncio.wait_for(main(), 1))
+    assert source.closed_by == "cancel"
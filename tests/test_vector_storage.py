@@ -0,0 +1,31 @@
+import faiss
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from bairdotr.vector_storage import ChunkStore, OFFSETS_FILE, write_mmap_store
+
+
+def make_index(n: int) -> faiss.Index:
+    index = faiss.IndexFlatL2(4)
+    index.add(np.random.default_rng(0).random((n, 4), dtype = np.float32))
+    return index
+
+def docs(n: int) -> list:
+    return [Document(id = str(i), page_content = f"chunk {i}", metadata = {"source": "a.txt"}) for i in range(n)]
+
+
+def test_mmap_store_roundtrip(tmp_path):
+    write_mmap_store(str(tmp_path), make_index(3), docs(2) + [None])
+    store = ChunkStore(str(tmp_path))
+    assert store.count == 3
+    assert store.get(1).page_content == "chunk 1"
+    assert store.is_deleted(2) and store.get(2) is None
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_chunk_store_rejects_files_of_different_saves(tmp_path):
+    # Загрузка между подменой chunks.idx и storage.json видит файлы двух разных сохранений
+    write_mmap_store(str(tmp_path), make_index(3), docs(3))
+    np.arange(6, dtype = np.int64).tofile(tmp_path / OFFSETS_FILE)
+    with pytest.raises(ValueError):
+        ChunkStore(str(tmp_path))
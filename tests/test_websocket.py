@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api_backend.api_activation as api
+
+
+@pytest.fixture
+def client():
+    # Без загрузки модели и базы: на вопросы приходит отказ not_ready, разбор сообщений проверяется и так
+    api.RUNTIME._ready.clear()
+    return TestClient(api.app)
+
+def receive_error(ws) -> dict:
+    frame = json.loads(ws.receive_text())
+    assert frame["type"] == "error"
+    return frame
+
+
+def test_bad_requests_get_error_frame(client):
+    with client.websocket_connect("/ws/chat/?protocol=delta") as ws:
+        for data in ["not json", "{'message': 'вопрос'}", json.dumps({"message": 1}), json.dumps({"question": "вопрос"})]:
+            ws.send_text(data)
+            assert receive_error(ws)["name"] == "bad_request"
+
+        # После ошибки соединение продолжает работать
+        ws.send_text(json.dumps({"message": "вопрос"}))
+        assert receive_error(ws)["name"] == "not_ready"
+
+def test_default_protocol_is_events(client):
+    """Без ?protocol= формат ответа прежний (события), у существующих клиентов ничего не меняется"""
+    with client.websocket_connect("/ws/chat/") as ws:
+        ws.send_text(json.dumps({"message": "вопрос"}))
+        assert ws.receive_json() == {"event": "error", "name": "not_ready", "data": api.NOT_READY_TEXT, "run_id": "rag_system"}
+
+def test_binary_encoding(client):
+    with client.websocket_connect("/ws/chat/?protocol=delta&encoding=binary") as ws:
+        ws.send_text(json.dumps({"message": "вопрос"}))
+        assert ws.receive_bytes() == b"X" + f"not_ready\n{api.NOT_READY_TEXT}".encode("utf-8")
+
+def test_client_close_between_questions(client):
+    """Закрытие соединения клиентом между вопросами - штатное завершение, а не ошибка приложения
+    (исключение приложения TestClient пробросил бы при выходе из блока)"""
+    with client.websocket_connect("/ws/chat/?protocol=events") as ws:
+        ws.send_text(json.dumps({"message": "вопрос"}))
+        assert json.loads(ws.receive_text())["name"] == "not_ready"
+        ws.close()
+
+def test_unknown_protocol_closes_connection(client):
+    from starlette.websockets import WebSocketDisconnect
+
+    with pytest.raises(WebSocketDisconnect) as e:
+        with client.websocket_connect("/ws/chat/?protocol=xml") as ws:
+            ws.receive_text()
+    assert e.value.code == 1003